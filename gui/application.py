@@ -331,7 +331,22 @@ class Application (object):
         cache_size = self.preferences.get(
             'ui.rendered_tile_cache_size', lib.cache.DEFAULT_CACHE_SIZE
         )
-        model = lib.document.Document(self.brush, cache_size=cache_size)
+        render_workers = self.preferences.get('ui.render_workers', 0)
+        lazy_loading = self.preferences.get('document.lazy_loading', True)
+        resident_tile_limit = self.preferences.get(
+            'document.resident_tile_limit', 0
+        )
+        packed_tile_limit = self.preferences.get(
+            'document.packed_tile_limit', 8192
+        )
+        model = lib.document.Document(
+            self.brush,
+            cache_size=cache_size,
+            render_workers=render_workers,
+            lazy_loading=lazy_loading,
+            resident_tile_limit=resident_tile_limit,
+            packed_tile_limit=packed_tile_limit,
+        )
         self.doc = document.Document(self, app_canvas, model)
         app_canvas.set_model(model)
 
@@ -777,6 +792,14 @@ class Application (object):
     def run_garbage_collector_cb(self, action):
         helpers.run_garbage_collector()
 
+    def print_render_cache_stats_cb(self, action):
+        """Prints the working doc's render cache counters to stdout."""
+        root = self.doc.model.layer_stack
+        stats = root.get_render_cache_stats()
+        print("Render cache: %r" % (root._render_cache,))
+        for key in sorted(stats.keys()):
+            print("  %s: %d" % (key, stats[key]))
+
     def crash_program_cb(self, action):
         """Tests exception handling."""
         raise Exception("This is a crash caused by the user.")
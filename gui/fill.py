@@ -33,6 +33,7 @@ import lib.helpers
 import lib.mypaintlib
 import lib.layer
 import lib.modes
+import lib.surface
 
 
 # Class defs
@@ -329,8 +330,13 @@ def status_callback(handler):
 
     curr_stage = [None]
 
+    # Show the fill spreading over the canvas as it runs
+    preview = _FillPreviewLayer(
+        app.doc.model.layer_stack, handler.preview)
+
     # Status update ticker callback - also handles dialog destruction
     def status_update():
+        preview.update()
         if handler.running():
             # Only update the header when the stage has changed
             if curr_stage[0] != handler.stage:
@@ -351,11 +357,55 @@ def status_callback(handler):
         handler.cancel()
     status_dialog.hide()
     handler.wait()
+    preview.remove()
     status_dialog.destroy()
     app.kbm.enabled = True
     return result == Gtk.ResponseType.OK
 
 
+class _FillPreviewLayer (object):
+    """Shows the tiles of a running fill over the current layer
+
+    The tiles come from a lib.floodfill.FillPreview, and are copied
+    into a temporary layer used as the root stack's current layer
+    overlay, which draws them the same way the finished fill will be.
+    """
+
+    def __init__(self, root, preview):
+        self._root = root
+        self._preview = preview
+        self._layer = None
+
+    def update(self):
+        """Copy newly published tiles into the overlay layer"""
+        if self._preview is None:
+            return
+        tiles = self._preview.take_updates()
+        if not tiles:
+            return
+        layer = self._layer
+        if layer is None:
+            layer = lib.layer.SimplePaintingLayer()
+            layer.mode = self._preview.mode
+            layer.opacity = self._preview.opacity
+            self._root.current_layer_overlay = layer
+            self._layer = layer
+        surface = layer._surface
+        for (tx, ty), rgba in tiles.items():
+            with surface.tile_request(tx, ty, readonly=False) as tile:
+                tile[...] = rgba
+        bbox = lib.surface.get_tiles_bbox(tiles)
+        surface.notify_observers(*bbox)
+
+    def remove(self):
+        """Remove the overlay layer, if it was added"""
+        if self._layer is None:
+            return
+        if self._root.current_layer_overlay is self._layer:
+            self._root.current_layer_overlay = None
+        self._layer = None
+
+
 class FloodFillOverlay (gui.overlays.Overlay):
     """
     Overlay indicating pixels that constitute the fill seeds
@@ -27,6 +27,7 @@ import numpy as np
 from lib import helpers, tiledsurface, pixbufsurface
 from lib.observable import event
 import lib.layer
+import lib.surface
 from . import cursor
 from .drawutils import render_checks
 import gui.style
@@ -404,7 +405,7 @@ class TiledDrawWidget (Gtk.EventBox):
         self.renderer.translation_y += cy - cy_new
         # Redraw handling
         if ongoing:
-            self.renderer.defer_hq_rendering()
+            self.renderer.defer_hq_rendering(coarse=True)
         self.renderer.queue_draw()
 
     def zoom(self, zoom_step, center=None, ongoing=True):
@@ -682,6 +683,29 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
 
     """
 
+    ## Class constants
+
+    #: Extra mipmap levels used while zooming or rotating.
+    _COARSE_MIPMAP_LEVELS = 2
+
+    #: Tiles rendered per idle callback when refining a coarse view.
+    _REFINE_BATCH_TILES = 16
+
+    #: Tiles pre-rendered beyond each edge of the view.
+    _PREFETCH_MARGIN_TILES = 1
+
+    #: How far ahead to predict the view's movement, in seconds.
+    _PREFETCH_LOOKAHEAD = 0.25
+
+    #: Most tiles pre-rendered in the direction of movement.
+    _PREFETCH_MAX_AHEAD_TILES = 8
+
+    #: Most tiles pre-rendered for one position of the view.
+    _PREFETCH_MAX_TILES = 256
+
+    #: Tiles pre-rendered per idle callback.
+    _PREFETCH_BATCH_TILES = 8
+
     ## Method defs
 
     def __init__(self, tdw, idle_redraw_priority=None):
@@ -746,6 +770,23 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
         self._hq_rendering = True
         self._restore_hq_rendering_timeout_id = None
 
+        # Progressive rendering: coarse mipmaps during zooms and
+        # rotations, then refinement of the view in idle time
+        self._coarse_rendering = False
+        self._refine_queue = []
+        self._refine_state = None
+        self._refine_src_id = None
+
+        # Pixels rendered for earlier frames, reused where still valid
+        self._backing_store = _BackingStore()
+
+        # Pre-rendering into the render cache around the view, in the
+        # direction it's moving
+        self._prefetch_view = None
+        self._prefetch_sample = None  # (time, x, y, log2(scale))
+        self._prefetch_queue = []  # [(tx, ty, mipmap_level)]
+        self._prefetch_src_id = None
+
         self.connect("configure-event", self._configure_event_cb)
 
     def _init_alpha_checks(self):
@@ -859,6 +900,9 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
     def canvas_modified_cb(self, model, x, y, w, h):
         """Handles area redraw notifications from the underlying model"""
 
+        self._backing_store.invalidate_area(x, y, w, h)
+        self._cancel_prefetch()  # painting, probably
+
         if self._insensitive_state_content:
             return False
 
@@ -1111,9 +1155,13 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
             cr.paint()
 
         # Prep a pixbuf-surface aligned to the model to render into.
-        # This also applies the transformation.
+        # This also applies the transformation. Unless each render
+        # needs to be visible, it's part of the backing store.
+        backing_store = None
+        if not self.visualize_rendering:
+            backing_store = self._backing_store
         transformation, surface, sparse, mipmap_level, clip_rect = \
-            self._render_prepare(cr)
+            self._render_prepare(cr, backing_store=backing_store)
 
         # not sure if it is a good idea to clip so tightly
         # has no effect right now because device_bbox is always smaller
@@ -1135,6 +1183,7 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
             mipmap_level,
             clip_rect,
             filter = self.display_filter,
+            backing_store = backing_store,
         )
 
         # Using different random blues helps make one rendered bbox
@@ -1157,6 +1206,7 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
             overlay.paint(cr)
             cr.restore()
 
+        self._queue_prefetch()
         return True
 
     def _render_get_clip_region(self, cr, device_bbox):
@@ -1271,7 +1321,59 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
         tile_rect = helpers.Rect(*bbox)
         return clip_rect.overlaps(tile_rect)
 
-    def _render_prepare(self, cr):
+    def _get_mipmap_level(self):
+        """The mipmap level to render at, for the current view"""
+        # HQ rendering causes a very clear slowdown on some hardware.
+        # Probably could avoid this entirely by rendering differently,
+        # but for now, if the canvas is being panned around,
+        # just render more simply.
+        if self._hq_rendering:
+            mipmap_level = max(0, int(floor(log(1 / self.scale, 2))))
+        else:
+            mipmap_level = max(0, int(ceil(log(1 / self.scale, 2))))
+        # Zooms and rotations of big views are slow even so. Use much
+        # coarser mipmaps while they're happening, and refine after.
+        if self._coarse_rendering:
+            mipmap_level += self._COARSE_MIPMAP_LEVELS
+
+        # OPTIMIZE: If we would render tile scanlines,
+        # OPTIMIZE:  we could probably use the better one above...
+        return min(mipmap_level, tiledsurface.MAX_MIPMAP_LEVEL)
+
+    def _get_render_transformation(self, mipmap_level):
+        """Model-to-display matrix, scaled for a mipmap level"""
+        transformation = cairo.Matrix(*self._get_model_view_transformation())
+        transformation.scale(2**mipmap_level, 2**mipmap_level)
+        return transformation
+
+    def _get_view_model_rect(self, mipmap_level):
+        """The model area the whole view covers, as in _render_prepare()
+
+        :param int mipmap_level: mipmap level for the coordinates
+        :returns: (x1, y1, x2, y2), in model coords at mipmap_level
+        :rtype: tuple
+
+        """
+        alloc = self.get_allocation()
+        w, h = alloc.width, alloc.height
+        inverse = self._get_render_transformation(mipmap_level)
+        inverse.invert()
+        corners = [
+            inverse.transform_point(x, y)
+            for (x, y) in [(0, 0), (w, 0), (0, h), (w, h)]
+        ]
+        x1 = int(floor(min(x for (x, y) in corners)))
+        y1 = int(floor(min(y for (x, y) in corners)))
+        x2 = int(ceil(max(x for (x, y) in corners)))
+        y2 = int(ceil(max(y for (x, y) in corners)))
+        if not self.is_translation_only():
+            x1 -= 1
+            y1 -= 1
+            x2 += 1
+            y2 += 1
+        return (x1, y1, x2, y2)
+
+    def _render_prepare(self, cr, backing_store=None):
         """Prepares a blank pixbuf & other details for later rendering.
 
         Called when handling "draw" events. The size and shape of the
@@ -1280,6 +1382,9 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
         region that expresses what we've been asked to redraw, and by
         the TDW's own view transformation of the document.
 
+        If a backing store is passed, the returned surface is a view of
+        it, and isn't blank.
+
         """
         # Determine what to draw, and the nature of the reveal.
         allocation = self.get_allocation()
@@ -1291,21 +1396,8 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
         # Use a copy of the cached translation matrix for this
         # rendering. It'll need scaling if using a mipmap level
         # greater than zero.
-        transformation = cairo.Matrix(*self._get_model_view_transformation())
-
-        # HQ rendering causes a very clear slowdown on some hardware.
-        # Probably could avoid this entirely by rendering differently,
-        # but for now, if the canvas is being panned around,
-        # just render more simply.
-        if self._hq_rendering:
-            mipmap_level = max(0, int(floor(log(1 / self.scale, 2))))
-        else:
-            mipmap_level = max(0, int(ceil(log(1 / self.scale, 2))))
-
-        # OPTIMIZE: If we would render tile scanlines,
-        # OPTIMIZE:  we could probably use the better one above...
-        mipmap_level = min(mipmap_level, tiledsurface.MAX_MIPMAP_LEVEL)
-        transformation.scale(2**mipmap_level, 2**mipmap_level)
+        mipmap_level = self._get_mipmap_level()
+        transformation = self._get_render_transformation(mipmap_level)
 
         # bye bye device coordinates
         cr.save()   # >>>CONTEXT1
@@ -1330,13 +1422,32 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
         # factor 3 for ATI/Radeon Xorg driver (and hopefully others).
         # https://bugs.freedesktop.org/show_bug.cgi?id=28670
 
-        surface = pixbufsurface.Surface(x1, y1, x2 - x1 + 1, y2 - y1 + 1)
+        rect = (x1, y1, x2 - x1 + 1, y2 - y1 + 1)
+        if backing_store is None:
+            surface = pixbufsurface.Surface(*rect)
+        else:
+            key = self._get_backing_store_key(mipmap_level)
+            surface = backing_store.get_view(*rect, key=key)
         return transformation, surface, sparse, mipmap_level, clip_rect
 
+    def _get_backing_store_key(self, mipmap_level):
+        """Everything the backing store's pixels depend on, bar the model"""
+        model = self.doc
+        return (
+            mipmap_level,
+            self.display_filter,
+            self.overlay_layer,
+            self._draw_real_alpha_checks,
+            model.layer_stack.get_render_is_opaque(),
+        )
+
     def _render_execute(self, cr, transformation, surface, sparse,
-                        mipmap_level, clip_rect, filter=None):
+                        mipmap_level, clip_rect, filter=None,
+                        backing_store=None):
         """Renders tiles into a prepared pixbufsurface, then blits it.
 
+        If the surface is a view of a backing store, only the tiles
+        which aren't valid in the store are rendered.
 
         """
         translation_only = self.is_translation_only()
@@ -1344,10 +1455,6 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
         if self.visualize_rendering:
             surface.pixbuf.fill(int(random.random() * 0xff) << 16)
 
-        fake_alpha_check_tile = None
-        if not self._draw_real_alpha_checks:
-            fake_alpha_check_tile = self._fake_alpha_check_tile
-
         # Determine which tiles to render.
         tiles = list(surface.get_tiles())
         if sparse:
@@ -1362,16 +1469,15 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
                 )
             ]
 
+        if backing_store is not None:
+            tiles = backing_store.get_invalid_tiles(tiles)
+
         # Composite each stack of tiles in the exposed area
         # into the pixbufsurface.
-        self.doc._layers.render(
-            surface,
-            tiles,
-            mipmap_level,
-            overlay = self.overlay_layer,
-            opaque_base_tile = fake_alpha_check_tile,
-            filter = filter,
-        )
+        if tiles:
+            self._render_tiles(surface, tiles, mipmap_level, filter)
+        if backing_store is not None:
+            backing_store.set_valid(tiles)
 
         # Set the surface's underlying pixbuf as the source, then paint
         # it with Cairo. We don't care if it's pixelized at high zoom-in
@@ -1385,6 +1491,20 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
             pattern.set_filter(cairo.FILTER_NEAREST)
         cr.paint()
 
+    def _render_tiles(self, surface, tiles, mipmap_level, filter=None):
+        """Composite some tiles of the document into a surface"""
+        fake_alpha_check_tile = None
+        if not self._draw_real_alpha_checks:
+            fake_alpha_check_tile = self._fake_alpha_check_tile
+        self.doc._layers.render(
+            surface,
+            tiles,
+            mipmap_level,
+            overlay = self.overlay_layer,
+            opaque_base_tile = fake_alpha_check_tile,
+            filter = filter,
+        )
+
     def scroll(self, dx, dy, ongoing=True):
         self.translation_x -= dx
         self.translation_y -= dy
@@ -1437,10 +1557,11 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
         self.translation_y += current_cy - cy
         self.queue_draw()
 
-    def defer_hq_rendering(self, t=1.0 / 8):
+    def defer_hq_rendering(self, t=1.0 / 8, coarse=False):
         """Use faster but lower-quality rendering for a brief period
 
         :param float t: The time to defer for, in seconds
+        :param bool coarse: Use much coarser mipmaps, and refine later
 
         This method is intended to be called repeatedly
         from scroll or drag event handlers,
@@ -1456,7 +1577,15 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
         However it's slow enough to make rendering
         lag appreciably when scrolling.
 
+        Zooming and rotating big views is slower still, so those can
+        ask for `coarse` rendering. Normal service is then resumed
+        progressively, by refining the view in idle time, starting at
+        its centre. Each call cancels any refinement in progress.
+
         """
+        self._cancel_refinement()
+        if coarse:
+            self._coarse_rendering = True
         if self._restore_hq_rendering_timeout_id:
             GLib.source_remove(self._restore_hq_rendering_timeout_id)
             self._restore_hq_rendering_timeout_id = None
@@ -1470,11 +1599,456 @@ class CanvasRenderer (Gtk.DrawingArea, DrawCursorMixin):
 
     def _resume_hq_rendering_timeout_cb(self):
         self._hq_rendering = True
-        self.queue_draw()
+        coarse = self._coarse_rendering
+        self._coarse_rendering = False
+        if not (coarse and self._start_refinement()):
+            self.queue_draw()
         self._restore_hq_rendering_timeout_id = None
         logger.debug("hq_rendering: resumed")
         return False
 
+    def _start_refinement(self):
+        """Start replacing a coarse rendering of the view in idle time
+
+        :returns: False if a full redraw is needed instead
+        :rtype: bool
+
+        The whole view is rendered into the backing store, a batch of
+        tiles at a time, nearest the centre first. Each batch is drawn
+        as it's completed.
+
+        """
+        self._cancel_refinement()
+        if not self.doc or not self.get_window():
+            return False
+        if self.visualize_rendering or self._insensitive_state_content:
+            return False
+        alloc = self.get_allocation()
+        w, h = alloc.width, alloc.height
+        if w <= 0 or h <= 0:
+            return False
+
+        mipmap_level = self._get_mipmap_level()
+        transformation = self._get_render_transformation(mipmap_level)
+        translation_only = self.is_translation_only()
+        x1, y1, x2, y2 = self._get_view_model_rect(mipmap_level)
+
+        # Which tiles need rendering. The queue is popped from the end.
+        key = self._get_backing_store_key(mipmap_level)
+        view = self._backing_store.get_view(
+            x1, y1, x2 - x1 + 1, y2 - y1 + 1,
+            key=key,
+        )
+        clip_rect = helpers.Rect(0, 0, w, h)
+        tiles = [
+            (tx, ty) for (tx, ty) in view.get_tiles()
+            if self._tile_is_visible(
+                tx, ty,
+                transformation,
+                clip_rect,
+                translation_only,
+            )
+        ]
+        tiles = self._backing_store.get_invalid_tiles(tiles)
+        n = tiledsurface.N
+        cx = ((x1 + x2) / 2.0 / n) - 0.5
+        cy = ((y1 + y2) / 2.0 / n) - 0.5
+        tiles.sort(
+            key = lambda t: (t[0] - cx) ** 2 + (t[1] - cy) ** 2,
+            reverse = True,
+        )
+        logger.debug("refinement: %d tiles at level %d",
+                     len(tiles), mipmap_level)
+        if not tiles:
+            return True
+        self._refine_queue = tiles
+        self._refine_state = (view, mipmap_level, tuple(transformation))
+        self._refine_src_id = GLib.idle_add(self._refine_idle_cb)
+        return True
+
+    def _refine_idle_cb(self):
+        """Render and draw the next batch of refined tiles"""
+        view, mipmap_level, matrix = self._refine_state
+        store = self._backing_store
+        transformation = self._get_render_transformation(mipmap_level)
+        current = (
+            tuple(transformation) == matrix
+            and self._get_mipmap_level() == mipmap_level
+            and store.owns(view)
+        )
+        if not current:
+            logger.debug("refinement: superseded")
+            self._refine_src_id = None
+            self._cancel_refinement()
+            self.queue_draw()
+            return False
+
+        # Render a batch into the store, then draw it from there
+        queue = self._refine_queue
+        batch = store.get_invalid_tiles(queue[-self._REFINE_BATCH_TILES:])
+        del queue[-self._REFINE_BATCH_TILES:]
+        if batch:
+            self._render_tiles(view, batch, mipmap_level, self.display_filter)
+            store.set_valid(batch)
+            n = tiledsurface.N
+            tx0 = min(tx for (tx, ty) in batch)
+            ty0 = min(ty for (tx, ty) in batch)
+            tx1 = max(tx for (tx, ty) in batch) + 1
+            ty1 = max(ty for (tx, ty) in batch) + 1
+            corners = [
+                transformation.transform_point(tx * n, ty * n)
+                for tx in (tx0, tx1)
+                for ty in (ty0, ty1)
+            ]
+            self.queue_draw_area(*helpers.rotated_rectangle_bbox(corners))
+
+        if queue:
+            return True
+        logger.debug("refinement: done")
+        self._refine_src_id = None
+        self._cancel_refinement()
+        return False
+
+    ## Pre-rendering around the view
+
+    def _queue_prefetch(self):
+        """Start pre-rendering around the view, if it has moved
+
+        Tiles just outside the view are rendered into the layer stack's
+        render cache in idle time, so that panning or zooming onto them
+        is quick. The view's recent velocity decides how much further
+        to go in the direction it's moving, and whether a neighbouring
+        mipmap level is needed too. Painting cancels the work.
+
+        """
+        if not self.doc or self.visualize_rendering:
+            return
+        if self._insensitive_state_content:
+            return
+        if self.overlay_layer is not None:
+            return  # not cacheable
+        mipmap_level = self._get_mipmap_level()
+        transformation = self._get_render_transformation(mipmap_level)
+        view = (tuple(transformation), mipmap_level)
+        if view == self._prefetch_view:
+            return
+        self._prefetch_view = view
+        self._cancel_prefetch()
+
+        # Velocity, in model pixels and zoom steps per second
+        now = GLib.get_monotonic_time() / 1e6
+        cx, cy = self.get_center_model_coords()
+        sample = (now, cx, cy, log(self.scale, 2))
+        velocity = (0.0, 0.0, 0.0)
+        last = self._prefetch_sample
+        self._prefetch_sample = sample
+        if last is not None:
+            dt = now - last[0]
+            if 0 < dt < 4 * self._PREFETCH_LOOKAHEAD:
+                velocity = tuple(
+                    (b - a) / dt
+                    for (a, b) in zip(last[1:], sample[1:])
+                )
+
+        tiles = self._get_prefetch_tiles(mipmap_level, *velocity)
+        if not tiles:
+            return
+        self._prefetch_queue = tiles
+        self._prefetch_src_id = GLib.idle_add(
+            self._prefetch_idle_cb,
+            priority = GLib.PRIORITY_LOW,
+        )
+
+    def _get_prefetch_tiles(self, mipmap_level, vx, vy, vz):
+        """Tiles to pre-render around the view, in order
+
+        :param int mipmap_level: the view's mipmap level
+        :param float vx: X velocity, model pixels per second
+        :param float vy: Y velocity, model pixels per second
+        :param float vz: zoom velocity, log2(scale) per second
+        :returns: list of (tx, ty, level)
+
+        """
+        n = tiledsurface.N
+        x1, y1, x2, y2 = self._get_view_model_rect(mipmap_level)
+        tx0, ty0, tx1, ty1 = x1 // n, y1 // n, x2 // n, y2 // n
+
+        # The ring around the view, widened in the direction of travel
+        ahead = self._PREFETCH_LOOKAHEAD / (n * 2**mipmap_level)
+        limit = self._PREFETCH_MAX_AHEAD_TILES
+        dtx = helpers.clamp(vx * ahead, -limit, limit)
+        dty = helpers.clamp(vy * ahead, -limit, limit)
+        m = self._PREFETCH_MARGIN_TILES
+        rx0 = tx0 - m + min(0, int(floor(dtx)))
+        ry0 = ty0 - m + min(0, int(floor(dty)))
+        rx1 = tx1 + m + max(0, int(ceil(dtx)))
+        ry1 = ty1 + m + max(0, int(ceil(dty)))
+        cx = (tx0 + tx1) / 2.0 + dtx
+        cy = (ty0 + ty1) / 2.0 + dty
+        ring = [
+            (tx, ty, mipmap_level)
+            for ty in xrange(ry0, ry1 + 1)
+            for tx in xrange(rx0, rx1 + 1)
+            if not (tx0 <= tx <= tx1 and ty0 <= ty <= ty1)
+        ]
+        ring.sort(key=lambda t: (t[0] - cx) ** 2 + (t[1] - cy) ** 2)
+
+        # The whole view at the level the zoom is heading for
+        level = mipmap_level
+        if vz > 0:
+            level -= 1
+        elif vz < 0:
+            level += 1
+        if level == mipmap_level:
+            return ring[:self._PREFETCH_MAX_TILES]
+        if not (0 <= level <= tiledsurface.MAX_MIPMAP_LEVEL):
+            return ring[:self._PREFETCH_MAX_TILES]
+        f = 2.0 ** (mipmap_level - level)
+        ltx0, lty0 = int(floor(x1 * f / n)), int(floor(y1 * f / n))
+        ltx1, lty1 = int(floor(x2 * f / n)), int(floor(y2 * f / n))
+        lcx, lcy = (ltx0 + ltx1) / 2.0, (lty0 + lty1) / 2.0
+        zoom = [
+            (tx, ty, level)
+            for ty in xrange(lty0, lty1 + 1)
+            for tx in xrange(ltx0, ltx1 + 1)
+        ]
+        zoom.sort(key=lambda t: (t[0] - lcx) ** 2 + (t[1] - lcy) ** 2)
+        return (zoom + ring)[:self._PREFETCH_MAX_TILES]
+
+    def _prefetch_idle_cb(self):
+        """Pre-render the next batch of tiles around the view"""
+        queue = self._prefetch_queue
+        batch = queue[:self._PREFETCH_BATCH_TILES]
+        del queue[:self._PREFETCH_BATCH_TILES]
+        target = _PrefetchTarget()
+        for level in sorted(set(t[2] for t in batch)):
+            tiles = [(tx, ty) for (tx, ty, l) in batch if l == level]
+            self._render_tiles(target, tiles, level)
+        if queue:
+            return True
+        self._prefetch_src_id = None
+        return False
+
+    def _cancel_prefetch(self):
+        """Stop pre-rendering"""
+        if self._prefetch_src_id is not None:
+            GLib.source_remove(self._prefetch_src_id)
+            self._prefetch_src_id = None
+        self._prefetch_queue = []
+
+    def _cancel_refinement(self):
+        """Forget any refinement in progress"""
+        if self._refine_src_id is not None:
+            GLib.source_remove(self._refine_src_id)
+            self._refine_src_id = None
+        self._refine_queue = []
+        self._refine_state = None
+
+
+class _PrefetchTarget (lib.surface.TileAccessible):
+    """Throwaway 8bpc render target, for filling the render cache
+
+    The render cache keeps the tile arrays it's given, so each request
+    gets a new one.
+
+    """
+
+    def get_bbox(self):
+        return helpers.Rect()
+
+    @contextlib.contextmanager
+    def tile_request(self, tx, ty, readonly):
+        n = tiledsurface.N
+        yield np.zeros((n, n, 4), dtype='uint8')
+
+
+class _BackingStore (object):
+    """Rendered pixels kept between redraws of a CanvasRenderer
+
+    The store is a tile-aligned pixbuf in model coordinates, at the
+    mipmap level being displayed, together with the set of its tiles
+    which are still valid. When the view is only translated, most of
+    what's needed was already rendered for the previous frame. It gets
+    shifted into place, and only the newly exposed strips of tiles are
+    rendered. Tiles are invalidated when the model reports changes.
+
+    >>> class Surf (object):
+    ...     def __init__(self, x, y, w, h):
+    ...         self.ex, self.ey, self.ew, self.eh = x, y, w, h
+    ...         self.epixbuf = self
+    ...     def copy_area(self, *args):
+    ...         pass
+    >>> store = _BackingStore(Surf, view_class=lambda *a: None)
+    >>> N = tiledsurface.N
+    >>> store.get_view(N+1, 0, N, N, key=(0,))
+    >>> sorted(store.get_invalid_tiles([(1, 0), (2, 0)]))
+    [(1, 0), (2, 0)]
+    >>> store.set_valid([(1, 0), (2, 0)])
+    >>> store.get_invalid_tiles([(1, 0), (2, 0)])
+    []
+
+    Changes in the model invalidate tiles, at the store's level.
+
+    >>> store.invalidate_area(2*N, 0, 1, 1)
+    >>> store.get_invalid_tiles([(1, 0), (2, 0)])
+    [(2, 0)]
+
+    Views outside the store move it, keeping the tiles they share.
+
+    >>> store.set_valid([(2, 0)])
+    >>> store.get_view(2*N, 0, 2*N, N, key=(0,))
+    >>> store.get_invalid_tiles([(2, 0), (3, 0)])
+    [(3, 0)]
+
+    A change of key, e.g. the mipmap level, discards everything.
+
+    >>> store.get_view(2*N, 0, 2*N, N, key=(1,))
+    >>> store.get_invalid_tiles([(2, 0), (3, 0)])
+    [(2, 0), (3, 0)]
+
+    """
+
+    def __init__(self, surface_class=pixbufsurface.Surface,
+                 view_class=None):
+        super(_BackingStore, self).__init__()
+        self._surface_class = surface_class
+        self._view_class = view_class or _BackingStoreView
+        self._surface = None
+        self._key = None
+        self._level = 0
+        self._valid = set()
+
+    def clear(self):
+        """Forget all stored pixels"""
+        self._surface = None
+        self._key = None
+        self._valid = set()
+
+    def invalidate_area(self, x, y, w, h):
+        """Invalidate the tiles in an area of the model
+
+        :param x: left edge, in model coordinates
+        :param y: top edge, in model coordinates
+        :param w: width; zero or less means the whole model
+        :param h: height; zero or less means the whole model
+
+        """
+        if not self._valid:
+            return
+        if w <= 0 or h <= 0:
+            self._valid = set()
+            return
+        n = tiledsurface.N << self._level
+        tx0, ty0 = int(floor(x / n)), int(floor(y / n))
+        tx1, ty1 = int(floor((x + w - 1) / n)), int(floor((y + h - 1) / n))
+        self._valid = set(
+            (tx, ty) for (tx, ty) in self._valid
+            if not (tx0 <= tx <= tx1 and ty0 <= ty <= ty1)
+        )
+
+    def get_view(self, x, y, w, h, key):
+        """Get a target surface for rendering and painting an area
+
+        :param int x: left edge, in model coords at the mipmap level
+        :param int y: top edge, in model coords at the mipmap level
+        :param int w: width
+        :param int h: height
+        :param tuple key: the mipmap level, then anything else which
+            the rendered pixels depend on
+        :returns: a view of the area in the store
+        :rtype: _BackingStoreView
+
+        The store is moved to cover the area if it doesn't already,
+        keeping the tiles which it still covers.
+
+        """
+        if key != self._key:
+            self.clear()
+            self._key = key
+            self._level = key[0]
+        n = tiledsurface.N
+        ex0, ey0 = (x // n) * n, (y // n) * n
+        ex1 = ((x + w - 1) // n + 1) * n
+        ey1 = ((y + h - 1) // n + 1) * n
+        old = self._surface
+        covered = old is not None and (
+            old.ex <= ex0 and ex1 <= old.ex + old.ew
+            and old.ey <= ey0 and ey1 <= old.ey + old.eh
+        )
+        if not covered:
+            new = self._surface_class(ex0, ey0, ex1 - ex0, ey1 - ey0)
+            self._move(old, new)
+            self._surface = new
+        return self._view_class(self._surface, x, y, w, h)
+
+    def _move(self, old, new):
+        """Copy valid pixels from an old store surface to a new one"""
+        if old is None or not self._valid:
+            self._valid = set()
+            return
+        x0, y0 = max(old.ex, new.ex), max(old.ey, new.ey)
+        x1 = min(old.ex + old.ew, new.ex + new.ew)
+        y1 = min(old.ey + old.eh, new.ey + new.eh)
+        if x1 <= x0 or y1 <= y0:
+            self._valid = set()
+            return
+        old.epixbuf.copy_area(
+            x0 - old.ex, y0 - old.ey,
+            x1 - x0, y1 - y0,
+            new.epixbuf,
+            x0 - new.ex, y0 - new.ey,
+        )
+        n = tiledsurface.N
+        tx0, ty0, tx1, ty1 = x0 // n, y0 // n, x1 // n, y1 // n
+        self._valid = set(
+            (tx, ty) for (tx, ty) in self._valid
+            if (tx0 <= tx < tx1 and ty0 <= ty < ty1)
+        )
+
+    def owns(self, view):
+        """Whether a view is of the store as it currently is"""
+        return (self._surface is not None
+                and view.store_surface is self._surface)
+
+    def get_invalid_tiles(self, tiles):
+        """Filter a list of tiles, returning those needing a render"""
+        valid = self._valid
+        return [t for t in tiles if t not in valid]
+
+    def set_valid(self, tiles):
+        """Record that tiles have been rendered into the store"""
+        self._valid.update(tiles)
+
+
+class _BackingStoreView (lib.surface.TileAccessible):
+    """Part of a backing store, usable like a pixbufsurface.Surface"""
+
+    def __init__(self, store_surface, x, y, w, h):
+        super(_BackingStoreView, self).__init__()
+        self.store_surface = store_surface
+        self.x, self.y, self.w, self.h = x, y, w, h
+        self.pixbuf = store_surface.epixbuf.new_subpixbuf(
+            x - store_surface.ex, y - store_surface.ey,
+            w, h,
+        )
+        n = tiledsurface.N
+        store_tiles = store_surface.get_tiles()
+        self._tiles = dict(
+            ((tx, ty), store_tiles[(tx, ty)])
+            for ty in xrange(y // n, (y + h - 1) // n + 1)
+            for tx in xrange(x // n, (x + w - 1) // n + 1)
+        )
+
+    def get_tiles(self):
+        return self._tiles
+
+    def get_bbox(self):
+        return helpers.Rect(self.x, self.y, self.w, self.h)
+
+    @contextlib.contextmanager
+    def tile_request(self, tx, ty, readonly):
+        yield self._tiles[(tx, ty)]
+
 
 ## Testing
 
@@ -86,6 +86,7 @@ def default_configuration():
         'ui.toolbar_icon_size': 'large',
         'ui.dark_theme_variant': True,
         'ui.rendered_tile_cache_size': 16384,
+        'ui.render_workers': 0,  # 0 means one per CPU, up to a limit
         'saving.default_format': 'openraster',
         'brushmanager.selected_brush': None,
         'brushmanager.selected_groups': [],
@@ -94,6 +95,9 @@ def default_configuration():
 
         'document.autosave_backups': True,
         'document.autosave_interval': 10,
+        'document.lazy_loading': True,
+        'document.resident_tile_limit': 0,  # 0 keeps every tile in RAM
+        'document.packed_tile_limit': 8192,  # 0 never compresses tiles
 
         # configurable EOTF.  Set to 1.0 for legacy non-linear behaviour
         'display.colorspace_EOTF': DEFAULT_EOTF,
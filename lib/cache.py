@@ -9,9 +9,16 @@
 from __future__ import division, print_function
 
 from collections import OrderedDict
+import heapq
+import threading
+
+from lib.pycompat import xrange
 
 DEFAULT_CACHE_SIZE = 16384
 
+#: Default memory budget for a TileCache: 16384 8bpc RGBA tiles.
+DEFAULT_CACHE_BYTES = DEFAULT_CACHE_SIZE * 64 * 64 * 4
+
 
 class LRUCache (object):
     """Least-recently-used cache with dict-like usage"""
@@ -85,3 +92,350 @@ class LRUCache (object):
             while len(self._cache) >= self._capacity:
                 self._cache.popitem(last=False)
         self._cache[key] = item
+
+
+## Byte-budgeted tile cache
+
+#: Number of independently locked shards in a TileCache.
+DEFAULT_CACHE_SHARDS = 8
+
+
+class _TileCacheShard (object):
+    """One independently locked part of a TileCache.
+
+    Entries are stored per mipmap level, then per tile position,
+    then per variant key: {level: {(tx, ty): {key2: entry}}}.
+    Each entry is a list [item, nbytes, priority, seq].
+
+    Eviction uses the GreedyDual-Size algorithm. Each entry's priority
+    is the shard's current "inflation" value plus the entry's weight,
+    and the weight grows with mipmap level and shrinks with size.
+    The lowest priority entry is evicted first, and its priority
+    becomes the new inflation value, so entries which have not been
+    used for a while gradually age out relative to fresh ones.
+
+    """
+
+    def __init__(self, capacity):
+        super(_TileCacheShard, self).__init__()
+        self.lock = threading.Lock()
+        self.capacity = capacity
+        self.nbytes = 0
+        self.nentries = 0
+        self.levels = {}
+        self.heap = []
+        self.inflation = 0.0
+        self.seq = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _weight(level, nbytes):
+        return (1.0 + level) / max(1, nbytes)
+
+    def _touch(self, key1, key2, entry):
+        self.seq += 1
+        entry[2] = self.inflation + self._weight(key1[2], entry[1])
+        entry[3] = self.seq
+        heapq.heappush(self.heap, (entry[2], entry[3], key1, key2))
+        if len(self.heap) > 4 * self.nentries + 64:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        heap = []
+        for level, tiles in self.levels.items():
+            for txy, variants in tiles.items():
+                key1 = (txy[0], txy[1], level)
+                for key2, entry in variants.items():
+                    heap.append((entry[2], entry[3], key1, key2))
+        heapq.heapify(heap)
+        self.heap = heap
+
+    def get(self, key1, key2):
+        tx, ty, level = key1
+        try:
+            entry = self.levels[level][(tx, ty)][key2]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(key1, key2, entry)
+        return entry
+
+    def set(self, key1, key2, item, nbytes):
+        tx, ty, level = key1
+        variants = self.levels.setdefault(level, {}).setdefault((tx, ty), {})
+        entry = variants.get(key2)
+        if entry is None:
+            entry = [item, nbytes, 0.0, 0]
+            variants[key2] = entry
+            self.nentries += 1
+        else:
+            self.nbytes -= entry[1]
+            entry[0] = item
+            entry[1] = nbytes
+        self.nbytes += nbytes
+        self._touch(key1, key2, entry)
+        while self.nbytes > self.capacity and self.nentries > 0:
+            self._evict_one()
+
+    def _evict_one(self):
+        while self.heap:
+            prio, seq, key1, key2 = heapq.heappop(self.heap)
+            tx, ty, level = key1
+            variants = self.levels.get(level, {}).get((tx, ty))
+            if not variants:
+                continue
+            entry = variants.get(key2)
+            if entry is None or entry[3] != seq:
+                continue  # stale heap record
+            self.inflation = prio
+            self._remove(level, (tx, ty), key2)
+            self.evictions += 1
+            return
+
+    def _remove(self, level, txy, key2=None):
+        """Removes one variant, or all variants at a position."""
+        tiles = self.levels[level]
+        variants = tiles[txy]
+        if key2 is None:
+            removed = list(variants.values())
+            variants.clear()
+        else:
+            removed = [variants.pop(key2)]
+        for entry in removed:
+            self.nbytes -= entry[1]
+            self.nentries -= 1
+        if not variants:
+            del tiles[txy]
+            if not tiles:
+                del self.levels[level]
+        return len(removed)
+
+    def invalidate_area(self, tx_min, ty_min, tx_max, ty_max, key2=None):
+        for level in list(self.levels.keys()):
+            tiles = self.levels[level]
+            x0 = tx_min >> level
+            y0 = ty_min >> level
+            x1 = tx_max >> level
+            y1 = ty_max >> level
+            area = (x1 - x0 + 1) * (y1 - y0 + 1)
+            if area <= len(tiles):
+                doomed = [
+                    (tx, ty)
+                    for tx in xrange(x0, x1 + 1)
+                    for ty in xrange(y0, y1 + 1)
+                    if (tx, ty) in tiles
+                ]
+            else:
+                doomed = [
+                    (tx, ty) for (tx, ty) in tiles
+                    if (x0 <= tx <= x1) and (y0 <= ty <= y1)
+                ]
+            for txy in doomed:
+                if key2 is None:
+                    self.invalidations += self._remove(level, txy)
+                elif key2 in tiles[txy]:
+                    self.invalidations += self._remove(level, txy, key2)
+
+    def clear(self):
+        self.levels.clear()
+        del self.heap[:]
+        self.nbytes = 0
+        self.nentries = 0
+        self.inflation = 0.0
+
+
+class TileCache (object):
+    """Sharded, thread-safe tile cache with a memory budget in bytes.
+
+    Keys are split into a tile address, key1=(tx, ty, mipmap_level),
+    and a variant key2 which distinguishes different renderings of the
+    same tile. Capacity is measured in bytes, not entries.
+
+    >>> import numpy as np
+    >>> tile = np.zeros((64, 64, 4), dtype="uint8")
+    >>> cache = TileCache(capacity=4 * tile.nbytes, shards=1)
+    >>> cache.set((0, 0, 0), "a", tile)
+    >>> cache.get((0, 0, 0), "a") is tile
+    True
+    >>> cache.get((0, 0, 0), "b") is None
+    True
+    >>> cache.nbytes == tile.nbytes
+    True
+
+    When the budget is exceeded, entries are evicted. Entries which are
+    cheap to rebuild are evicted first: level 0 before deeper mipmap
+    levels, and then least recently used first.
+
+    >>> cache.set((0, 0, 3), "a", tile.copy())
+    >>> for tx in range(1, 4):
+    ...     cache.set((tx, 0, 0), "a", tile.copy())
+    >>> len(cache)
+    4
+    >>> cache.get((0, 0, 3), "a") is not None
+    True
+    >>> cache.get((0, 0, 0), "a") is None
+    True
+    >>> stats = cache.stats()
+    >>> (stats["hits"], stats["misses"], stats["evictions"])
+    (2, 2, 1)
+
+    Invalidation works on a range of level 0 tile coordinates,
+    and removes the corresponding tiles at every mipmap level.
+
+    >>> cache.invalidate_area(2, 0, 5, 5)
+    >>> sorted(k for k, v in cache.keys())
+    [(1, 0, 0)]
+    >>> cache.stats()["invalidations"]
+    3
+
+    """
+
+    def __init__(self, capacity=DEFAULT_CACHE_BYTES,
+                 shards=DEFAULT_CACHE_SHARDS):
+        """Initialize, with a memory budget.
+
+        :param int capacity: the budget, in bytes
+        :param int shards: number of independently locked parts
+
+        """
+        super(TileCache, self).__init__()
+        shards = max(1, int(shards))
+        capacity = max(0, int(capacity))
+        self._capacity = capacity
+        self._shards = [
+            _TileCacheShard(capacity // shards)
+            for i in xrange(shards)
+        ]
+
+    def __repr__(self):
+        stats = self.stats()
+        accesses = stats["hits"] + stats["misses"]
+        hitrate = 1.0
+        if accesses > 0:
+            hitrate = stats["hits"] / accesses
+        return "<TileCache %d entries, %.1f/%.1f MiB, h: %.0f%%>" % (
+            stats["entries"],
+            stats["nbytes"] / (1 << 20),
+            stats["capacity"] / (1 << 20),
+            hitrate * 100,
+        )
+
+    def _shard(self, key1):
+        return self._shards[hash(key1) % len(self._shards)]
+
+    @property
+    def capacity(self):
+        """The memory budget, in bytes (read-only)."""
+        return self._capacity
+
+    @property
+    def nbytes(self):
+        """Total size of the cached items, in bytes."""
+        return sum(s.nbytes for s in self._shards)
+
+    def __len__(self):
+        return sum(s.nentries for s in self._shards)
+
+    def keys(self):
+        """Returns a list of (key1, key2) pairs for all entries."""
+        result = []
+        for shard in self._shards:
+            with shard.lock:
+                for level, tiles in shard.levels.items():
+                    for (tx, ty), variants in tiles.items():
+                        for key2 in variants:
+                            result.append(((tx, ty, level), key2))
+        return result
+
+    def get(self, key1, key2, default=None):
+        """Gets a cached item, or returns a default."""
+        shard = self._shard(key1)
+        with shard.lock:
+            entry = shard.get(key1, key2)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def set(self, key1, key2, item, nbytes=None):
+        """Stores an item, evicting others if needed.
+
+        :param tuple key1: tile address, (tx, ty, mipmap_level)
+        :param key2: variant key (hashable)
+        :param item: the item to store
+        :param int nbytes: item size (default: item.nbytes)
+
+        """
+        if nbytes is None:
+            nbytes = item.nbytes
+        shard = self._shard(key1)
+        with shard.lock:
+            shard.set(key1, key2, item, nbytes)
+
+    def invalidate_area(self, tx_min, ty_min, tx_max, ty_max, key2=None):
+        """Removes all tiles in a range, at all mipmap levels.
+
+        :param int tx_min: Leftmost level 0 tile column (inclusive)
+        :param int ty_min: Topmost level 0 tile row (inclusive)
+        :param int tx_max: Rightmost level 0 tile column (inclusive)
+        :param int ty_max: Bottom level 0 tile row (inclusive)
+        :param key2: Only remove this variant (default: all variants)
+
+        >>> cache = TileCache(capacity=1000, shards=2)
+        >>> cache.set((0, 0, 0), "a", None, nbytes=10)
+        >>> cache.set((0, 0, 0), "b", None, nbytes=10)
+        >>> cache.invalidate_area(0, 0, 0, 0, key2="b")
+        >>> cache.keys()
+        [((0, 0, 0), 'a')]
+
+        """
+        for shard in self._shards:
+            with shard.lock:
+                shard.invalidate_area(tx_min, ty_min, tx_max, ty_max, key2)
+
+    def clear(self):
+        """Removes all entries. The stats counters are not reset."""
+        for shard in self._shards:
+            with shard.lock:
+                shard.clear()
+
+    def stats(self):
+        """Returns a dict of counters, for testing and debugging.
+
+        :rtype: dict
+
+        The keys are: "hits", "misses", "evictions", "invalidations",
+        "entries", "nbytes", and "capacity".
+
+        """
+        result = dict(
+            hits=0, misses=0, evictions=0, invalidations=0,
+            entries=0, nbytes=0,
+        )
+        for shard in self._shards:
+            with shard.lock:
+                result["hits"] += shard.hits
+                result["misses"] += shard.misses
+                result["evictions"] += shard.evictions
+                result["invalidations"] += shard.invalidations
+                result["entries"] += shard.nentries
+                result["nbytes"] += shard.nbytes
+        result["capacity"] = self._capacity
+        return result
+
+    def reset_stats(self):
+        """Zeroes the hit, miss, eviction, and invalidation counters."""
+        for shard in self._shards:
+            with shard.lock:
+                shard.hits = 0
+                shard.misses = 0
+                shard.evictions = 0
+                shard.invalidations = 0
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -18,6 +18,8 @@ from gettext import gettext as _
 from logging import getLogger
 
 import lib.layer
+import lib.layer.core
+import lib.tiledsurface
 from . import helpers
 from lib.observable import event
 import lib.stroke
@@ -146,12 +148,56 @@ class CommandStack (object):
         self.stack_updated()  # the display_name may have changed
         return cmd
 
+    def get_memory_usage(self):
+        """Measures the tile memory held by the undo and redo stacks
+
+        :returns: see lib.tiledsurface.get_tiles_memory_usage()
+        :rtype: dict
+
+        This counts the tiles of every surface snapshot the commands
+        hold, directly or inside layer snapshots. Tiles shared with the
+        working document or between snapshots are counted once. Layers
+        kept whole by some commands (e.g. removed ones) are not counted.
+
+        """
+        tiles = []
+        for sshot in _iter_surface_snapshots(self.undo_stack
+                                             + self.redo_stack):
+            tiles.extend(sshot.tiledict.values())
+        return lib.tiledsurface.get_tiles_memory_usage(tiles)
+
     @event
     def stack_updated(self):
         """Event: command stack was updated"""
         pass
 
 
+def _iter_surface_snapshots(objs, _seen=None):
+    """Finds the surface snapshots held by commands or layer snapshots
+
+    Only commands, layer snapshots and plain containers are searched,
+    so this never wanders off into the live document.
+
+    """
+    if _seen is None:
+        _seen = set()
+    for obj in objs:
+        if id(obj) in _seen:
+            continue
+        _seen.add(id(obj))
+        if isinstance(obj, lib.tiledsurface._SurfaceSnapshot):
+            yield obj
+        elif isinstance(obj, (list, tuple)):
+            for sshot in _iter_surface_snapshots(obj, _seen):
+                yield sshot
+        elif isinstance(obj, dict):
+            for sshot in _iter_surface_snapshots(obj.values(), _seen):
+                yield sshot
+        elif isinstance(obj, (Command, lib.layer.core.LayerBaseSnapshot)):
+            for sshot in _iter_surface_snapshots(vars(obj).values(), _seen):
+                yield sshot
+
+
 class Command (object):
     """A reversible change to the document model
 
@@ -17,12 +17,17 @@ import sys
 import zipfile
 import tempfile
 import time
-from os.path import join
+import struct
+import threading
+import functools
+import weakref
+import collections
 import xml.etree.ElementTree as ET
 from warnings import warn
 import shutil
 from datetime import datetime
 from collections import namedtuple
+from io import BytesIO
 import json
 import logging
 from lib.fileutils import safename
@@ -50,6 +55,8 @@ import lib.xml
 import lib.glib
 import lib.feedback
 import lib.layervis
+import lib.orawriter
+import lib.tilestore
 from lib.pycompat import unicode
 
 logger = logging.getLogger(__name__)
@@ -66,6 +73,7 @@ CACHE_DOC_SUBDIR_PREFIX = u"doc."
 CACHE_DOC_AUTOSAVE_SUBDIR = u"autosave"
 CACHE_ACTIVITY_FILE = u"active"
 CACHE_UPDATE_INTERVAL = 10  # seconds
+CACHE_TILE_STORE_FILE = u"tiles.dat"
 
 # Logging and error reporting strings
 _LOAD_FAILED_COMMON_TEMPLATE_LINE = C_(
@@ -275,13 +283,19 @@ class Document (object):
     ## Initialization and cleanup
 
     def __init__(self, brushinfo=None, painting_only=False,
-                 cache_dir=None, cache_size=DEFAULT_CACHE_SIZE):
+                 cache_dir=None, cache_size=DEFAULT_CACHE_SIZE,
+                 render_workers=1, lazy_loading=False,
+                 resident_tile_limit=0, packed_tile_limit=0):
         """Initialize
 
         :param brushinfo: the lib.brush.BrushInfo instance to use
         :param painting_only: only use painting layers
         :param cache_dir: use an existing cache dir
-        :param cache_size: size of the layer render cache
+        :param cache_size: render cache budget, in 8bpc tiles' worth
+        :param render_workers: render threads to use (0 means automatic)
+        :param lazy_loading: default for load_ora()'s "lazy" param
+        :param resident_tile_limit: read-only tiles kept in RAM (0: all)
+        :param packed_tile_limit: read-only tiles kept unpacked (0: all)
 
         If painting_only is true, then no tempdir will be created by the
         document when it is initialized or cleared.
@@ -291,12 +305,26 @@ class Document (object):
         this is set; it's assumed that you're importing into a parent
         document.
 
+        If resident_tile_limit is nonzero and the document manages its
+        own cache dir, read-only tiles beyond that number are moved out
+        to a memory-mapped file in the cache dir, least recently used
+        first. Otherwise, if packed_tile_limit is nonzero, read-only
+        tiles beyond that number are compressed in RAM instead. Layers
+        are snapshotted at every stroke, so this covers the tiles of
+        every layer, and not just those only used by the undo history.
+        Evicted tiles are brought back when they're next read.
+        See lib.tilestore.
+
         """
         object.__init__(self)
         if not brushinfo:
             brushinfo = brush.BrushInfo()
             brushinfo.load_defaults()
-        self._layers = layer.RootLayerStack(self, cache_size=cache_size)
+        self._layers = layer.RootLayerStack(
+            self,
+            cache_size=cache_size,
+            render_workers=render_workers,
+        )
         self._layers.layer_content_changed += self._canvas_modified_cb
         self.brush = brush.Brush(brushinfo)
         self.brush.brushinfo.observers.append(self.brushsettings_changed_cb)
@@ -321,6 +349,9 @@ class Document (object):
         else:
             self._owns_cache_dir = True
         self._cache_updater_id = None
+        self._resident_tile_limit = max(0, int(resident_tile_limit))
+        self._packed_tile_limit = max(0, int(packed_tile_limit))
+        self._tile_store = None
         self._autosave_backups = False
         self.autosave_interval = 10
         self._autosave_processor = None
@@ -344,8 +375,16 @@ class Document (object):
         #: Sets of layer-views, identified by name.
         self._layer_view_manager = lib.layervis.LayerViewManager(self)
 
+        # Lazy loading of OpenRaster layer data
+        self.lazy_loading = bool(lazy_loading)
+        self._lazy_loader = None
+        self._lazy_load_processor = lib.idletask.Processor()
+        self.sync_pending_changes += self._lazy_load_sync_pending_changes_cb
+
         # And begin in a known state
         self.clear()
+        if self._tile_store is None:
+            self._start_tile_store()
 
     def __repr__(self):
         bbox = self.get_bbox()
@@ -402,6 +441,47 @@ class Document (object):
                 "its containing cache subfolder is active.\n"
             )
         self._start_cache_updater()
+        self._start_tile_store()
+
+    def _start_tile_store(self):
+        """Internal: starts moving cold read-only tiles out of the way."""
+        self._stop_tile_store()
+        if self._resident_tile_limit and self._cache_dir is not None:
+            store_path = os.path.join(self._cache_dir, CACHE_TILE_STORE_FILE)
+            store = lib.tilestore.TileStore(
+                store_path,
+                resident_limit=self._resident_tile_limit,
+            )
+        elif self._packed_tile_limit:
+            store = lib.tilestore.PackedTileStore(
+                resident_limit=self._packed_tile_limit,
+            )
+        else:
+            return
+        self._tile_store = store
+        tiledsurface.set_tile_store(store)
+        logger.debug("Started tile store %r", store)
+
+    def _stop_tile_store(self):
+        """Internal: stops spilling tiles. Spilled ones stay readable."""
+        store = self._tile_store
+        if store is None:
+            return
+        self._tile_store = None
+        if tiledsurface.get_tile_store() is store:
+            tiledsurface.set_tile_store(None)
+        store.close()
+
+    def get_tile_store_stats(self):
+        """Get the tile store's counters, or None if it's not in use
+
+        :returns: see the stats() method of lib.tilestore's stores
+        :rtype: dict
+
+        """
+        if self._tile_store is None:
+            return None
+        return self._tile_store.stats()
 
     def _cleanup_cache_dir(self):
         """Internal: recursively delete the working-document cache_dir if OK.
@@ -415,6 +495,7 @@ class Document (object):
             return
         self._stop_cache_updater()
         self._stop_autosave_writes()
+        self._stop_tile_store()
         shutil.rmtree(self._cache_dir, ignore_errors=True)
         if os.path.exists(self._cache_dir):
             logger.error(
@@ -434,7 +515,9 @@ class Document (object):
         This method is called by the main app's exit routine
         after confirmation.
         """
+        self._lazy_load_stop()
         self._cleanup_cache_dir()
+        self._stop_tile_store()
 
     ## Document-specific settings dict.
 
@@ -604,6 +687,15 @@ class Document (object):
             logger.warning("autosave start abandoned: _cache_dir not set")
             # sometimes happens on exit
             return
+        # Layers still loading lazily could fail too. Find out now.
+        self.finish_lazy_loading()
+        failed = self._get_failed_lazy_load_layers()
+        if failed:
+            logger.warning(
+                "autosave abandoned: data failed to load for %r",
+                failed,
+            )
+            return
         logger.debug("autosave starting: queueing save tasks")
         assert not self._painting_only
         assert not self._autosave_processor.has_work()
@@ -925,6 +1017,7 @@ class Document (object):
         and resets the frame, the stored resolution,
         and the document-specific settings.
         """
+        self._lazy_load_stop()
         self.sync_pending_changes()
         self.layer_view_manager.clear()
         self._layers.set_symmetry_state(
@@ -1137,6 +1230,53 @@ class Document (object):
         """
         self._settings.sync_pending_changes(flush=flush, **kwargs)
 
+    ## Lazy loading
+
+    def _lazy_load_sync_pending_changes_cb(self, doc, flush=True, **kwargs):
+        """Finish any lazy loading when the doc is flushed (e.g. saves)"""
+        if flush:
+            self.finish_lazy_loading()
+
+    def finish_lazy_loading(self):
+        """Loads any layer data which is still being lazy-loaded"""
+        loader = self._lazy_loader
+        if loader is None:
+            return
+        loader.finish_all()
+        self._lazy_load_stop()
+
+    def _lazy_load_stop(self):
+        """Abandons any lazy loading, dropping the preview"""
+        self._lazy_load_processor.stop()
+        loader = self._lazy_loader
+        self._lazy_loader = None
+        if loader is not None:
+            loader.close()
+        self._layers.lazy_preview = None
+
+    def _get_failed_lazy_load_layers(self):
+        """Returns the layers whose lazily loaded data failed to load
+
+        These layers are empty, so saving them would overwrite the
+        user's original data with nothing.
+
+        """
+        return [
+            l for l in self.layer_stack.deepiter()
+            if isinstance(l, layer.SurfaceBackedLayer)
+            and l.load_error is not None
+        ]
+
+    def _lazy_load_idle_cb(self):
+        """Loads one layer in the background. Idle callback."""
+        loader = self._lazy_loader
+        if loader is None:
+            return False
+        if loader.load_next():
+            return True
+        self._lazy_load_stop()
+        return False
+
     def undo(self):
         """Undo the most recently done command"""
         self.sync_pending_changes()
@@ -1431,6 +1571,23 @@ class Document (object):
         ``save_*()`` method is chosen to perform the save.
         """
         self.sync_pending_changes(flush=True)
+        failed = self._get_failed_lazy_load_layers()
+        if failed:
+            logger.error(
+                "Not writing %r: data failed to load for %r",
+                filename, failed,
+            )
+            hint_tmpl = C_(
+                "Document IO: hint templates for user-facing exceptions",
+                u'Unable to write “{filename}”: '
+                u'the data for {layers} failed to load, '
+                u'so saving would lose it.\n'
+                u'Delete those layers, or reload the file.'
+            )
+            raise FileHandlingError(hint_tmpl.format(
+                filename = filename,
+                layers = u", ".join(u"“%s”" % (l.name,) for l in failed),
+            ))
         junk, ext = os.path.splitext(filename)
         ext = ext.lower().replace('.', '')
         save = getattr(self, 'save_' + ext, self._unsupported)
@@ -1799,11 +1956,35 @@ class Document (object):
         cb = kwargs.get('incompatible_ora_cb', ignore)
         return cb(compat_type, prerel, filename, target_version)
 
-    def load_ora(self, filename, progress=None, **kwargs):
-        """Loads from an OpenRaster file"""
+    def load_ora(self, filename, progress=None, lazy=None, **kwargs):
+        """Loads from an OpenRaster file
+
+        :param unicode filename: the file to load
+        :param progress: Unsized UI feedback object
+        :type progress: lib.feedback.Progress or None
+        :param bool lazy: defer decoding layers (None: use lazy_loading)
+        :param \*\*kwargs: passed to the layers stack's loader
+
+        In lazy mode, layer PNGs are decoded the first time their tiles
+        are needed, or by a low priority background task. Until all
+        have loaded, the document view shows mergedimage.png instead.
+
+        >>> doc = Document()
+        >>> doc.load_ora("tests/fill_outlines.ora", lazy=True)
+        True
+        >>> doc.layer_stack.lazy_preview is not None
+        True
+        >>> doc.finish_lazy_loading()
+        >>> doc.layer_stack.lazy_preview is None
+        True
+        >>> doc.cleanup()
+
+        """
         logger.info('load_ora: %r', filename)
         t0 = time.time()
         self.clear()
+        if lazy is None:
+            lazy = self.lazy_loading
         cache_dir = self._cache_dir
         orazip = zipfile.ZipFile(filename)
         logger.debug('mimetype: %r', orazip.read('mimetype').strip())
@@ -1825,6 +2006,12 @@ class Document (object):
         if 'compat_handler' in kwargs:
             kwargs['compat_handler'](eotf, root_stack_elem)
 
+        # Defer decoding of the layers' image data if requested
+        lazy_loader = None
+        if lazy:
+            lazy_loader = _LazyOraLoader(filename)
+            kwargs["lazy_loader"] = lazy_loader
+
         # Delegate loading of image data to the layers tree itself
         self.layer_stack.load_from_openraster(
             orazip,
@@ -1878,6 +2065,15 @@ class Document (object):
                 )
             self._settings.update(new_settings)
 
+        # Show the flattened image until the deferred layers are loaded
+        if lazy_loader is not None:
+            if lazy_loader.has_pending():
+                self._lazy_loader = lazy_loader
+                self._layers.lazy_preview = lazy_loader.load_preview()
+                self._lazy_load_processor.add_work(self._lazy_load_idle_cb)
+            else:
+                lazy_loader.close()
+
         orazip.close()
 
         logger.info('%.3fs load_ora total', time.time() - t0)
@@ -1923,6 +2119,7 @@ class Document (object):
             )
         else:
             self._cache_dir = doc_cache_dir
+            self._start_tile_store()
 
     def _load_from_openraster_dir(self, oradir, cache_dir,
                                   progress=None,
@@ -2013,6 +2210,7 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
                                frame_active=False,
                                progress=None,
                                settings=None,
+                               save_workers=None,
                                **kwargs):
     """Save a root layer stack to a new OpenRaster zipfile
 
@@ -2024,10 +2222,15 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
     :param frame_active: True if the frame is enabled
     :param progress: Unsized UI feedback object
     :type progress: lib.feedback.Progress or None
+    :param dict settings: document settings to save as JSON
+    :param int save_workers: PNG encoder threads (None or 0: automatic)
     :param \*\*kwargs: Passed through to root_stack.save_to_openraster()
     :rtype: GdkPixbuf
     :returns: Thumbnail preview image (256x256 max) of what was saved
 
+    Layer PNGs and the merged image are encoded concurrently, but the
+    zipfile's members are written in the same order as they're queued.
+
     >>> from gi.repository import GdkPixbuf
     >>> from lib.layer.test import make_test_stack
     >>> root, leaves = make_test_stack()
@@ -2054,11 +2257,42 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
     if not isinstance(tempdir, unicode):
         tempdir = tempdir.decode(sys.getfilesystemencoding())
 
-    orazip = zipfile.ZipFile(
-        filename, 'w',
-        compression=zipfile.ZIP_STORED,
+    orazip = lib.orawriter.OrderedZipWriter(
+        zipfile.ZipFile(
+            filename, 'w',
+            compression=zipfile.ZIP_STORED,
+        ),
+        num_workers=save_workers,
     )
+    try:
+        try:
+            thumbnail = _save_layers_to_orazip_members(
+                orazip, root_stack, bbox,
+                xres, yres, frame_active, settings,
+                progress, tempdir, **kwargs
+            )
+        except Exception:
+            orazip.abort()
+            raise
+        # The bulk of the work: finish encoding, and stream into the zip.
+        orazip.close(progress=progress.open(90))
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+    progress.close()
+    return thumbnail
 
+
+def _save_layers_to_orazip_members(orazip, root_stack, bbox,
+                                   xres, yres, frame_active, settings,
+                                   progress, tempdir, **kwargs):
+    """Queue up all the members of a new OpenRaster file (internal)
+
+    See _save_layers_to_new_orazip() for the params. The progress
+    object is sized, and this uses 10 items of it. Returns the
+    thumbnail.
+
+    """
     # The mimetype entry must be first
     helpers.zipfile_writestr(orazip, 'mimetype', lib.xml.OPENRASTER_MEDIA_TYPE)
 
@@ -2071,7 +2305,7 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
         data_bbox.expandToIncludeRect(s_layer.get_bbox())
     data_bbox = tuple(data_bbox)
 
-    # First 90%: save the layer stack
+    # Queue the layer stack. Encoding runs in the background.
     image = ET.Element('image')
     if bbox is None:
         bbox = data_bbox
@@ -2083,7 +2317,7 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
     root_stack_elem = root_stack.save_to_openraster(
         orazip, tempdir, root_stack_path,
         data_bbox, bbox,
-        progress=progress.open(90),
+        progress=progress.open(5),
         **kwargs
     )
     image.append(root_stack_elem)
@@ -2116,27 +2350,29 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
     # OpenRaster version declaration
     image.attrib["version"] = lib.xml.OPENRASTER_VERSION
 
-    # Last 10%: previews.
-    # Thumbnail preview (256x256)
+    # Previews.
+    # Thumbnail preview (256x256), rendered while the layers encode.
     thumbnail = root_stack.render_thumbnail(
         bbox,
-        progress=progress.open(1),
+        progress=progress.open(5),
+    )
+    thumbnail_png = BytesIO()
+    lib.pixbuf.save(thumbnail, thumbnail_png, 'png')
+    helpers.zipfile_writestr(
+        orazip, 'Thumbnails/thumbnail.png',
+        thumbnail_png.getvalue(),
     )
-    tmpfile = join(tempdir, 'tmp.png')
-    lib.pixbuf.save(thumbnail, tmpfile, 'png')
-    orazip.write(tmpfile, 'Thumbnails/thumbnail.png')
-    os.remove(tmpfile)
 
     # Save fully rendered image too
-    tmpfile = os.path.join(tempdir, "mergedimage.png")
-    root_stack.save_as_png(
-        tmpfile, *bbox,
-        alpha=False, background=True,
-        progress=progress.open(9),
-        **kwargs
-    )
-    orazip.write(tmpfile, 'mergedimage.png')
-    os.remove(tmpfile)
+    def _write_mergedimage(fp):
+        root_stack.render_layer_to_png_file(
+            root_stack, fp,
+            bbox=bbox,
+            alpha=False, background=True,
+            **kwargs
+        )
+
+    orazip.submit('mergedimage.png', _write_mergedimage)
 
     # Prettification
     lib.xml.indent_etree(image)
@@ -2144,13 +2380,125 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None,
 
     # Finalize
     helpers.zipfile_writestr(orazip, 'stack.xml', xml)
-    orazip.close()
-    os.rmdir(tempdir)
-
-    progress.close()
     return thumbnail
 
 
+class _LazyOraLoader (object):
+    """Deferred decoding of the layer PNGs in an OpenRaster file
+
+    The layer loading code hands surfaces to defer(), which makes them
+    load on first access. The pending surfaces can also be loaded one at
+    a time, in stack order, with load_next(). This keeps its own open
+    handle on the zipfile until close() is called.
+
+    """
+
+    def __init__(self, filename):
+        super(_LazyOraLoader, self).__init__()
+        self._filename = filename
+        self._zip = zipfile.ZipFile(filename)
+        self._zip_lock = threading.Lock()
+        self._pending = collections.deque()  # [weakref to surface]
+
+    def __repr__(self):
+        return "<_LazyOraLoader %r pending=%d>" % (
+            self._filename,
+            len(self._pending),
+        )
+
+    def defer(self, surface, src, x, y):
+        """Arranges for a zipfile member to be loaded into a surface later
+
+        :param lib.tiledsurface.MyPaintSurface surface: empty surface
+        :param unicode src: zipfile member name (a PNG file)
+        :param int x: X coordinate to load the PNG at
+        :param int y: Y coordinate to load the PNG at
+        :returns: True if the load was deferred, false to load it now.
+
+        """
+        size = self._read_png_size(src)
+        if size is None:
+            return False
+        w, h = size
+        load = functools.partial(self._load_surface, src, x, y)
+        surface.set_pending_load(load, (x, y, w, h))
+        self._pending.append(weakref.ref(surface))
+        return True
+
+    def has_pending(self):
+        """True if there are deferred surfaces still to load"""
+        for surface_ref in self._pending:
+            surface = surface_ref()
+            if surface is not None and surface.has_pending_load:
+                return True
+        return False
+
+    def load_next(self):
+        """Loads the next pending surface. Returns True if more remain."""
+        while self._pending:
+            surface = self._pending.popleft()()
+            if surface is None or not surface.has_pending_load:
+                continue
+            try:
+                surface.finish_pending_load()
+            except Exception:
+                pass  # logged, and kept in the surface's load_error
+            break
+        return bool(self._pending)
+
+    def finish_all(self):
+        """Loads all remaining pending surfaces"""
+        while self.load_next():
+            pass
+
+    def load_preview(self):
+        """Loads the file's flattened image, mergedimage.png, if present
+
+        :returns: a surface with the flattened image, or None
+        :rtype: lib.tiledsurface.MyPaintSurface
+
+        """
+        if self._read_png_size("mergedimage.png") is None:
+            return None
+        try:
+            return self._load_surface("mergedimage.png", 0, 0)
+        except Exception:
+            logger.exception("Failed to load mergedimage.png preview")
+            return None
+
+    def close(self):
+        """Closes the zipfile. Pending surfaces stay empty after this."""
+        with self._zip_lock:
+            self._zip.close()
+        self._pending.clear()
+
+    def _read_png_size(self, src):
+        """Reads a PNG member's size from its header, or None"""
+        try:
+            with self._zip_lock:
+                with self._zip.open(src, mode='r') as fp:
+                    header = fp.read(24)
+        except Exception:
+            logger.debug("Cannot lazy-load %r: not readable", src)
+            return None
+        if len(header) < 24 or header[12:16] != b"IHDR":
+            logger.debug("Cannot lazy-load %r: not a PNG file", src)
+            return None
+        return struct.unpack(">II", header[16:24])
+
+    def _load_surface(self, src, x, y):
+        """Decodes a PNG member into a new surface (any thread)"""
+        with self._zip_lock:
+            pixbuf = lib.pixbuf.load_from_zipfile(
+                datazip=self._zip,
+                filename=src,
+            )
+        arr = helpers.gdkpixbuf2numpy(pixbuf)
+        surface = tiledsurface.Surface()
+        surface.load_from_numpy(arr, x, y)
+        return surface
+
+
 def get_app_cache_root():
     """Get the app-specific cache root dir, creating it if needed.
 
@@ -41,6 +41,15 @@ static void
 png_write_error_callback (png_structp png_save_ptr,
                           png_const_charp error_msg)
 {
+    // The error pointer, if set, is the writer's saved thread state.
+    // It's non-NULL while rows are being compressed without the GIL,
+    // so take the GIL back before touching the Python error state.
+    PyThreadState **saved_tstate =
+        (PyThreadState **)png_get_error_ptr(png_save_ptr);
+    if (saved_tstate && *saved_tstate) {
+        PyEval_RestoreThread(*saved_tstate);
+        *saved_tstate = NULL;
+    }
     // we don't trust libpng to call the error callback only once, so
     // check for already-set error
     if (!PyErr_Occurred()) {
@@ -64,13 +73,15 @@ struct ProgressivePNGWriter::State
     int y;
     PyObject *file;
     FILE *fp;
+    PyThreadState *saved_tstate;  // non-NULL while the GIL is released
 
     State()
         : width(0), height(0),
           png_ptr(NULL), info_ptr(NULL),
           y(0),
           file(NULL),
-          fp(NULL)
+          fp(NULL),
+          saved_tstate(NULL)
     { }
 
     ~State() {
@@ -179,7 +190,7 @@ ProgressivePNGWriter::ProgressivePNGWriter(PyObject *file,
     state->fp = fp;
 
     png_ptr = png_create_write_struct (PNG_LIBPNG_VER_STRING,
-                                       (png_voidp)NULL,
+                                       (png_voidp)&state->saved_tstate,
                                        png_write_error_callback,
                                        NULL);
     if (!png_ptr) {
@@ -293,7 +304,18 @@ ProgressivePNGWriter::write(PyObject *arr_obj)
     assert(PyArray_STRIDE(arr, 1) == 4);
     assert(PyArray_STRIDE(arr, 2) == 1);
 
+    rowcount = PyArray_DIM(arr, 0);
+    if (state->y + rowcount > state->height) {
+        err_type = PyExc_RuntimeError;
+        err_text = "too many pixel rows written";
+        goto errexit;
+    }
     if (setjmp(png_jmpbuf(state->png_ptr))) {
+        // The error callback has already reacquired the GIL.
+        if (state->saved_tstate) {
+            PyEval_RestoreThread(state->saved_tstate);
+            state->saved_tstate = NULL;
+        }
         if (PyErr_Occurred()) {
             state->cleanup();
             return NULL;
@@ -302,23 +324,20 @@ ProgressivePNGWriter::write(PyObject *arr_obj)
         err_text = "libpng error during write()";
         goto errexit;
     }
-    rowcount = PyArray_DIM(arr, 0);
     rowstride = PyArray_STRIDE(arr, 0);
     rowdata = (png_bytep)PyArray_DATA(arr);
     row_p = (png_bytep)rowdata;
+
+    // Filtering and deflating the rows is the expensive part, and it
+    // touches no Python objects. Let other threads run meanwhile.
+    state->saved_tstate = PyEval_SaveThread();
     for (row=0; row<rowcount; row++) {
         png_write_row(state->png_ptr, row_p);
-        if (! state->check_valid()) {
-            state->cleanup();
-            return NULL;
-        }
         row_p += rowstride;
-        if (++(state->y) > state->height) {
-            err_type = PyExc_RuntimeError;
-            err_text = "too many pixel rows written";
-            goto errexit;
-        }
     }
+    PyEval_RestoreThread(state->saved_tstate);
+    state->saved_tstate = NULL;
+    state->y += rowcount;
     Py_RETURN_NONE;
 
   errexit:
@@ -133,8 +133,8 @@ Filler::pixel_fill_alpha(const rgba& px)
 */
 bool
 Filler::check_enqueue(
-    const int x, const int y, bool check, const rgba& src_pixel,
-    const chan_t& dst_pixel)
+    std::queue<coord>& seed_queue, const int x, const int y, bool check,
+    const rgba& src_pixel, const chan_t& dst_pixel)
 {
     if (dst_pixel != 0) return true;
     bool match = pixel_fill_alpha(src_pixel) > 0;
@@ -160,8 +160,13 @@ Filler::tile_uniformity(bool empty_tile, PyObject* src_arr)
     }
 
     PixelBuffer<rgba> src = PixelBuffer<rgba>(src_arr);
+    bool uniform;
 
-    if (src.is_uniform()) {
+    Py_BEGIN_ALLOW_THREADS
+    uniform = src.is_uniform();
+    Py_END_ALLOW_THREADS
+
+    if (uniform) {
         chan_t alpha = pixel_fill_alpha(src(0, 0));
         return Py_BuildValue("i", alpha);
     }
@@ -172,7 +177,8 @@ Filler::tile_uniformity(bool empty_tile, PyObject* src_arr)
 
 void
 Filler::queue_seeds(
-    PyObject* seeds, PixelBuffer<rgba>& src, PixelBuffer<chan_t> dst)
+    std::queue<coord>& seed_queue, PyObject* seeds, PixelBuffer<rgba>& src,
+    PixelBuffer<chan_t> dst)
 {
     Py_ssize_t num_seeds = PySequence_Size(seeds);
     for (Py_ssize_t i = 0; i < num_seeds; ++i) {
@@ -197,8 +203,8 @@ Filler::queue_seeds(
 */
 void
 Filler::queue_ranges(
-    edge origin, PyObject* seeds, bool input_marks[N], PixelBuffer<rgba>& src,
-    PixelBuffer<chan_t>& dst)
+    std::queue<coord>& seed_queue, edge origin, PyObject* seeds,
+    bool input_marks[N], PixelBuffer<rgba>& src, PixelBuffer<chan_t>& dst)
 {
 #ifdef HEAVY_DEBUG
     assert(PySequence_Check(seeds));
@@ -267,6 +273,9 @@ Filler::queue_ranges(
 
   The bounds defined by the min/max,x/y parameters limit the fill
   within the tile, if they are more constrained than (0, 0, N-1, N-1)
+
+  The GIL is released while filling, so fills of different tiles
+  can run in parallel on several threads.
 */
 PyObject*
 Filler::fill(
@@ -291,10 +300,11 @@ Filler::fill(
     // prior to constructing the output seed segment lists
     bool input_seeds[N] = {0,};
 
+    std::queue<coord> seed_queue;
     if (seed_origin == edges::none) { // Initial seeds, a list of coordinates
-        queue_seeds(seeds, src, dst);
+        queue_seeds(seed_queue, seeds, src, dst);
     } else {
-        queue_ranges(seed_origin, seeds, input_seeds, src, dst);
+        queue_ranges(seed_queue, seed_origin, seeds, input_seeds, src, dst);
     } // Seed queue populated
 
     // 0-initialized arrays used to mark points reached on
@@ -304,6 +314,7 @@ Filler::fill(
     bool* edge_marks[] = {_n, _e, _s, _w};
 
     // Fill loop
+    Py_BEGIN_ALLOW_THREADS
     while (!seed_queue.empty()) {
 
         int x0 = seed_queue.front().x;
@@ -342,13 +353,15 @@ Filler::fill(
 
                 if (y > 0) {
                     look_above = check_enqueue( //check/enqueue above
-                        x, y-1, look_above, src_px.above(), dst_px.above());
+                        seed_queue, x, y-1, look_above,
+                        src_px.above(), dst_px.above());
                 } else {
                     _n[x] = true; // On northern edge
                 }
                 if (y < (N - 1)) {
                     look_below = check_enqueue( // check/enqueue below
-                        x, y+1, look_below, src_px.below(), dst_px.below());
+                        seed_queue, x, y+1, look_below,
+                        src_px.below(), dst_px.below());
                 } else {
                     _s[x] = true; // On southern edge
                 }
@@ -361,6 +374,7 @@ Filler::fill(
             }
         }
     }
+    Py_END_ALLOW_THREADS
 
     if (seed_origin != edges::none) {
         // Remove incoming seeds from outgoing seeds
@@ -379,9 +393,11 @@ Filler::flood(PyObject* src_arr, PyObject* dst_arr)
 {
     PixelRef<rgba> src_px = PixelBuffer<rgba>(src_arr).get_pixel(0, 0);
     PixelRef<chan_t> dst_px = PixelBuffer<chan_t>(dst_arr).get_pixel(0, 0);
+    Py_BEGIN_ALLOW_THREADS
     for (int i = 0; i < N * N; ++i, src_px.move_x(1), dst_px.move_x(1)) {
         dst_px.write(pixel_fill_alpha(src_px.read()));
     }
+    Py_END_ALLOW_THREADS
 }
 
 PyObject*
@@ -395,6 +411,7 @@ rgba_tile_from_alpha_tile(
     PyObject* dst_arr = PyArray_ZEROS(3, dims, NPY_USHORT, 0);
     PixelBuffer<rgba> dst_buf(dst_arr);
     PixelBuffer<chan_t> src_buf(src);
+    Py_BEGIN_ALLOW_THREADS
     for (int y = min_y; y <= max_y; ++y) {
         int x = min_x;
         PixelRef<chan_t> src_px = src_buf.get_pixel(x, y);
@@ -403,5 +420,6 @@ rgba_tile_from_alpha_tile(
             dst_px.write(rgba(fill_r, fill_g, fill_b, src_px.read()));
         }
     }
+    Py_END_ALLOW_THREADS
     return dst_arr;
 }
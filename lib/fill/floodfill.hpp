@@ -28,6 +28,9 @@ typedef edges::edge edge;
 /*
   Implements the pixel threshold test function and uses it in the
   fill, alpha flooding, and tile uniformity/fillability methods
+
+  Instances hold no per-fill state, so one filler can be used by several
+  threads at once, for different tiles. The pixel loops run without the GIL.
 */
 class Filler
 {
@@ -35,7 +38,6 @@ class Filler
     const rgba target_color;
     const rgba target_color_premultiplied;
     const fix15_t tolerance;
-    std::queue<coord> seed_queue;
 
   public:
     Filler(int targ_r, int targ_g, int targ_b, int targ_a, double tol);
@@ -60,25 +62,28 @@ class Filler
     chan_t pixel_fill_alpha(const rgba& src_px);
     // Queue seeds from a python list of (x, y) coordinate tuples
     void queue_seeds(
-        PyObject* seeds, PixelBuffer<rgba>& src, PixelBuffer<chan_t> dst);
+        std::queue<coord>& seed_queue, PyObject* seeds,
+        PixelBuffer<rgba>& src, PixelBuffer<chan_t> dst);
     // Queue seeds from a python list of [start, end] range tuples
     // paired with an input origin direction indicating the side of
     // the tile that the ranges apply to.
     // Ranges are left->right, top->down, and end-inclusive.
     void queue_ranges(
-        edge direction, PyObject* seeds, bool marks[N],
-        PixelBuffer<rgba>& src, PixelBuffer<chan_t>& dst);
+        std::queue<coord>& seed_queue, edge direction, PyObject* seeds,
+        bool marks[N], PixelBuffer<rgba>& src, PixelBuffer<chan_t>& dst);
     // Check if a pixel is a valid fill candidate (unfilled & within threshold)
     // Put it in the seed queue if true.
     // Return value means: "enqueue valid neighbours on same row".
     bool check_enqueue(
-        const int x, const int y, bool check, const rgba& src_px,
-        const chan_t& dst_px);
+        std::queue<coord>& seed_queue, const int x, const int y, bool check,
+        const rgba& src_px, const chan_t& dst_px);
 };
 
 /*
   A GapClosingFiller uses additional distance data
   to stop filling when leaving a detected gap
+
+  Like Filler, it can be shared by threads working on different tiles.
 */
 class GapClosingFiller
 {
@@ -203,6 +203,8 @@ GapClosingFiller::fill(
 
     int pixels_filled = 0;
 
+    // Only the pixel buffers are touched from here on
+    Py_BEGIN_ALLOW_THREADS
     while (!queue.empty()) {
         gc_coord c = queue.front();
         int x = c.x;
@@ -265,6 +267,7 @@ GapClosingFiller::fill(
         // Queue adjacent pixels
         queue_gc_seeds(queue, c, curr_dist, north, east, south, west);
     }
+    Py_END_ALLOW_THREADS
 
     PyObject* f_edge_list = PyList_New(0);
 
@@ -126,11 +126,14 @@ find_gaps(
     GridVector input{PBT(nw), PBT(n),  PBT(ne), PBT(w), PBT(mid),
                      PBT(e),  PBT(se), PBT(s),  PBT(sw)};
 
-    init_from_nine_grid(r, rb.input, false, input);
-
     bool gaps_found = false;
 
     PixelBuffer<chan_t> radiuses(radiuses_arr);
+
+    // The bucket is scratch space, so callers searching several
+    // grids in parallel must give each thread its own bucket.
+    Py_BEGIN_ALLOW_THREADS
+    init_from_nine_grid(r, rb.input, false, input);
     // search for gaps in an approximate semi-circle
     for (int y = 0; y < 2 * r + N - 1;
          ++y) { // we check at most distance+1 pixels above any point
@@ -152,5 +155,6 @@ find_gaps(
             }
         }
     }
+    Py_END_ALLOW_THREADS
     return gaps_found;
 }
@@ -9,6 +9,7 @@
 """This module implements tile-based floodfill and related operations."""
 
 import logging
+import time
 
 import numpy as np
 import threading
@@ -23,6 +24,7 @@ import lib.fill_common as fc
 from lib.fill_common import _OPAQUE, _FULL_TILE, _EMPTY_TILE
 import lib.modes
 import lib.morphology
+import lib.workers
 
 from lib.pycompat import iteritems
 
@@ -41,6 +43,18 @@ _GAPLESS_TILE.flags.writeable = False
 
 EDGE = myplib.edges
 
+# Smallest batch of tiles worth handing to the worker pool
+PARALLEL_MIN_TILES = 4
+
+# Worker threads for the fill and composite stages, see _run_jobs()
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+# Seconds before a running fill starts publishing preview tiles,
+# and the minimum interval between later batches of them
+PREVIEW_DELAY = 0.5
+PREVIEW_INTERVAL = 0.2
+
 
 class GapClosingOptions:
     """Container of parameters for gap closing fill operations
@@ -98,6 +112,46 @@ def seeds_by_tile(seeds):
     return tile_seeds
 
 
+def group_by_tile(items):
+    """Group queue items by their tile coordinate, keeping their order
+
+    :param items: sequence of items whose first element is a tile coord
+    :returns: list of (tile_coord, [item, ...]), in order of first use
+
+    >>> group_by_tile([((0, 0), 'a'), ((1, 0), 'b'), ((0, 0), 'c')])
+    [((0, 0), [((0, 0), 'a'), ((0, 0), 'c')]), ((1, 0), [((1, 0), 'b')])]
+    """
+    groups = {}
+    order = []
+    for item in items:
+        tile_coord = item[0]
+        group = groups.get(tile_coord)
+        if group is None:
+            group = groups[tile_coord] = []
+            order.append(tile_coord)
+        group.append(item)
+    return [(tile_coord, groups[tile_coord]) for tile_coord in order]
+
+
+def _run_jobs(func, jobs):
+    """Call func(job) for each job, in parallel if there are enough
+
+    The per-tile fill and compositing functions in mypaintlib release
+    the GIL, so several tiles can be processed at once. Each job must
+    only write to its own tiles.
+    """
+    global _worker_pool
+    if len(jobs) < PARALLEL_MIN_TILES:
+        for job in jobs:
+            func(job)
+        return
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = lib.workers.WorkerPool(name="floodfill")
+    for job in _worker_pool.map_unordered(func, jobs):
+        pass
+
+
 def get_target_color(src, tx, ty, px, py):
     """Get the pixel color for the given tile/pixel coordinates"""
     with src.tile_request(tx, ty, readonly=True) as start:
@@ -149,6 +203,8 @@ class FillHandler:
         # this is the total amount of tiles to process
         self.tiles_max = 0
         self.fill_thread = None
+        # Tiles of the fill in progress, see FillPreview
+        self.preview = None
 
     @property
     def tiles_processed(self):
@@ -193,6 +249,67 @@ class FillHandler:
         self.run = False
 
 
+class FillPreview(object):
+    """Colored tiles of a fill in progress, for showing it as it spreads
+
+    The fill thread publishes batches of tiles here every so often
+    (see PREVIEW_DELAY), each holding the fill color at the fill's
+    alpha, the same as what gets composited into the destination at
+    the end. Drawn over the destination with the fill's mode and
+    opacity, they look just like the finished fill will.
+
+    >>> preview = FillPreview(0, 1.0)
+    >>> preview.publish({(0, 0): "a", (1, 0): "b"})
+    >>> sorted(preview.take_updates().items())
+    [((0, 0), 'a'), ((1, 0), 'b')]
+    >>> preview.publish({(1, 0): "c"})
+    >>> preview.take_updates()
+    {(1, 0): 'c'}
+    >>> preview.take_updates()
+    {}
+    >>> preview.num_tiles
+    2
+    """
+
+    def __init__(self, mode, opacity):
+        """Initialize, with the fill's compositing parameters
+
+        :param int mode: Combine* mode the fill will be composited with
+        :param float opacity: opacity of the fill
+        """
+        self.mode = mode
+        self.opacity = opacity
+        self._lock = threading.Lock()
+        self._tiles = {}  # {tile_coord: rgba}, all published so far
+        self._updates = {}  # {tile_coord: rgba}, not yet taken
+
+    @property
+    def num_tiles(self):
+        """The number of tiles published so far"""
+        return len(self._tiles)
+
+    def publish(self, tiles):
+        """Add or replace tiles (fill thread)
+
+        :param dict tiles: {tile_coord: rgba array}, not to be changed
+            after they are published
+        """
+        with self._lock:
+            self._tiles.update(tiles)
+            self._updates.update(tiles)
+
+    def take_updates(self):
+        """Get the tiles published since the last call
+
+        :returns: {tile_coord: rgba array}, read-only
+        :rtype: dict
+        """
+        with self._lock:
+            updates = self._updates
+            self._updates = {}
+        return updates
+
+
 class FloodFillArguments(object):
     """Container holding a set of flood fill arguments
     The purpose of this class is to avoid unnecessary
@@ -276,6 +393,7 @@ def flood_fill(src, fill_args, dst):
     :type dst: lib.tiledsurface.MyPaintSurface
     """
     handler = FillHandler()
+    handler.preview = FillPreview(fill_args.mode, fill_args.opacity)
     fill_function_args = (src, fill_args, dst, handler)
     fill_thread = threading.Thread(target=_flood_fill, args=fill_function_args)
     handler.fill_thread = fill_thread
@@ -317,12 +435,20 @@ def _flood_fill(src, args, dst, handler):
     seed_lists = seeds_by_tile(args.seeds)
 
     fill_args = (handler, src, seed_lists, tiles_bbox, filler)
+    publisher = _PreviewPublisher(handler, args.color)
 
     if args.gap_closing_options:
         fill_args += (args.gap_closing_options,)
-        filled = gap_closing_fill(*fill_args)
+        filled = gap_closing_fill(*fill_args, on_wave=publisher.update)
+    else:
+        filled = scanline_fill(*fill_args, on_wave=publisher.update)
+
+    # Colored tiles already made for the preview can be composited
+    # directly, unless the fill is about to be morphed or blurred.
+    if offset == 0 and feather == 0:
+        colored = publisher.unchanged_tiles()
     else:
-        filled = scanline_fill(*fill_args)
+        colored = {}
 
     # Dilate/Erode (Grow/Shrink)
     if offset != 0 and handler.run:
@@ -338,7 +464,76 @@ def _flood_fill(src, args, dst, handler):
     if handler.run:
         composite(
             handler, args,
-            trim_result, filled, tiles_bbox, dst
+            trim_result, filled, tiles_bbox, dst, colored
+        )
+
+
+class _PreviewPublisher(object):
+    """Publishes the tiles of a running fill to its FillHandler.preview
+
+    The fill functions report the tiles each wavefront touched. Those
+    are colored and published in batches, no more often than
+    PREVIEW_INTERVAL, so a short fill never publishes anything.
+    """
+
+    def __init__(self, handler, color):
+        self._handler = handler
+        self._color = color
+        self._full_rgba = None
+        self._colored = {}  # {tile_coord: rgba}, as last published
+        self._dirty = set()  # tiles changed since they were published
+        self._next_publish = time.time() + PREVIEW_DELAY
+
+    def update(self, filled, touched):
+        """Note changed tiles, publishing them if it's time to
+
+        :param dict filled: the alpha tiles filled so far
+        :param iterable touched: coordinates of the tiles which changed
+        """
+        self._dirty.update(touched)
+        handler = self._handler
+        if handler.preview is None or not handler.run:
+            return
+        if time.time() < self._next_publish:
+            return
+        batch = {}
+        jobs = []
+        for tile_coord in self._dirty:
+            alpha_tile = filled.get(tile_coord)
+            if alpha_tile is None:
+                continue
+            if alpha_tile is _FULL_TILE:
+                if self._full_rgba is None:
+                    self._full_rgba = myplib.rgba_tile_from_alpha_tile(
+                        _FULL_TILE, *(self._color + (0, 0, N-1, N-1))
+                    )
+                batch[tile_coord] = self._full_rgba
+            else:
+                jobs.append((tile_coord, alpha_tile))
+
+        def _color_tile(job):
+            tile_coord, alpha_tile = job
+            batch[tile_coord] = myplib.rgba_tile_from_alpha_tile(
+                alpha_tile, *(self._color + (0, 0, N-1, N-1))
+            )
+
+        _run_jobs(_color_tile, jobs)
+        if not handler.run:
+            return
+        self._colored.update(batch)
+        self._dirty.clear()
+        handler.preview.publish(batch)
+        self._next_publish = time.time() + PREVIEW_INTERVAL
+
+    def unchanged_tiles(self):
+        """The published tiles which are still up to date
+
+        :returns: {tile_coord: rgba array}
+        :rtype: dict
+        """
+        return dict(
+            (tc, rgba) for (tc, rgba) in iteritems(self._colored)
+            if tc not in self._dirty
         )
 
 
@@ -364,8 +559,12 @@ def update_bbox(bbox, tx, ty):
 
 def composite(
         handler, fill_args,
-        trim_result, filled, tiles_bbox, dst):
-    """Composite the filled tiles into the destination surface"""
+        trim_result, filled, tiles_bbox, dst, colored=None):
+    """Composite the filled tiles into the destination surface
+
+    :param dict colored: {tile_coord: rgba} for filled tiles which have
+        already been colored, e.g. for the preview, and can be reused
+    """
 
     handler.set_stage(handler.COMPOSITE, len(filled))
 
@@ -385,6 +584,38 @@ def composite(
     opacity = fill_args.opacity
 
     tile_combine = myplib.tile_combine
+    if colored is None:
+        colored = {}
+
+    # Destination tiles are requested here, since that changes dst's
+    # tile dict. The compositing itself is done by the worker pool.
+    jobs = []
+
+    def _composite_tile(job):
+        if not handler.run:
+            return
+        src_tile, dst_tile, tile_bounds = job
+        if src_tile is None:
+            # Even if opacity != 1.0, we can reuse the full rgba tile
+            src_tile_rgba = full_rgba
+        elif tile_bounds is None:
+            # Colored earlier
+            src_tile_rgba = src_tile
+        else:
+            src_tile_rgba = myplib.rgba_tile_from_alpha_tile(
+                src_tile, *(fill_col + tile_bounds)
+            )
+
+        # If alpha locking is enabled in combination with a mode other than
+        # CombineNormal, we need to copy the dst tile to mask the result
+        if lock_alpha and mode != myplib.CombineSourceAtop:
+            mask = np.copy(dst_tile)
+            mask_mode = myplib.CombineDestinationAtop
+            tile_combine(mode, src_tile_rgba, dst_tile, True, opacity)
+            tile_combine(mask_mode, mask, dst_tile, True, 1.0)
+        else:
+            tile_combine(mode, src_tile_rgba, dst_tile, True, opacity)
+        handler.inc_processed()
 
     # Composite filled tiles into the destination surface
     for tile_coord, src_tile in iteritems(filled):
@@ -392,16 +623,16 @@ def composite(
         if not handler.run:
             break
 
-        handler.inc_processed()
-
         # Omit tiles outside of the bounding box _if_ the frame is enabled
         # Note:filled tiles outside bbox only originates from dilation/blur
         if trim_result and tiles_bbox.outside(tile_coord):
+            handler.inc_processed()
             continue
 
         # Skip empty destination tiles for erasing and alpha locking
         # Avoids completely unnecessary tile allocation and copying
         if skip_empty_dst and tile_coord not in dst_tiles:
+            handler.inc_processed()
             continue
 
         with dst.tile_request(*tile_coord, readonly=False) as dst_tile:
@@ -413,35 +644,30 @@ def composite(
             # can be used instead of compositing operations.
             cut_off = trim_result and tiles_bbox.crossing(tile_coord)
             full_inner = src_tile is _FULL_TILE and not cut_off
-            if full_inner:
-                if mode == myplib.CombineNormal and opacity == 1.0:
+            if full_inner and opacity == 1.0:
+                if mode == myplib.CombineNormal:
                     myplib.tile_copy_rgba16_into_rgba16(full_rgba, dst_tile)
+                    handler.inc_processed()
                     continue
-                elif mode == myplib.CombineDestinationOut and opacity == 1.0:
+                elif mode == myplib.CombineDestinationOut:
                     dst_tiles.pop(tile_coord)
+                    handler.inc_processed()
                     continue
-                elif mode == myplib.CombineDestinationIn and opacity == 1.0:
+                elif mode == myplib.CombineDestinationIn:
+                    handler.inc_processed()
                     continue
-                # Even if opacity != 1.0, we can reuse the full rgba tile
-                src_tile_rgba = full_rgba
+            if full_inner:
+                jobs.append((None, dst_tile, None))
+            elif tile_coord in colored and not trim_result:
+                jobs.append((colored[tile_coord], dst_tile, None))
             else:
                 if trim_result:
                     tile_bounds = tiles_bbox.tile_bounds(tile_coord)
                 else:
                     tile_bounds = (0, 0, N-1, N-1)
-                src_tile_rgba = myplib.rgba_tile_from_alpha_tile(
-                    src_tile, *(fill_col + tile_bounds)
-                )
+                jobs.append((src_tile, dst_tile, tile_bounds))
 
-            # If alpha locking is enabled in combination with a mode other than
-            # CombineNormal, we need to copy the dst tile to mask the result
-            if lock_alpha and mode != myplib.CombineSourceAtop:
-                mask = np.copy(dst_tile)
-                mask_mode = myplib.CombineDestinationAtop
-                tile_combine(mode, src_tile_rgba, dst_tile, True, opacity)
-                tile_combine(mask_mode, mask, dst_tile, True, 1.0)
-            else:
-                tile_combine(mode, src_tile_rgba, dst_tile, True, opacity)
+    _run_jobs(_composite_tile, jobs)
 
     # Handle dst-out and dst-atop: clear untouched tiles
     if mode in [myplib.CombineDestinationIn, myplib.CombineDestinationAtop]:
@@ -472,7 +698,8 @@ def composite(
         GLib.idle_add(dst.notify_observers, *bbox)
 
 
-def scanline_fill(handler, src, seed_lists, tiles_bbox, filler):
+def scanline_fill(
+        handler, src, seed_lists, tiles_bbox, filler, on_wave=None):
     """ Perform a scanline fill and return the filled tiles
 
     Perform a scanline fill using the given starting point and tile,
@@ -488,7 +715,14 @@ def scanline_fill(handler, src, seed_lists, tiles_bbox, filler):
     :type tiles_bbox: lib.fill_common.TileBoundingBox
     :param filler: filler instance performing the per-tile fill operation
     :type filler: mypaintlib.Filler
+    :param on_wave: called as on_wave(filled, tile_coords) after each
+        wavefront, with the coordinates of the tiles it processed
     :returns: a dictionary of coord->tile mappings for the filled tiles
+
+    The seed queue is processed one wavefront at a time. The tiles in
+    a wavefront are independent, so they are filled in parallel, but
+    the seeds for each tile are handled in the same order as a single
+    queue would, so the result is the same.
     """
 
     # Dict of coord->tile data populated during the fill
@@ -508,26 +742,48 @@ def scanline_fill(handler, src, seed_lists, tiles_bbox, filler):
 
     tfs = _TileFillSkipper(tiles_bbox, filler, set({}))
 
+    def _fill_tile(job):
+        tile_coord, src_tile, dst_tile, items = job
+        bounds = tiles_bbox.tile_bounds(tile_coord)
+        for item in items:
+            if not handler.run:
+                break
+            _, seeds, from_dir, _ = item
+            item[3] = filler.fill(src_tile, dst_tile, seeds, from_dir, *bounds)
+
     while len(tileq) > 0 and handler.run:
-        tile_coord, seeds, from_dir = tileq.pop(0)
-        # Skip if the tile has been fully processed already
-        if tile_coord in tfs.final:
-            continue
-        # Flood-fill one tile
-        with src.tile_request(*tile_coord, readonly=True) as src_tile:
-            # See if the tile can be skipped
-            overflows = tfs.check(tile_coord, src_tile, filled, from_dir)
+        # Items are [tile_coord, seeds, from_dir, overflows]
+        wave = [list(item) + [None] for item in tileq]
+        tileq = []
+        # Uniform tiles are handled and output tiles are allocated here,
+        # as is reading src, which may not be safe to share between threads.
+        jobs = []
+        for tile_coord, items in group_by_tile(wave):
+            # Skip if the tile has been fully processed already
+            if tile_coord in tfs.final:
+                continue
+            with src.tile_request(*tile_coord, readonly=True) as src_tile:
+                # See if the tile can be skipped
+                from_dir = items[0][2]
+                overflows = tfs.check(tile_coord, src_tile, filled, from_dir)
             if overflows is None:
                 if tile_coord not in filled:
                     handler.inc_processed()
                     filled[tile_coord] = np.zeros((N, N), 'uint16')
-                overflows = filler.fill(
-                    src_tile, filled[tile_coord], seeds,
-                    from_dir, *tiles_bbox.tile_bounds(tile_coord)
-                )
+                dst_tile = filled[tile_coord]
+                jobs.append((tile_coord, src_tile, dst_tile, items))
             else:
                 handler.inc_processed()
-        enqueue_overflows(tileq, tile_coord, overflows, tiles_bbox, inv_edges)
+                items[0][3] = overflows
+        # Flood-fill the wavefront's tiles
+        _run_jobs(_fill_tile, jobs)
+        for tile_coord, _, _, overflows in wave:
+            if overflows is not None:
+                enqueue_overflows(
+                    tileq, tile_coord, overflows, tiles_bbox, inv_edges
+                )
+        if on_wave:
+            on_wave(filled, set(item[0] for item in wave))
     return filled
 
 
@@ -598,7 +854,8 @@ class _TileFillSkipper:
 
 
 def gap_closing_fill(
-        handler, src, seed_lists, tiles_bbox, filler, gap_closing_options):
+        handler, src, seed_lists, tiles_bbox, filler, gap_closing_options,
+        on_wave=None):
     """ Fill loop that finds and uses gap data to avoid unwanted leaks
 
     Gaps are defined as distances of fillable pixels enclosed on two sides
@@ -606,6 +863,11 @@ def gap_closing_fill(
     flooded with alpha values based on the target color and threshold values.
     The resulting alphas are then searched for gaps, and the size of these gaps
     are marked in separate tiles - one for each tile filled.
+
+    Like scanline_fill(), this works through the seed queue one
+    wavefront at a time, searching for gaps and filling the tiles of
+    each wavefront in parallel. Progress is reported to on_wave in the
+    same way, too.
     """
 
     unseep_queue = []
@@ -623,24 +885,24 @@ def gap_closing_fill(
     total_px = 0
     skip_unseeping = False
 
-    while len(seed_queue) > 0 and handler.run:
-        tile_coord, seeds = seed_queue.pop(0)
-        if tile_coord in final:
-            continue
-        # Create distance-data and alpha output tiles for the fill
-        # and check if the tile can be skipped directly
-        alpha_t, dist_t, overflows = gc_handler.get_gc_data(tile_coord, seeds)
-        if overflows:
-            handler.inc_processed()
-            filled[tile_coord] = _FULL_TILE
-        else:
+    def _fill_tile(job):
+        tile_coord, items = job
+        for item in items:
+            if not handler.run or tile_coord in final:
+                break
+            seeds = item[1]
+            # Create distance-data and alpha output tiles for the fill
+            # and check if the tile can be skipped directly
+            alpha_t, dist_t, overflows = gc_handler.get_gc_data(
+                tile_coord, seeds
+            )
+            if overflows:
+                handler.inc_processed()
+                filled[tile_coord] = _FULL_TILE
+                item[2] = (overflows, None, 0, False)
+                continue
             # Complement data for initial seeds (if they are initial seeds)
             seeds, any_not_max = complement_gc_seeds(seeds, dist_t)
-            # If the fill is starting at a point with a detected distance,
-            # disable seep retraction - otherwise it is very likely
-            # that the result will be completely empty.
-            if any_not_max:
-                skip_unseeping = True
             # Pixel limits within tiles can vary at the bounding box edges
             px_bounds = tiles_bbox.tile_bounds(tile_coord)
             # Create new output tile if not already present
@@ -657,20 +919,47 @@ def gap_closing_fill(
             # replace data w. constant and mark tile as final.
             if px_f == N*N:
                 final.add(tile_coord)
+            item[2] = (overflows, fill_edges, px_f, any_not_max)
+
+    while len(seed_queue) > 0 and handler.run:
+        # Items are [tile_coord, seeds, result]
+        wave = [list(item) + [None] for item in seed_queue]
+        seed_queue = []
+        jobs = []
+        for tile_coord, items in group_by_tile(wave):
+            if tile_coord in final:
+                continue
+            # Alpha tiles are created from src here, not in the workers
+            gc_handler.prepare(tile_coord)
+            jobs.append((tile_coord, items))
+        _run_jobs(_fill_tile, jobs)
+        for tile_coord, _, result in wave:
+            if result is None:
+                continue
+            overflows, fill_edges, px_f, any_not_max = result
+            # If the fill is starting at a point with a detected distance,
+            # disable seep retraction - otherwise it is very likely
+            # that the result will be completely empty.
+            if any_not_max:
+                skip_unseeping = True
             # When seep inversion is enabled, track total pixels filled
             # and coordinates where the fill stopped due to distance conditions
             total_px += px_f
             if not skip_unseeping and fill_edges:
                 unseep_queue.append((tile_coord, fill_edges, True))
-        # Enqueue overflows, whether skipping or not
-        enqueue_overflows(seed_queue, tile_coord, overflows, tiles_bbox)
+            # Enqueue overflows, whether skipping or not
+            enqueue_overflows(seed_queue, tile_coord, overflows, tiles_bbox)
+        if on_wave:
+            on_wave(filled, set(item[0] for item in wave))
 
     # If enabled, pull the fill back into the gaps to stop before them
     if not skip_unseeping and handler.run:
-        unseep(
+        unseeped = unseep(
             unseep_queue, filled, gc_filler,
             total_px, tiles_bbox, gc_handler.distances
         )
+        if on_wave:
+            on_wave(filled, unseeped)
     return filled
 
 
@@ -693,10 +982,22 @@ class _GCTileHandler(object):
         self.final = final
         self.distances = dict()
         self._alpha_tiles = dict()
-        self._dist_data = None
         self._bbox = tiles_bbox
         self._filler = filler
-        self._distbucket = myplib.DistanceBucket(max_gap_size)
+        self._max_gap_size = max_gap_size
+        # Gap searches run on several threads at once, and each needs
+        # its own scratch space: a bucket and a spare distance tile.
+        self._scratch = threading.local()
+
+    def prepare(self, tile_coord):
+        """Make the alpha tiles needed by get_gc_data() for a tile
+
+        This reads the src surface, so it must be called from the
+        thread running the fill, before get_gc_data() is called
+        for the tile from any thread.
+        """
+        if tile_coord not in self.distances:
+            self.alpha_grid(tile_coord)
 
     def get_gc_data(self, tile_coord, seeds):
         """Get the data necessary to run a gap-closing fill
@@ -733,8 +1034,8 @@ class _GCTileHandler(object):
                         overflows = self.OVERFLOWS[seeds[0]]
                     return _FULL_TILE, _GAPLESS_TILE, overflows
             else:
-                self.distances[tile_coord] = self._dist_data
-                self._dist_data = None
+                self.distances[tile_coord] = self._scratch.dist_data
+                self._scratch.dist_data = None
         # The distance data is already present, meaning the skip checks have
         # already been tried, no skipping possible.
         return self._alpha_tiles[tile_coord], self.distances[tile_coord], ()
@@ -746,9 +1047,12 @@ class _GCTileHandler(object):
         :return: True if any gaps were found, otherwise false
         :rtype: bool
         """
-        if self._dist_data is None:
-            self._dist_data = fc.new_full_tile(INF_DIST)
-        return myplib.find_gaps(self._distbucket, self._dist_data, *grid)
+        scratch = self._scratch
+        if getattr(scratch, "dist_data", None) is None:
+            scratch.dist_data = fc.new_full_tile(INF_DIST)
+        if getattr(scratch, "bucket", None) is None:
+            scratch.bucket = myplib.DistanceBucket(self._max_gap_size)
+        return myplib.find_gaps(scratch.bucket, scratch.dist_data, *grid)
 
     def alpha_grid(self, tile_coord):
         """When needed, create and calculate alpha tiles for distance searching.
@@ -791,6 +1095,8 @@ def unseep(seed_queue, filled, gc_filler, total_px, tiles_bbox, distances):
     with different conditions. It only backs off into the original
     fill and therefore does not require creation of new tiles or use
     of an input alpha tile.
+
+    Returns the coordinates of the tiles which may have been changed.
     """
     backup = {}
     while len(seed_queue) > 0:
@@ -818,6 +1124,7 @@ def unseep(seed_queue, filled, gc_filler, total_px, tiles_bbox, distances):
         # roll back the tiles that were processed
         for tile_coord, tile in iteritems(backup):
             filled[tile_coord] = tile
+    return set(backup)
 
 
 def complement_gc_seeds(seeds, distance_tile):
@@ -905,23 +905,30 @@ class LayerBase (Renderable):
         """
         return self._thumbnail
 
-    def update_thumbnail(self):
+    def update_thumbnail(self, dirty=None):
         """Safely updates the cached preview thumbnail.
 
-        This method updates self.thumbnail using render_thumbnail() and
-        the data bounding box, and eats any NotImplementedErrors.
+        :param list dirty: model rects (x, y, w, h) which changed since
+            the last update, or None if anything may have changed.
+
+        This method updates self.thumbnail for the data bounding box,
+        and eats any NotImplementedErrors. Only the dirty parts are
+        rendered again: see RootLayerStack.update_layer_thumbnail().
 
         This is used by the layer stack to keep the preview thumbnail up
-        to date. It is called automatically after layer data is changed
-        and stable for a bit, so there is normally no need to call it in
-        client code.
+        to date. It is called automatically after layer data is changed,
+        so there is normally no need to call it in client code.
 
         """
+        root = self.root
         try:
-            self._thumbnail = self.render_thumbnail(
-                self.get_bbox(),
-                alpha=True,
-            )
+            if root is None:
+                self._thumbnail = None
+            else:
+                self._thumbnail = root.update_layer_thumbnail(
+                    self, dirty,
+                    alpha=True,
+                )
         except NotImplementedError:
             self._thumbnail = None
 
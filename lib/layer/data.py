@@ -42,6 +42,8 @@ import lib.layer.error
 import lib.autosave
 import lib.xml
 import lib.feedback
+import lib.orawriter
+import lib.tilejournal
 from . import rendering
 from lib.pycompat import PY3
 from lib.pycompat import unicode
@@ -78,6 +80,17 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
     #: Substitute content if the layer cannot be loaded.
     FALLBACK_CONTENT = None
 
+    #: Whether load_from_openraster() may defer decoding the surface.
+    #: Layers which override _load_surface_from_orazip_member() must
+    #: set this to False.
+    LAZY_LOADABLE = True
+
+    #: Autosave stack.xml attribute: committed length of a tile journal.
+    #: When present, the layer's @src is a journal, not a PNG file.
+    _ORA_TILE_JOURNAL_SIZE_ATTR = "{%s}tile-journal-size" % (
+        lib.xml.OPENRASTER_MYPAINT_NS,
+    )
+
     ## Initialization
 
     def __init__(self, surface=None, **kwargs):
@@ -100,6 +113,9 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         else:
             self._surface = surface
 
+        # Incremental autosave state, see queue_autosave()
+        self._autosave_journal = None
+
     @classmethod
     def new_from_surface_backed_layer(cls, src):
         """Clone from another SurfaceBackedLayer
@@ -142,6 +158,11 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         method also checks the src attribute's suffix against
         ALLOWED_SUFFIXES before attempting to load the surface.
 
+        If a "lazy_loader" keyword argument is passed, and the layer is
+        LAZY_LOADABLE, decoding the surface is deferred to it instead.
+        It must have a ``defer(surface, src, x, y)`` method which
+        returns true if it's taken responsibility for loading.
+
         See: _load_surface_from_orazip_member()
 
         """
@@ -180,6 +201,13 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
             raise lib.layer.error.LoadingFailed(
                 "Only %r are supported" % (suffixes,),
             )
+        # Just note where the data is, if the surface can be lazy-loaded
+        lazy_loader = kwargs.get("lazy_loader")
+        if lazy_loader is not None and self.LAZY_LOADABLE:
+            if lazy_loader.defer(self._surface, src, x, y):
+                if progress:
+                    progress.close()
+                return
         # Delegate the actual loading part
         self._load_surface_from_orazip_member(
             orazip,
@@ -230,6 +258,15 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
             x, y,
             self.__class__.__name__,
         )
+        journal_size = attrs.get(self._ORA_TILE_JOURNAL_SIZE_ATTR, None)
+        if journal_size is not None:
+            self._load_surface_from_tile_journal(
+                os.path.join(oradir, src),
+                int(journal_size),
+                x, y,
+                progress,
+            )
+            return
         suffixes = self.ALLOWED_SUFFIXES
         if ("" not in suffixes) and (src_ext not in suffixes):
             logger.debug(
@@ -265,6 +302,45 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
             progress,
         )
 
+    def _load_surface_from_tile_journal(self, filename, size, x, y,
+                                        progress):
+        """Loads the surface from an autosave tile journal
+
+        :param unicode filename: the journal file
+        :param int size: its committed length, from stack.xml
+        :param int x: X offset for the journal's tiles, in pixels
+        :param int y: Y offset for the journal's tiles, in pixels
+        :param progress: Unsized UI feedback object
+        :type progress: lib.feedback.Progress or None
+
+        """
+        try:
+            tiles = lib.tilejournal.read_journal(filename, N, size)
+        except (IOError, OSError, ValueError) as err:
+            raise lib.layer.error.LoadingFailed(
+                "Failed to load %r: %r" % (filename, str(err)),
+            )
+        if progress:
+            progress.items = len(tiles)
+        # Tile-aligned offsets can be applied while loading.
+        aligned = (x % N == 0) and (y % N == 0)
+        dtx, dty = aligned and (x // N, y // N) or (0, 0)
+        surface = tiledsurface.Surface()
+        for (tx, ty), data in tiles.items():
+            with surface.tile_request(tx + dtx, ty + dty,
+                                      readonly=False) as dst:
+                tiledsurface.unpack_tile_data(data, dst)
+            if progress:
+                progress += 1
+        if not aligned:
+            move = surface.get_move(0, 0, sort=False)
+            move.update(x, y)
+            move.process(n=-1)
+            move.cleanup()
+        self.load_from_surface(surface)
+        if progress:
+            progress.close()
+
     def load_surface_from_pixbuf_file(self, filename, x=0, y=0,
                                       progress=None):
         """Loads the layer's surface from any file which GdkPixbuf can open"""
@@ -364,18 +440,19 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
             return []
 
         ops = []
+        source = self._surface.get_render_source()
         if (spec.current_overlay is not None) and (self is spec.current):
             # Temporary special effects, e.g. layer blink.
             ops.append((rendering.Opcode.PUSH, None, None, None))
             ops.append((
-                rendering.Opcode.COMPOSITE, self._surface, mode_default, 1.0,
+                rendering.Opcode.COMPOSITE, source, mode_default, 1.0,
             ))
             ops.extend(spec.current_overlay.get_render_ops(spec))
-            ops.append(rendering.Opcode.POP, None, mode, opacity)
+            ops.append((rendering.Opcode.POP, None, mode, opacity))
         else:
             # The 99%+ case☺
             ops.append((
-                rendering.Opcode.COMPOSITE, self._surface, mode, opacity,
+                rendering.Opcode.COMPOSITE, source, mode, opacity,
             ))
         return ops
 
@@ -393,6 +470,27 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
 
     ## Saving
 
+    @property
+    def load_error(self):
+        """Why a deferred load of this layer's data failed, or None
+
+        Layers whose load failed are empty, and refuse to be saved:
+        writing them out would replace the original data with nothing.
+        This property is read-only.
+
+        """
+        return self._surface.load_error
+
+    def _check_saveable(self):
+        """Raises LoadingFailed if the layer's deferred load failed"""
+        try:
+            self._surface.finish_pending_load()
+        except Exception as err:
+            raise lib.layer.error.LoadingFailed(
+                "Refusing to save %r: its data failed to load: %r"
+                % (self, err)
+            )
+
     @lib.fileutils.via_tempfile
     def save_as_png(self, filename, *rect, **kwargs):
         """Save to a named PNG file
@@ -402,17 +500,26 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         :param **kwargs: passed to the surface's save_as_png() method
         :rtype: Gdk.Pixbuf
         """
+        self._check_saveable()
         self._surface.save_as_png(filename, *rect, **kwargs)
 
     def save_to_openraster(self, orazip, tmpdir, path,
                            canvas_bbox, frame_bbox, **kwargs):
         """Saves the layer's data into an open OpenRaster ZipFile"""
+        self._check_saveable()
         rect = self.get_bbox()
         return self._save_rect_to_ora(orazip, tmpdir, "layer", path,
                                       frame_bbox, rect, **kwargs)
 
     def queue_autosave(self, oradir, taskproc, manifest, bbox, **kwargs):
         """Queues the layer for auto-saving"""
+        self._check_saveable()
+
+        # Normal layers are saved incrementally, as a tile journal.
+        if not self._surface.looped:
+            return self._queue_autosave_journal(
+                oradir, taskproc, manifest, bbox,
+            )
 
         # Queue up a task which writes the surface as a PNG. This will
         # be the file that's indexed by the <layer/>'s @src attribute.
@@ -453,6 +560,42 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         elem.attrib["src"] = png_relpath
         return elem
 
+    def _queue_autosave_journal(self, oradir, taskproc, manifest, bbox):
+        """Queues appending the tiles changed since the last autosave
+
+        The journal's tiles keep their model coordinates, so the
+        <layer/>'s x and y just undo the shift that loading applies.
+        The committed length of the journal is stored in stack.xml
+        when the appends are done, so an interrupted autosave leaves
+        a journal which still matches the previous stack.xml.
+
+        """
+        datadir = os.path.join(oradir, "data")
+        journal = self._autosave_journal
+        if journal is None or not os.path.exists(journal.path):
+            journal = lib.tilejournal.TileJournal(
+                datadir,
+                self.autosave_uuid,
+                tile_size = N,
+            )
+            self._autosave_journal = journal
+        sshot = self._surface.save_snapshot()
+        elem = self._get_stackxml_element("layer", -bbox[0], -bbox[1])
+        size_attr = self._ORA_TILE_JOURNAL_SIZE_ATTR
+
+        def _journal_updated_cb(journal):
+            elem.attrib[size_attr] = str(journal.size)
+
+        task = journal.get_update_task(sshot.tiledict, _journal_updated_cb)
+        if task:
+            taskproc.add_work(task)
+        self.autosave_dirty = False
+        journal_relpath = os.path.join("data", journal.filename)
+        manifest.add(journal_relpath)
+        elem.attrib["src"] = journal_relpath
+        elem.attrib[size_attr] = str(journal.size)
+        return elem
+
     @staticmethod
     def _make_refname(prefix, path, suffix, sep='-'):
         """Internal: standardized filename for something with a path"""
@@ -465,17 +608,15 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
     def _save_rect_to_ora(self, orazip, tmpdir, prefix, path,
                           frame_bbox, rect, progress=None, **kwargs):
         """Internal: saves a rectangle of the surface to an ORA zip"""
-        # Write PNG data via a tempfile
+        # Encode PNG data, possibly concurrently
         pngname = self._make_refname(prefix, path, ".png")
-        pngpath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self._surface.save_as_png(pngpath, *rect, progress=progress, **kwargs)
-        t1 = time.time()
-        logger.debug('%.3fs surface saving %r', t1 - t0, pngname)
-        # Archive and remove
         storepath = "data/%s" % (pngname,)
-        orazip.write(pngpath, storepath)
-        os.remove(pngpath)
+        lib.orawriter.write_png(
+            orazip, tmpdir, storepath,
+            self._surface, rect,
+            progress=progress,
+            **kwargs
+        )
         # Return details
         png_bbox = tuple(rect)
         png_x, png_y = png_bbox[0:2]
@@ -602,6 +743,7 @@ class FileBackedLayer (SurfaceBackedLayer, core.ExternallyEditable):
 
     ALLOWED_SUFFIXES = []
     REVISIONS_SUBDIR = u"revisions"
+    LAZY_LOADABLE = False
 
     ## Construction
 
@@ -1027,6 +1169,8 @@ class BackgroundLayer (SurfaceBackedLayer):
         lib.xml.OPENRASTER_MYPAINT_NS,
     )
 
+    LAZY_LOADABLE = False
+
     def __init__(self, bg, **kwargs):
         if isinstance(bg, tiledsurface.Background):
             surface = bg
@@ -1065,24 +1209,14 @@ class BackgroundLayer (SurfaceBackedLayer):
         # Item 2: also save as single pattern (with corrected origin)
         x0, y0 = frame_bbox[0:2]
         x, y, w, h = self.get_bbox()
-
         pngname = self._make_refname("background", path, "tile.png")
-        tmppath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self._surface.save_as_png(
-            tmppath,
-            x=x + x0,
-            y=y + y0,
-            w=w,
-            h=h,
+        storename = 'data/%s' % (pngname,)
+        lib.orawriter.write_png(
+            orazip, tmpdir, storename,
+            self._surface, (x + x0, y + y0, w, h),
             progress=progress.open(),
             **kwargs
         )
-        t1 = time.time()
-        storename = 'data/%s' % (pngname,)
-        logger.debug('%.3fs surface saving %s', t1 - t0, storename)
-        orazip.write(tmppath, storename)
-        os.remove(tmppath)
         elem.attrib[self.ORA_BGTILE_ATTR] = storename
 
         progress.close()
@@ -1440,6 +1574,8 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
         #: List of strokemap.StrokeShape instances (not stroke.Stroke),
         #: ordered by depth.
         self.strokes = []
+        # Which strokes touch each tile, for picking
+        self._stroke_index = lib.strokemap.StrokeIndex()
 
     def clear(self):
         """Clear both the surface and the strokemap"""
@@ -1558,6 +1694,7 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
         if shape is not None:
             shape.brush_string = stroke.brush_settings
             self.strokes.append(shape)
+            self._stroke_index.stroke_added(self.strokes)
 
     ## Snapshots
 
@@ -1583,6 +1720,11 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
         for stroke in empty_strokes:
             logger.debug("Removing emptied stroke %r", stroke)
             self.strokes.remove(stroke)
+        self._stroke_index.strokes_changed(
+            self.strokes,
+            changed=self.strokes,
+            removed=empty_strokes,
+        )
 
     ## Strokemap load and save
 
@@ -1623,7 +1765,10 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
     def get_stroke_info_at(self, x, y):
         """Get the stroke at the given point"""
         x, y = int(x), int(y)
-        for s in reversed(self.strokes):
+        candidates = self._stroke_index.get_strokes_at(
+            self.strokes, x // N, y // N,
+        )
+        for s in candidates:
             if s.touches_pixel(x, y):
                 return s
 
@@ -1665,6 +1810,7 @@ class StrokemappedPaintingLayer (SimplePaintingLayer):
 
     def queue_autosave(self, oradir, taskproc, manifest, bbox, **kwargs):
         """Queues the layer for auto-saving"""
+        self._check_saveable()
         dat_basename = u"%s-strokemap.dat" % (self.autosave_uuid,)
         dat_relpath = os.path.join("data", dat_basename)
         dat_path = os.path.join(oradir, dat_relpath)
@@ -1840,13 +1986,15 @@ class StrokemappedPaintingLayerMove (SurfaceBackedLayerMove):
         dy = self._final_dy
         # Arrange for the strokemap to be moved too;
         # this happens in its own background idler.
-        for stroke in self._layer.strokes:
+        strokes = self._layer.strokes
+        for stroke in strokes:
             stroke.translate(dx, dy)
             # Minor problem: huge strokemaps take a long time to move, and the
             # translate must be forced to completion before drawing or any
             # further layer moves. This can cause apparent hangs for no
             # reason later on. Perhaps it would be better to process them
             # fully in this hourglass-cursor phase after all?
+        self._layer._stroke_index.strokes_changed(strokes, changed=strokes)
         # The tile memory is the canonical source of a painting layer,
         # so we'll need to autosave it.
         self._layer.autosave_dirty = True
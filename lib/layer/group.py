@@ -445,16 +445,35 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
 
         isolate_child_layers = (mode != PASS_THROUGH_MODE)
 
-        ops = []
-        if isolate_child_layers:
-            ops.append((Opcode.PUSH, None, None, None))
+        child_ops = []
         for child_layer in reversed(self._layers):
-            ops.extend(child_layer.get_render_ops(spec))
-        if isolate_child_layers:
-            ops.append((Opcode.POP, None, mode, opacity))
-
+            if child_layer is spec.current:
+                child_ops.append((Opcode.MARK, child_layer, None, None))
+            child_ops.extend(child_layer.get_render_ops(spec))
+        if not isolate_child_layers:
+            return child_ops
+
+        # Isolated groups which the user isn't working inside
+        # can be composited from the root's per-group tile cache.
+        root = self.root
+        if (root is not None) and spec.cacheable():
+            if not self._is_ancestor_of(spec.current):
+                cached = root.get_cached_group_rendering(self, child_ops)
+                return [(Opcode.COMPOSITE, cached, mode, opacity)]
+
+        ops = [(Opcode.PUSH, None, None, None)]
+        ops.extend(child_ops)
+        ops.append((Opcode.POP, None, mode, opacity))
         return ops
 
+    def _is_ancestor_of(self, layer):
+        """True if this stack is the layer, or one of its ancestors."""
+        while layer is not None:
+            if layer is self:
+                return True
+            layer = layer.group
+        return False
+
     ## Flood fill
 
     def flood_fill(self, fill_args, dst_layer=None):
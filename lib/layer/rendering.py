@@ -17,6 +17,10 @@ and its "render_*()" methods.
 
 import abc
 
+import numpy as np
+
+import lib.mypaintlib
+
 
 # Public constants:
 
@@ -41,6 +45,12 @@ class Opcode:
     #: Format: (POP, None, modenum, opacity)
     POP = 4
 
+    #: Bookmark: the current layer's ops start after this one.
+    #: Does nothing when rendering, but lets the renderer cache
+    #: everything underneath the current layer as a backdrop.
+    #: Format: (MARK, <LayerBase>, None, None)
+    MARK = 5
+
 
 # Classes and interfaces:
 
@@ -138,3 +148,133 @@ class Renderable:
         See lib.layer.rendering.Opcode for details.
 
         """
+
+
+class RenderProgram (object):
+    """An ops list, compiled for running natively over batches of tiles.
+
+    Interpreting an ops list in Python costs several method calls and
+    context managers per op, per tile. A program does that work once
+    per render: the ops are packed into an array of instructions, and
+    mypaintlib.tile_run_program() runs them over many tiles in one
+    call, with the GIL released.
+
+    The only per-tile Python work left is fetching the source tiles.
+    Sources which are empty at a tile are passed as None, and skipped
+    natively using the same zero-alpha rules as composite_tile().
+    With a tile index, sources it knows to be empty at a tile
+    aren't even asked.
+
+    Every COMPOSITE or BLIT source must provide a method
+    get_readonly_tile(tx, ty, mipmap_level) returning a fix15 tile
+    array that stays valid for the whole render, or None if the
+    source is empty there. MARKs are dropped.
+
+    """
+
+    def __init__(self, insns, sources):
+        """Initialize: use compile() instead."""
+        super(RenderProgram, self).__init__()
+        self._insns = np.array(insns, dtype="float64").reshape((-1, 4))
+        self._sources = list(sources)
+        self._getters = [s.get_readonly_tile for s in sources]
+
+    def __repr__(self):
+        return "<RenderProgram ops=%d sources=%d>" % (
+            len(self._insns),
+            len(self._getters),
+        )
+
+    @classmethod
+    def compile(cls, ops):
+        """Compiles an ops list, if possible.
+
+        :param list ops: ops from Renderable.get_render_ops()
+        :returns: a new program, or None if the ops can't be compiled
+        :rtype: RenderProgram
+
+        Ops lists with unbalanced PUSHes and POPs, and ones with
+        sources not supporting get_readonly_tile(), are left for the
+        caller to interpret in Python.
+
+        """
+        if not hasattr(lib.mypaintlib, "tile_run_program"):
+            return None
+        insns = []
+        sources = []
+        slots = {}  # {id(source): slot}
+        depth = 0
+        for (opcode, opdata, mode, opacity) in ops:
+            slot = 0
+            if opcode in (Opcode.COMPOSITE, Opcode.BLIT):
+                if not hasattr(opdata, "get_readonly_tile"):
+                    return None
+                slot = slots.get(id(opdata))
+                if slot is None:
+                    slot = len(sources)
+                    slots[id(opdata)] = slot
+                    sources.append(opdata)
+            elif opcode == Opcode.PUSH:
+                depth += 1
+            elif opcode == Opcode.POP:
+                depth -= 1
+                if depth < 0:
+                    return None
+            elif opcode == Opcode.MARK:
+                continue
+            else:
+                return None
+            if mode is None:
+                mode = lib.mypaintlib.CombineNormal
+            if opacity is None:
+                opacity = 1.0
+            insns.append((opcode, slot, mode, opacity))
+        if depth != 0:
+            return None
+        return cls(insns, sources)
+
+    def run(self, dsts, dst_has_alpha, tiles, mipmap_level, index=None):
+        """Renders a batch of tiles.
+
+        :param list dsts: fix15 C-contiguous tile arrays to render into
+        :param bool dst_has_alpha: whether the dsts have alpha
+        :param list tiles: the (tx, ty) to render, one per dst
+        :param int mipmap_level: mipmap level of the tiles
+        :param lib.tileindex.TileIndex index: skips empty sources
+
+        Like RootLayerStack._process_ops_list(), the program renders
+        on top of whatever is in the dsts already.
+
+        """
+        getters = self._getters
+        indexed = {}  # {source: slot}
+        if index is not None:
+            for slot, source in enumerate(self._sources):
+                if index.tracks(source):
+                    indexed[source] = slot
+        if not indexed:
+            srcs = [
+                [get(tx, ty, mipmap_level) for get in getters]
+                for (tx, ty) in tiles
+            ]
+        else:
+            unindexed = [
+                (slot, get) for (slot, get) in enumerate(getters)
+                if self._sources[slot] not in indexed
+            ]
+            nslots = len(getters)
+            srcs = []
+            for (tx, ty) in tiles:
+                tile_srcs = [None] * nslots
+                for (slot, get) in unindexed:
+                    tile_srcs[slot] = get(tx, ty, mipmap_level)
+                for source in index.get_surfaces_at(tx, ty, mipmap_level):
+                    slot = indexed.get(source)
+                    if slot is not None:
+                        tile_srcs[slot] = getters[slot](tx, ty, mipmap_level)
+                srcs.append(tile_srcs)
+        lib.mypaintlib.tile_run_program(
+            self._insns,
+            srcs, list(dsts),
+            bool(dst_has_alpha),
+        )
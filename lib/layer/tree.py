@@ -22,6 +22,9 @@ from copy import deepcopy
 import os.path
 from warnings import warn
 import contextlib
+import functools
+import time
+import weakref
 
 from gi.repository import GdkPixbuf
 from gi.repository import GLib
@@ -33,10 +36,13 @@ import lib.mypaintlib
 import lib.tiledsurface as tiledsurface
 from lib.tiledsurface import TileAccessible
 from lib.tiledsurface import TileBlittable
+from lib.tiledsurface import TileCompositable
 import lib.helpers as helpers
 from lib.observable import event
 import lib.pixbuf
 import lib.cache
+import lib.workers
+import lib.tileindex
 from lib.modes import PASS_THROUGH_MODE
 from lib.modes import MODES_DECREASING_BACKDROP_ALPHA
 from . import data
@@ -111,21 +117,64 @@ class RootLayerStack (group.LayerStack):
     INITIAL_MODE = lib.mypaintlib.CombineNormal
     PERMITTED_MODES = {INITIAL_MODE}
 
+    #: Batches smaller than (workers * this) are rendered serially.
+    _RENDER_MIN_TILES_PER_WORKER = 4
+
+    #: Max tiles per native call when running compiled render programs.
+    _RENDER_PROGRAM_BATCH_TILES = 16
+
+    #: Mipmap tiles regenerated per idle callback, ahead of rendering.
+    _REMIPMAP_TILES_PER_CALLBACK = 256
+
+    #: Quiet period after the last change before regenerating mipmaps.
+    _REMIPMAP_DELAY = 250
+
+    #: Milliseconds between layer thumbnail updates.
+    _RETHUMB_INTERVAL = 100
+
+    #: Seconds of thumbnail updating allowed per update, at most.
+    _RETHUMB_TIME_BUDGET = 0.01
+
+    #: Changed areas tracked per layer before they're merged into one.
+    _RETHUMB_MAX_RECTS = 64
+
+    #: Size of one cached 8bpc RGBA tile, for sizing the render cache.
+    _RENDER_CACHE_TILE_BYTES = tiledsurface.N * tiledsurface.N * 4
+
     ## Initialization
 
     def __init__(self, doc=None,
                  cache_size=lib.cache.DEFAULT_CACHE_SIZE,
+                 render_workers=1,
                  **kwargs):
         """Construct, as part of a model
 
         :param doc: The model document. May be None for testing.
         :type doc: lib.document.Document
-        :param cache_size: size of the layer render cache
+        :param cache_size: render cache budget, in 8bpc tiles' worth
         :type cache_size: int
+        :param render_workers: threads for render() (0: automatic)
+        :type render_workers: int
         """
         super(RootLayerStack, self).__init__(**kwargs)
         self.doc = doc
-        self._render_cache = lib.cache.LRUCache(capacity=cache_size)
+        self._render_cache = lib.cache.TileCache(
+            capacity=int(cache_size) * self._RENDER_CACHE_TILE_BYTES,
+        )
+        # Intermediate fix15 composites: one quarter of the budget each.
+        self._group_cache = lib.cache.TileCache(
+            capacity=int(cache_size) * self._RENDER_CACHE_TILE_BYTES // 4,
+        )
+        self._backdrop_cache = lib.cache.TileCache(
+            capacity=int(cache_size) * self._RENDER_CACHE_TILE_BYTES // 4,
+        )
+        self._render_workers = lib.workers.normalize_num_workers(
+            render_workers,
+        )
+        self._render_pool = None
+        # Which layers have data at each tile
+        self._tile_index = lib.tileindex.TileIndex()
+        self._tile_index_tracking = False
         # Background
         default_bg = (255, 255, 255)
         self._default_background = default_bg
@@ -142,35 +191,48 @@ class RootLayerStack (group.LayerStack):
         self._current_layer_previewing = False
         # Current layer
         self._current_path = ()
+        # Path lookup index, rebuilt on demand after the tree changes
+        self._layer_paths = None  # {layer: path}
+        self._path_layers = None  # {path: layer}
         # Temporary overlay for the current layer
         self._current_layer_overlay = None
+        # Flattened stand-in for layers which haven't loaded yet
+        self._lazy_preview = None
         # Self-observation
         self.layer_content_changed += self._render_cache_clear_area
         self.layer_properties_changed += self._render_cache_clear
         self.layer_deleted += self._render_cache_clear
         self.layer_inserted += self._render_cache_clear
+        self.layer_content_changed += self._composite_caches_clear_area
+        self.layer_deleted += self._composite_caches_clear
+        self.layer_inserted += self._composite_caches_clear
+        self.current_path_updated += self._backdrop_cache_clear
+        self.layer_content_changed += self._lazy_preview_discard_area
+        self.layer_properties_changed += self._lazy_preview_discard
+        self.layer_deleted += self._lazy_preview_discard
+        self.layer_inserted += self._lazy_preview_discard
+        self.background_changed += self._lazy_preview_discard
+        self.layer_content_changed += self._tile_index_update_area
+        self.layer_deleted += self._tile_index_reset
+        self.layer_inserted += self._tile_index_reset
         # Layer thumbnail updates
         self.layer_content_changed += self._mark_layer_for_rethumb
         self._rethumb_layers = []
+        self._rethumb_dirty = {}  # {layer: [(x, y, w, h)] or None}
         self._rethumb_layers_timer_id = None
+        self._thumbnails = weakref.WeakKeyDictionary()  # {layer: _Thumb..}
+        # Mipmap regeneration ahead of zoomed-out rendering
+        self.layer_content_changed += self._mark_layer_for_remipmap
+        self._remipmap_layers = []
+        self._remipmap_source_id = None
 
     # Render cache management:
 
     def _render_cache_get(self, key1, key2):
-        try:
-            cache2 = self._render_cache[key1]
-            return cache2[key2]
-        except KeyError:
-            pass
-        return None
+        return self._render_cache.get(key1, key2)
 
     def _render_cache_set(self, key1, key2, data):
-        try:
-            cache2 = self._render_cache[key1]
-        except KeyError:
-            cache2 = dict()  # it'll have ~MAX_MIPMAP_LEVEL items
-            self._render_cache[key1] = cache2
-        cache2[key2] = data
+        self._render_cache.set(key1, key2, data)
 
     def _render_cache_clear_area(self, root, layer, x, y, w, h):
         """Clears rendered tiles from the cache in a specific area."""
@@ -180,23 +242,24 @@ class RootLayerStack (group.LayerStack):
             return
 
         n = lib.mypaintlib.TILE_SIZE
-        tx_min = x // n
-        tx_max = ((x + w) // n)
-        ty_min = y // n
-        ty_max = ((y + h) // n)
-        mipmap_level_max = lib.mypaintlib.MAX_MIPMAP_LEVEL
-
-        for tx in range(tx_min, tx_max + 1):
-            for ty in range(ty_min, ty_max + 1):
-                for level in range(0, mipmap_level_max + 1):
-                    fac = 2 ** level
-                    key = ((tx // fac), (ty // fac), level)
-                    self._render_cache.pop(key, None)
+        self._render_cache.invalidate_area(
+            x // n, y // n,
+            (x + w) // n, (y + h) // n,
+        )
 
     def _render_cache_clear(self, *_ignored):
         """Clears all rendered tiles from the cache."""
         self._render_cache.clear()
 
+    def get_render_cache_stats(self):
+        """Get the render cache's counters, for debugging and tests.
+
+        :returns: see lib.cache.TileCache.stats()
+        :rtype: dict
+
+        """
+        return self._render_cache.stats()
+
     # Global ops:
 
     def clear(self):
@@ -204,7 +267,9 @@ class RootLayerStack (group.LayerStack):
         super(RootLayerStack, self).clear()
         self.set_background(self._default_background)
         self.current_path = ()
+        self._lazy_preview = None
         self._render_cache_clear()
+        self._composite_caches_clear()
 
     def ensure_populated(self, layer_class=None):
         """Ensures that the stack is non-empty by making a new layer if needed
@@ -276,6 +341,40 @@ class RootLayerStack (group.LayerStack):
         """Returns the set of unique names of all descendents"""
         return set((l.name for l in self.deepiter()))
 
+    def get_bbox(self):
+        """Returns the inherent (data) bounding box of the whole tree
+
+        Surface-backed layers' bboxes come from the tile index,
+        so this doesn't need to scan every layer's tiles.
+
+        """
+        index = self._get_tile_index()
+        result = helpers.Rect()
+        for layer in self.deepiter():
+            if isinstance(layer, group.LayerStack):
+                continue
+            surface = getattr(layer, "_surface", None)
+            if index.tracks(surface):
+                bbox = index.get_bbox(surface)
+            else:
+                bbox = layer.get_bbox()
+            result.expandToIncludeRect(bbox)
+        return result
+
+    def get_tile_coords(self):
+        """Returns all data tiles of all layers in the tree"""
+        index = self._get_tile_index()
+        tiles = set()
+        for layer in self.deepiter():
+            if isinstance(layer, group.LayerStack):
+                continue
+            surface = getattr(layer, "_surface", None)
+            if index.tracks(surface):
+                tiles.update(index.get_tile_coords(surface))
+            else:
+                tiles.update(layer.get_tile_coords())
+        return tiles
+
     ## Rendering: root stack API
 
     def _get_render_background(self, spec):
@@ -426,6 +525,10 @@ class RootLayerStack (group.LayerStack):
         This API may evolve to use only the "spec" argument rather than
         the explicit overlay etc.
 
+        Large batches are split across a pool of worker threads
+        if the "render_workers" property is greater than 1.
+        Progress is still reported from the calling thread.
+
         """
         if progress is None:
             progress = lib.feedback.Progress()
@@ -441,6 +544,7 @@ class RootLayerStack (group.LayerStack):
 
         if spec is None:
             spec = self._get_render_spec()
+            spec.current_overlay = self._current_layer_overlay
         if overlay is not None:
             spec.global_overlay = overlay
         if background is not None:
@@ -448,6 +552,7 @@ class RootLayerStack (group.LayerStack):
 
         dst_has_alpha = not self.get_render_is_opaque(spec=spec)
         ops = self.get_render_ops(spec)
+        self._get_tile_index()  # update it here, not in the workers
 
         target_surface_is_8bpc = False
         use_cache = False
@@ -458,91 +563,278 @@ class RootLayerStack (group.LayerStack):
                 use_cache = spec.cacheable()
         key2 = (id(opaque_base_tile), dst_has_alpha)
 
+        # Everything underneath the current layer can be cached as a
+        # fix15 backdrop, for quick redraws while it's being painted.
+        # Each part is compiled separately, if it can be.
+        backdrop = None
+        program = None
+        if spec.cacheable() and (spec.current is not None):
+            split = self._split_ops_at_mark(ops)
+            if split is not None:
+                bd_key2 = (id(spec.current), dst_has_alpha)
+                backdrop = split + (bd_key2,) + tuple(
+                    rendering.RenderProgram.compile(part)
+                    for part in split
+                )
+        if backdrop is None:
+            program = rendering.RenderProgram.compile(ops)
+
+        # Compiled programs render 8bpc targets in batches of tiles,
+        # with one native call per batch.
+        pool = self._get_render_pool(len(tiles))
+        if (program is not None) and target_surface_is_8bpc:
+            render_batch = functools.partial(
+                self._render_tile_batch,
+                surface, program, mipmap_level, opaque_base_tile, filter,
+                dst_has_alpha, use_cache, key2,
+            )
+            batch_size = self._RENDER_PROGRAM_BATCH_TILES
+            if pool is not None:
+                per_worker = -(-len(tiles) // pool.num_workers)
+                batch_size = max(1, min(batch_size, per_worker))
+            batches = [
+                tuple(tiles[i:i+batch_size])
+                for i in xrange(0, len(tiles), batch_size)
+            ]
+            if pool is None:
+                for batch in batches:
+                    render_batch(batch)
+                    progress += len(batch)
+            else:
+                for batch in pool.map_unordered(render_batch, batches):
+                    progress += len(batch)
+            progress.close()
+            return
+
         # Rendering loop.
-        # Keep this as tight as possible, and consider C++ parallelization.
+        # Keep the per-tile body as tight as possible. The heavy tile
+        # ops release the GIL, so large batches can be spread across
+        # a pool of worker threads.
+        render_tile = functools.partial(
+            self._render_tile,
+            surface, ops, program, backdrop, mipmap_level,
+            opaque_base_tile, filter,
+            dst_has_alpha, target_surface_is_8bpc, use_cache, key2,
+        )
+        if pool is None:
+            for tx, ty in tiles:
+                render_tile((tx, ty))
+                progress += 1
+        else:
+            for tx, ty in pool.map_unordered(render_tile, tiles):
+                progress += 1
+        progress.close()
+
+    def _render_tile_batch(self, surface, program, mipmap_level,
+                           opaque_base_tile, filter, dst_has_alpha,
+                           use_cache, key2, tiles):
+        """Render a batch of tiles into an 8bpc target: see render().
+
+        This may be called from a worker thread. Cache misses are
+        rendered to fix15 scratch tiles with one run of the compiled
+        program, then converted into the target.
+
+        """
         tiledims = (tiledsurface.N, tiledsurface.N, 4)
-        dst_has_alpha_orig = dst_has_alpha
-        for tx, ty in tiles:
-            dst_8bpc_orig = None
-            dst_has_alpha = dst_has_alpha_orig
-            key1 = (tx, ty, mipmap_level)
-            cache_hit = False
-
-            with surface.tile_request(tx, ty, readonly=False) as dst:
-
-                # Twirl out any 8bpc target here,
-                # if the render cache is empty for this tile.
-                if target_surface_is_8bpc:
-                    dst_8bpc_orig = dst
-                    dst = None
-                    if use_cache:
-                        dst = self._render_cache_get(key1, key2)
-
-                    if dst is None:
-                        dst = np.zeros(tiledims, dtype='uint16')
-                    else:
-                        cache_hit = True  # note: dtype is now uint8
-
-                if not cache_hit:
-                    # Render to dst.
-                    # dst is a fix15 rgba tile
-
-                    dst_over_opaque_base = None
-                    if dst_has_alpha and opaque_base_tile is not None:
-                        dst_over_opaque_base = dst
-                        lib.mypaintlib.tile_copy_rgba16_into_rgba16(
-                            opaque_base_tile,
-                            dst_over_opaque_base,
+        cached = {}
+        todo_tiles = []
+        todo_dsts = []
+        for (tx, ty) in tiles:
+            if use_cache:
+                rgba8 = self._render_cache_get((tx, ty, mipmap_level), key2)
+                if rgba8 is not None:
+                    cached[(tx, ty)] = rgba8
+                    continue
+            todo_tiles.append((tx, ty))
+            todo_dsts.append(np.zeros(tiledims, dtype='uint16'))
+
+        if todo_tiles:
+            program.run(
+                todo_dsts, dst_has_alpha,
+                todo_tiles, mipmap_level,
+                index=self._get_tile_index(),
+            )
+
+        over_opaque_base = dst_has_alpha and (opaque_base_tile is not None)
+        if dst_has_alpha and not over_opaque_base:
+            conv = lib.mypaintlib.tile_convert_rgba16_to_rgba8
+        else:
+            conv = lib.mypaintlib.tile_convert_rgbu16_to_rgbu8
+        rendered = dict(zip(todo_tiles, todo_dsts))
+        for (tx, ty) in tiles:
+            with surface.tile_request(tx, ty, readonly=False) as dst_8bpc:
+                dst = rendered.get((tx, ty))
+                if dst is None:
+                    # Loaded from the cache, already matching the format.
+                    dst_8bpc[:] = cached[(tx, ty)]
+                else:
+                    if over_opaque_base:
+                        base = opaque_base_tile.copy()
+                        lib.mypaintlib.tile_combine(
+                            lib.mypaintlib.CombineNormal,
+                            dst, base,
+                            False, 1.0,
                         )
-                        dst = np.zeros(tiledims, dtype='uint16')
+                        dst = base
+                    conv(dst, dst_8bpc, eotf())
+                    if use_cache:
+                        key1 = (tx, ty, mipmap_level)
+                        self._render_cache_set(key1, key2, dst_8bpc)
+                if filter is not None:
+                    filter(dst_8bpc)
+
+    def _render_tile(self, surface, ops, program, backdrop, mipmap_level,
+                     opaque_base_tile, filter, dst_has_alpha,
+                     target_surface_is_8bpc, use_cache, key2, tile_coords):
+        """Render one tile of a batch: see render().
+
+        This may be called from a worker thread. Each call uses its own
+        fix15 scratch tiles, and shared state is confined to the target
+        surface's tile (which nobody else is writing) and the render
+        cache, which is thread-safe.
+
+        """
+        tx, ty = tile_coords
+        dst_8bpc_orig = None
+        key1 = (tx, ty, mipmap_level)
+        cache_hit = False
+        tiledims = (tiledsurface.N, tiledsurface.N, 4)
+
+        with surface.tile_request(tx, ty, readonly=False) as dst:
 
-                    # Process the ops list.
+            # Twirl out any 8bpc target here,
+            # if the render cache is empty for this tile.
+            if target_surface_is_8bpc:
+                dst_8bpc_orig = dst
+                dst = None
+                if use_cache:
+                    dst = self._render_cache_get(key1, key2)
+
+                if dst is None:
+                    dst = np.zeros(tiledims, dtype='uint16')
+                else:
+                    cache_hit = True  # note: dtype is now uint8
+
+            if not cache_hit:
+                # Render to dst.
+                # dst is a fix15 rgba tile
+
+                dst_over_opaque_base = None
+                if dst_has_alpha and opaque_base_tile is not None:
+                    dst_over_opaque_base = dst
+                    lib.mypaintlib.tile_copy_rgba16_into_rgba16(
+                        opaque_base_tile,
+                        dst_over_opaque_base,
+                    )
+                    dst = np.zeros(tiledims, dtype='uint16')
+
+                # Process the ops list.
+                if backdrop is not None:
+                    (backdrop_ops, current_ops, bd_key2,
+                     bd_program, current_program) = backdrop
+                    self._process_ops_with_backdrop(
+                        backdrop_ops, current_ops, bd_key2,
+                        bd_program, current_program,
+                        dst, dst_has_alpha,
+                        tx, ty, mipmap_level,
+                    )
+                elif program is not None and dst.flags.c_contiguous:
+                    program.run(
+                        [dst], dst_has_alpha,
+                        [(tx, ty)], mipmap_level,
+                        index=self._get_tile_index(),
+                    )
+                else:
                     self._process_ops_list(
                         ops,
                         dst, dst_has_alpha,
                         tx, ty, mipmap_level,
                     )
 
-                    if dst_over_opaque_base is not None:
-                        dst_has_alpha = False
-                        lib.mypaintlib.tile_combine(
-                            lib.mypaintlib.CombineNormal,
-                            dst, dst_over_opaque_base,
-                            False, 1.0,
-                        )
-                        dst = dst_over_opaque_base
-
-                # If the target tile is fix15 already, we're done.
-                if dst_8bpc_orig is None:
-                    continue
+                if dst_over_opaque_base is not None:
+                    dst_has_alpha = False
+                    lib.mypaintlib.tile_combine(
+                        lib.mypaintlib.CombineNormal,
+                        dst, dst_over_opaque_base,
+                        False, 1.0,
+                    )
+                    dst = dst_over_opaque_base
 
-                # Untwirl into the target 8bpc tile.
-                if not cache_hit:
-                    # Rendering just happened.
-                    # Convert to 8bpc, and maybe store.
-                    if dst_has_alpha:
-                        conv = lib.mypaintlib.tile_convert_rgba16_to_rgba8
-                    else:
-                        conv = lib.mypaintlib.tile_convert_rgbu16_to_rgbu8
-                    conv(dst, dst_8bpc_orig, eotf())
+            # If the target tile is fix15 already, we're done.
+            if dst_8bpc_orig is None:
+                return
 
-                    if use_cache:
-                        self._render_cache_set(key1, key2, dst_8bpc_orig)
+            # Untwirl into the target 8bpc tile.
+            if not cache_hit:
+                # Rendering just happened.
+                # Convert to 8bpc, and maybe store.
+                if dst_has_alpha:
+                    conv = lib.mypaintlib.tile_convert_rgba16_to_rgba8
                 else:
-                    # An already 8pbc dst was loaded from the cache.
-                    # It will match dst_has_alpha already.
-                    dst_8bpc_orig[:] = dst
+                    conv = lib.mypaintlib.tile_convert_rgbu16_to_rgbu8
+                conv(dst, dst_8bpc_orig, eotf())
 
-                dst = dst_8bpc_orig
+                if use_cache:
+                    self._render_cache_set(key1, key2, dst_8bpc_orig)
+            else:
+                # An already 8pbc dst was loaded from the cache.
+                # It will match dst_has_alpha already.
+                dst_8bpc_orig[:] = dst
 
-                # Display filtering only happens when rendering
-                # 8bpc for the screen.
-                if filter is not None:
-                    filter(dst)
+            dst = dst_8bpc_orig
 
-            # end tile_request
-            progress += 1
-        progress.close()
+            # Display filtering only happens when rendering
+            # 8bpc for the screen.
+            if filter is not None:
+                filter(dst)
+
+    def _get_render_pool(self, num_tiles):
+        """Get the worker pool for a batch of tiles, or None for serial.
+
+        Small batches aren't worth the thread handoff overhead,
+        so they are always rendered in the calling thread.
+
+        """
+        workers = self._render_workers
+        if workers <= 1:
+            return None
+        if num_tiles < workers * self._RENDER_MIN_TILES_PER_WORKER:
+            return None
+        if self._render_pool is None:
+            self._render_pool = lib.workers.WorkerPool(
+                num_workers=workers,
+                name="render",
+            )
+        return self._render_pool
+
+    @property
+    def render_workers(self):
+        """Number of worker threads used by render() for big batches.
+
+        Setting this to 1 renders everything serially in the calling
+        thread. A value of 0 or None picks a default based on the number
+        of CPUs available.
+
+        >>> root = RootLayerStack(None, render_workers=1)
+        >>> root.render_workers
+        1
+        >>> root.render_workers = 4
+        >>> root.render_workers
+        4
+
+        """
+        return self._render_workers
+
+    @render_workers.setter
+    def render_workers(self, n):
+        n = lib.workers.normalize_num_workers(n)
+        if n == self._render_workers:
+            return
+        self._render_workers = n
+        pool = self._render_pool
+        self._render_pool = None
+        if pool is not None:
+            pool.shutdown()
 
     def render_layer_preview(self, layer, size=256, bbox=None, **options):
         """Render a standardized thumbnail/preview of a specific layer.
@@ -722,7 +1014,28 @@ class RootLayerStack (group.LayerStack):
         # On the other hand, this is sort of what a parallelized,
         # GIL-holding C++ loop body might look like.
 
-        stack = []
+        stack = [(dst, dst_has_alpha)]
+        RootLayerStack._process_ops(ops, stack, tx, ty, mipmap_level)
+        if len(stack) > 1:
+            raise ValueError(
+                "Ops list contains more PUSH operations "
+                "than POPs. Rendering is incomplete."
+            )
+
+    @staticmethod
+    def _process_ops(ops, stack, tx, ty, mipmap_level):
+        """Process ops, continuing from an isolation stack state.
+
+        :param list ops: The ops to run.
+        :param list stack: [(dst, dst_has_alpha), ...], modified in place.
+
+        The last item in "stack" is the tile being rendered into.
+        Items below it are the backdrops which PUSH ops saved.
+        Running a partial ops list leaves the intermediate state
+        in "stack", ready for the rest of the ops to be run later.
+
+        """
+        (dst, dst_has_alpha) = stack.pop(-1)
         for (opcode, opdata, mode, opacity) in ops:
             if opcode == rendering.Opcode.COMPOSITE:
                 opdata.composite_tile(
@@ -748,17 +1061,227 @@ class RootLayerStack (group.LayerStack):
                     src, dst, dst_has_alpha,
                     opacity,
                 )
+            elif opcode == rendering.Opcode.MARK:
+                pass
             else:
                 raise RuntimeError(
                     "Unknown lib.layer.rendering.Opcode: %r",
                     opcode,
                 )
-        if len(stack) > 0:
+        stack.append((dst, dst_has_alpha))
+
+    def _process_ops_with_backdrop(self, backdrop_ops, ops, key2,
+                                   backdrop_program, program,
+                                   dst, dst_has_alpha,
+                                   tx, ty, mipmap_level):
+        """Render a tile, using or filling the backdrop cache.
+
+        :param list backdrop_ops: ops for everything below the current layer
+        :param list ops: the remaining ops
+        :param key2: variant key for the backdrop cache
+        :param backdrop_program: compiled backdrop_ops, or None
+        :param program: compiled ops, or None
+
+        The isolation stack state after running "backdrop_ops" is cached
+        as a tuple of fix15 tiles. Edits to the current layer don't
+        invalidate it, so redraws while painting only need to run the
+        ops for the current layer and the layers above it.
+
+        """
+        key1 = (tx, ty, mipmap_level)
+        state = self._backdrop_cache.get(key1, key2)
+        if state is None:
+            stack = [(dst, dst_has_alpha)]
+            if backdrop_program is not None:
+                backdrop_program.run(
+                    [dst], dst_has_alpha,
+                    [(tx, ty)], mipmap_level,
+                    index=self._get_tile_index(),
+                )
+            else:
+                self._process_ops(backdrop_ops, stack, tx, ty, mipmap_level)
+            state = tuple((t.copy(), a) for (t, a) in stack)
+            nbytes = sum(t.nbytes for (t, a) in state)
+            self._backdrop_cache.set(key1, key2, state, nbytes=nbytes)
+        else:
+            stack = []
+            for (tile, tile_has_alpha) in state:
+                if not stack:
+                    lib.mypaintlib.tile_copy_rgba16_into_rgba16(tile, dst)
+                    stack.append((dst, tile_has_alpha))
+                else:
+                    stack.append((tile.copy(), tile_has_alpha))
+        if program is not None and len(stack) == 1:
+            program.run(
+                [dst], dst_has_alpha,
+                [(tx, ty)], mipmap_level,
+                index=self._get_tile_index(),
+            )
+            return
+        self._process_ops(ops, stack, tx, ty, mipmap_level)
+        if len(stack) > 1:
             raise ValueError(
                 "Ops list contains more PUSH operations "
                 "than POPs. Rendering is incomplete."
             )
 
+    @staticmethod
+    def _split_ops_at_mark(ops):
+        """Split an ops list at its MARK, for backdrop caching.
+
+        :returns: (backdrop_ops, remaining_ops), or None
+        :rtype: tuple
+
+        The split is only worth making if there's at least
+        some real work to do in the backdrop part.
+
+        """
+        for i, op in enumerate(ops):
+            if op[0] == rendering.Opcode.MARK:
+                break
+        else:
+            return None
+        if i < 2:
+            return None
+        return (ops[:i], ops[i+1:])
+
+    ## Per-group and backdrop composite caches
+
+    def get_cached_group_rendering(self, group, child_ops):
+        """Get a compositable, cached rendering of an isolated group.
+
+        :param LayerStack group: A group within this tree.
+        :param list child_ops: Render ops for its children.
+        :rtype: TileCompositable
+
+        This is used by isolated LayerStacks to render themselves via a
+        cache of their fix15 composited tiles.  Content changes inside
+        the group invalidate only the affected areas of its cache.
+
+        """
+        return _CachedGroupRendering(self, group, child_ops)
+
+    def _composite_caches_clear_area(self, root, layer, x, y, w, h):
+        """Invalidate the per-group and backdrop caches in an area."""
+        if (w <= 0) or (h <= 0):
+            self._composite_caches_clear()
+            return
+        n = lib.mypaintlib.TILE_SIZE
+        tile_bbox = (x // n, y // n, (x + w) // n, (y + h) // n)
+
+        # Groups caching the changed layer's pixels, and any group which
+        # changed (e.g. by insertion or removal of child layers).
+        if isinstance(layer, group.LayerStack):
+            parent = layer
+        else:
+            parent = layer.group
+        while (parent is not None) and (parent is not self):
+            self._group_cache.invalidate_area(*tile_bbox, key2=id(parent))
+            parent = parent.group
+
+        # Edits to the current layer itself don't affect its backdrop.
+        current = self.current
+        while layer is not None:
+            if layer is current:
+                return
+            layer = layer.group
+        self._backdrop_cache.invalidate_area(*tile_bbox)
+
+    def _composite_caches_clear(self, *_ignored):
+        """Clears the per-group and backdrop caches completely."""
+        self._group_cache.clear()
+        self._backdrop_cache.clear()
+
+    def _backdrop_cache_clear(self, *_ignored):
+        """Clears just the backdrop cache."""
+        self._backdrop_cache.clear()
+
+    # Index of which layers have data at each tile:
+
+    def _get_tile_index(self):
+        """Get the tile index, tracking the tree's current surfaces.
+
+        :rtype: lib.tileindex.TileIndex
+
+        The index holds the surfaces of all surface-backed layers in
+        the tree, so rendering and other whole-tree operations can
+        skip layers which have no data at a tile.
+
+        """
+        index = self._tile_index
+        if not self._tile_index_tracking:
+            surfaces = [
+                l._surface for l in self.deepiter()
+                if isinstance(l, data.SurfaceBackedLayer)
+            ]
+            index.track(surfaces)
+            for surface in surfaces:
+                index.tracks(surface)  # index now, not in render workers
+            self._tile_index_tracking = True
+        return index
+
+    def _tile_index_update_area(self, root, layer, *args):
+        """Keep the tile index up to date as layers change."""
+        if layer is self:
+            return  # background, overlays, or viewing modes
+        index = self._tile_index
+        if isinstance(layer, data.SurfaceBackedLayer):
+            if len(args) == 4:
+                index.update_area(layer._surface, *args)
+            else:
+                index.invalidate(layer._surface)
+        elif isinstance(layer, group.LayerStack):
+            queue = list(layer)
+            while queue:
+                sublayer = queue.pop()
+                if isinstance(sublayer, data.SurfaceBackedLayer):
+                    index.invalidate(sublayer._surface)
+                elif isinstance(sublayer, group.LayerStack):
+                    queue.extend(sublayer)
+
+    def _tile_index_reset(self, *_ignored):
+        """Re-index everything after layers are added or removed."""
+        self._tile_index.invalidate_all()
+        self._tile_index_tracking = False
+
+    # Stand-in rendering while layers are being lazy-loaded:
+
+    @property
+    def lazy_preview(self):
+        """Flattened image shown instead of the layers, or None.
+
+        While layers are still being loaded in the background, a
+        flattened rendering of the document (e.g. an OpenRaster file's
+        mergedimage.png) can be shown instead of them, when rendering
+        the normal document view. It must include the background.
+
+        The preview is discarded automatically if any layer or the
+        background changes, and setting this property triggers a full
+        redraw.
+
+        """
+        return self._lazy_preview
+
+    @lazy_preview.setter
+    def lazy_preview(self, surface):
+        if surface is self._lazy_preview:
+            return
+        self._lazy_preview = surface
+        self._render_cache_clear()
+        self._composite_caches_clear()
+        self.layer_content_changed(self, 0, 0, 0, 0)
+
+    def _lazy_preview_discard(self, *_ignored):
+        """Drops any lazy-loading preview when the layers change."""
+        if self._lazy_preview is not None:
+            self.lazy_preview = None
+
+    def _lazy_preview_discard_area(self, root, layer, *_ignored):
+        """Drops any lazy-loading preview when a layer's pixels change."""
+        if layer is self:
+            return  # background, overlays, or the preview's own redraw
+        self._lazy_preview_discard()
+
     ## Renderable implementation
 
     def get_render_ops(self, spec):
@@ -768,7 +1291,16 @@ class RootLayerStack (group.LayerStack):
             bg_opcode = rendering.Opcode.BLIT
             bg_surf = self._background_layer._surface
             ops.append((bg_opcode, bg_surf, None, None))
+            preview = self._lazy_preview
+            if (preview is not None) and spec.cacheable():
+                ops.append((
+                    rendering.Opcode.COMPOSITE, preview,
+                    lib.mypaintlib.CombineNormal, 1.0,
+                ))
+                return ops
         for child_layer in reversed(self):
+            if child_layer is spec.current:
+                ops.append((rendering.Opcode.MARK, child_layer, None, None))
             ops.extend(child_layer.get_render_ops(spec))
         if spec.global_overlay is not None:
             ops.extend(spec.global_overlay.get_render_ops(spec))
@@ -1654,6 +2186,10 @@ class RootLayerStack (group.LayerStack):
             return default
         if len(path) == 0:
             return self
+        layer = self._get_path_index()[1].get(tuple(path))
+        if layer is not None:
+            return layer
+        # Negative indices, or no such layer
         unused_path = list(path)
         layer = self
         while len(unused_path) > 0:
@@ -1797,10 +2333,47 @@ class RootLayerStack (group.LayerStack):
         """
         if layer is self:
             return ()
-        for path, ly in self.walk():
-            if ly is layer:
-                return tuple(path)
-        return None
+        return self._get_path_index()[0].get(layer)
+
+    def _get_path_index(self):
+        """Get the path lookup index, rebuilding it if needed (internal)
+
+        :returns: ``({layer: path}, {path: layer})``
+        :rtype: tuple
+
+        The index is valid until the tree's structure next changes.
+        See _notify_layer_inserted() and _notify_layer_deleted().
+
+        >>> from . import test
+        >>> stack, leaves = test.make_test_stack()
+        >>> paths, layers = stack._get_path_index()
+        >>> paths[leaves[4]]
+        (1, 1)
+        >>> layers[(1, 1)] is leaves[4]
+        True
+        >>> stack.deepremove(stack.deepget([0]))
+        >>> stack._layer_paths is None
+        True
+        >>> stack.deepindex(leaves[4])
+        (0, 1)
+        >>> stack.deepindex(leaves[0]) is None
+        True
+
+        """
+        if self._layer_paths is None:
+            paths = {}
+            layers = {}
+            for path, layer in self.walk():
+                paths[layer] = path
+                layers[path] = layer
+            self._path_layers = layers
+            self._layer_paths = paths
+        return (self._layer_paths, self._path_layers)
+
+    def _path_index_invalidate(self):
+        """Forget the path lookup index after a tree change (internal)"""
+        self._layer_paths = None
+        self._path_layers = None
 
     ## Convenience methods for commands
 
@@ -2596,6 +3169,7 @@ class RootLayerStack (group.LayerStack):
     def _notify_layer_deleted(self, parent, oldchild, oldindex):
         assert parent.root is self
         assert oldchild.root is not self
+        self._path_index_invalidate()
         path = self.deepindex(parent)
         if path is None:  # e.g. layers within current_layer_overlay
             return
@@ -2609,6 +3183,15 @@ class RootLayerStack (group.LayerStack):
     def _notify_layer_inserted(self, parent, newchild, newindex):
         assert parent.root is self
         assert newchild.root is self
+        # The descendents of an inserted stack are announced after it,
+        # from an index which was rebuilt for the stack and which
+        # already has them in the right place.
+        paths = self._layer_paths
+        if paths is not None:
+            parent_path = (parent is self) and () or paths.get(parent)
+            path = paths.get(newchild)
+            if parent_path is None or path != parent_path + (newindex,):
+                self._path_index_invalidate()
         path = self.deepindex(newchild)
         if path is None:  # e.g. layers within current_layer_overlay
             return
@@ -2629,52 +3212,170 @@ class RootLayerStack (group.LayerStack):
         """Snapshots the state of the layer, for undo purposes"""
         return RootLayerStackSnapshot(self)
 
+    ## Mipmap regeneration in the background
+
+    def _mark_layer_for_remipmap(self, root, layer, *_ignored):
+        """Queue a changed layer's dirty mipmaps for regeneration.
+
+        Regeneration starts once things have been quiet for a moment,
+        so it doesn't compete with painting. See also
+        lib.tiledsurface.MyPaintSurface.regenerate_mipmaps().
+
+        """
+        if not isinstance(layer, data.SurfaceBackedLayer):
+            return
+        if layer not in self._remipmap_layers:
+            self._remipmap_layers.append(layer)
+        self._restart_remipmap_timer()
+
+    def _restart_remipmap_timer(self):
+        source_id = self._remipmap_source_id
+        if source_id is not None:
+            GLib.source_remove(source_id)
+        self._remipmap_source_id = GLib.timeout_add(
+            priority=GLib.PRIORITY_LOW,
+            interval=self._REMIPMAP_DELAY,
+            function=self._remipmap_timer_cb,
+        )
+
+    def _remipmap_timer_cb(self):
+        """Quiet period over: regenerate in idle time from now on."""
+        self._remipmap_source_id = GLib.idle_add(
+            self._remipmap_idle_cb,
+            priority=GLib.PRIORITY_LOW,
+        )
+        return False
+
+    def _remipmap_idle_cb(self):
+        while self._remipmap_layers:
+            layer = self._remipmap_layers[-1]
+            if layer.root is self:
+                more = layer._surface.regenerate_mipmaps(
+                    max_tiles=self._REMIPMAP_TILES_PER_CALLBACK,
+                )
+                if more:
+                    return True
+            self._remipmap_layers.pop(-1)
+            return True
+        self._remipmap_source_id = None
+        return False
+
     ## Layer preview thumbnails
 
     def _mark_all_layers_for_rethumb(self):
         self._rethumb_layers[:] = []
+        self._rethumb_dirty.clear()
         for path, layer in self.walk():
             self._rethumb_layers.append(layer)
-        self._restart_rethumb_timer()
+            self._rethumb_dirty[layer] = None
+        self._start_rethumb_timer()
 
-    def _mark_layer_for_rethumb(self, root, layer, *_ignored):
-        if layer not in self._rethumb_layers:
-            self._rethumb_layers.append(layer)
-        self._restart_rethumb_timer()
+    def _mark_layer_for_rethumb(self, root, layer, *args):
+        """Queue a changed layer's thumbnail, and its parents', for update
 
-    def _restart_rethumb_timer(self):
-        timer_id = self._rethumb_layers_timer_id
-        if timer_id is not None:
-            GLib.source_remove(timer_id)
+        Only the changed area is recorded, so that the update can just
+        patch the thumbnail there.
+
+        """
+        path = self.deepindex(layer)
+        if not path:
+            return
+        rect = None
+        if len(args) == 4 and args[2] > 0 and args[3] > 0:
+            rect = tuple(int(n) for n in args)
+        # Parents are queued first, so they're updated after the layer.
+        layers = [self.deepget(path[:i]) for i in xrange(1, len(path))]
+        layers.append(layer)
+        for queued in layers:
+            if queued not in self._rethumb_dirty:
+                self._rethumb_layers.append(queued)
+                self._rethumb_dirty[queued] = []
+            rects = self._rethumb_dirty[queued]
+            if rects is None:
+                continue
+            if rect is None:
+                self._rethumb_dirty[queued] = None
+                continue
+            rects.append(rect)
+            if len(rects) > self._RETHUMB_MAX_RECTS:
+                bbox = helpers.Rect()
+                for r in rects:
+                    bbox.expandToIncludeRect(helpers.Rect(*r))
+                rects[:] = [tuple(bbox)]
+        self._start_rethumb_timer()
+
+    def _start_rethumb_timer(self):
+        """Starts updating thumbnails periodically, if not already"""
+        if self._rethumb_layers_timer_id is not None:
+            return
         timer_id = GLib.timeout_add(
             priority=GLib.PRIORITY_LOW,
-            interval=100,
+            interval=self._RETHUMB_INTERVAL,
             function=self._rethumb_layers_timer_cb,
         )
         self._rethumb_layers_timer_id = timer_id
 
     def _rethumb_layers_timer_cb(self):
-        if len(self._rethumb_layers) >= 1:
+        """Update queued thumbnails within a small time budget
+
+        Thumbnails are kept up to date during painting, but only a
+        little work is done per tick.
+
+        """
+        t0 = time.time()
+        while self._rethumb_layers:
             layer0 = self._rethumb_layers.pop(-1)
+            dirty = self._rethumb_dirty.pop(layer0, None)
             path0 = self.deepindex(layer0)
             if not path0:
-                return True
-            layer0.update_thumbnail()
+                continue
+            layer0.update_thumbnail(dirty)
             self.layer_thumbnail_updated(path0, layer0)
-            # Queue parent layers too
-            path = path0[:-1]
-            parents = []
-            while len(path) > 0:
-                layer = self.deepget(path)
-                if layer not in self._rethumb_layers:
-                    parents.append(layer)
-                path = path[:-1]
-            self._rethumb_layers.extend(reversed(parents))
-            return True
+            if time.time() - t0 > self._RETHUMB_TIME_BUDGET:
+                return True
         # Stop the timer when there is nothing more to be done.
         self._rethumb_layers_timer_id = None
         return False
 
+    def update_layer_thumbnail(self, layer, dirty=None, size=256,
+                               **options):
+        """Updates a layer's persistent thumbnail rendering
+
+        :param lib.layer.core.LayerBase layer: The layer to preview.
+        :param list dirty: model rects changed since the last update,
+            or None if anything may have changed.
+        :param int size: Size of the output pixbuf.
+        :param **options: Passed to render().
+        :rtype: GdkPixbuf.Pixbuf
+
+        This is like render_layer_preview() for the layer's data bbox,
+        but the unscaled, mipmap-level rendering is kept between calls.
+        Only the tiles in the dirty rects, and tiles new to the bbox,
+        are rendered again. The result is scaled to size at the end.
+
+        """
+        bbox = self._validate_layer_bbox_arg(layer, None)
+        thumb = self._thumbnails.get(layer)
+        if thumb is not None and thumb.size != size:
+            thumb = None
+        if thumb is None:
+            thumb = _LayerThumbnail(bbox, size)
+            tiles = thumb.get_tiles()
+        elif thumb.bbox != bbox:
+            old_thumb = thumb
+            thumb = _LayerThumbnail(bbox, size)
+            tiles = thumb.adopt_tiles(old_thumb, dirty)
+        else:
+            tiles = thumb.get_dirty_tiles(dirty)
+        self._thumbnails[layer] = thumb
+        if tiles:
+            spec = self._get_render_spec_for_layer(layer)
+            self.render(
+                thumb.surface, sorted(tiles), thumb.mipmap_level,
+                spec=spec, **options
+            )
+        return thumb.get_pixbuf()
+
     @event
     def layer_thumbnail_updated(self, path, layer):
         """Event: a layer thumbnail was updated.
@@ -2726,6 +3427,7 @@ class _TileRenderWrapper (TileAccessible, TileBlittable):
         self._root = root
         self._spec = spec
         self._ops = root.get_render_ops(spec)
+        self._program = rendering.RenderProgram.compile(self._ops)
         self._use_cache = bool(use_cache)
         self._cache = {}
 
@@ -2736,6 +3438,19 @@ class _TileRenderWrapper (TileAccessible, TileBlittable):
         else:
             self._visible_layers = list(root.deepiter(visible=True))
 
+        # Emptiness tests use the root's tile index where possible.
+        self._index = root._get_tile_index()
+        self._indexed_surfaces = set()
+        self._unindexed_layers = []
+        for layer in self._visible_layers:
+            if isinstance(layer, group.LayerStack):
+                continue
+            surface = getattr(layer, "_surface", None)
+            if self._index.tracks(surface):
+                self._indexed_surfaces.add(surface)
+            else:
+                self._unindexed_layers.append(layer)
+
     @contextlib.contextmanager
     def tile_request(self, tx, ty, readonly):
         """Context manager that fetches a single tile as fix15 RGBA data.
@@ -2760,19 +3475,29 @@ class _TileRenderWrapper (TileAccessible, TileBlittable):
             else:
                 tiledims = (tiledsurface.N, tiledsurface.N, 4)
                 dst = np.zeros(tiledims, 'uint16')
-                self._root.render_single_tile(
-                    dst, True,
-                    tx, ty, 0,
-                    ops=self._ops,
-                )
+                if self._program is not None:
+                    self._program.run(
+                        [dst], True,
+                        [(tx, ty)], 0,
+                        index=self._index,
+                    )
+                else:
+                    self._root.render_single_tile(
+                        dst, True,
+                        tx, ty, 0,
+                        ops=self._ops,
+                    )
             if self._use_cache:
                 self._cache[(tx, ty)] = dst
         yield dst
 
     def _all_empty(self, tx, ty):
         """Check that no tile exists at (tx, ty) in any visible layer"""
+        surfaces_here = self._index.get_surfaces_at(tx, ty)
+        if not self._indexed_surfaces.isdisjoint(surfaces_here):
+            return False
         tc = (tx, ty)
-        for layer in self._visible_layers:
+        for layer in self._unindexed_layers:
             if tc in layer.get_tile_coords():
                 return False
         return True
@@ -2797,6 +3522,158 @@ class _TileRenderWrapper (TileAccessible, TileBlittable):
         return getattr(self._root, attr)
 
 
+class _CachedGroupRendering (TileCompositable):
+    """Compositable rendering of an isolated group, via the root's cache.
+
+    Instances are made fresh for each get_render_ops() call,
+    but the cached tiles belong to the root stack, and are keyed
+    by the group's identity. They're invalidated by the root when
+    anything inside the group changes.
+
+    """
+
+    def __init__(self, root, group, child_ops):
+        super(_CachedGroupRendering, self).__init__()
+        self._root = root
+        self._group = group
+        self._key2 = id(group)
+        self._ops = child_ops
+        self._program = rendering.RenderProgram.compile(child_ops)
+
+    def get_bbox(self):
+        """The group's data bbox."""
+        return self._group.get_bbox()
+
+    def get_readonly_tile(self, tx, ty, mipmap_level=0):
+        """The group's isolated rendering of a tile, as fix15 data.
+
+        Tiles missing from the cache are rendered and cached first.
+        The returned array must not be modified.
+
+        """
+        cache = self._root._group_cache
+        key1 = (tx, ty, mipmap_level)
+        src = cache.get(key1, self._key2)
+        if src is None:
+            tiledims = (tiledsurface.N, tiledsurface.N, 4)
+            src = np.zeros(tiledims, dtype='uint16')
+            if self._program is not None:
+                self._program.run(
+                    [src], True,
+                    [(tx, ty)], mipmap_level,
+                    index=self._root._get_tile_index(),
+                )
+            else:
+                self._root._process_ops_list(
+                    self._ops,
+                    src, True,
+                    tx, ty, mipmap_level,
+                )
+            cache.set(key1, self._key2, src)
+        return src
+
+    def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level=0,
+                       opacity=1.0, mode=lib.mypaintlib.CombineNormal,
+                       *args, **kwargs):
+        """Composite the group's isolated rendering over a fix15 tile."""
+        src = self.get_readonly_tile(tx, ty, mipmap_level)
+        lib.mypaintlib.tile_combine(mode, src, dst, dst_has_alpha, opacity)
+
+
+class _LayerThumbnail (object):
+    """Persistent rendering of a layer's bbox, for its thumbnail
+
+    The rendering is kept at the mipmap level which makes the bbox
+    about the thumbnail's size, so it can be patched a tile at a time.
+    See RootLayerStack.update_layer_thumbnail().
+
+    """
+
+    def __init__(self, bbox, size):
+        super(_LayerThumbnail, self).__init__()
+        self.bbox = tuple(bbox)
+        self.size = size
+        x, y, w, h = bbox
+        mipmap_level = 0
+        while mipmap_level < lib.tiledsurface.MAX_MIPMAP_LEVEL:
+            if max(w, h) <= size:
+                break
+            mipmap_level += 1
+            x //= 2
+            y //= 2
+            w //= 2
+            h //= 2
+        self.mipmap_level = mipmap_level
+        self.surface = lib.pixbufsurface.Surface(x, y, max(1, w), max(1, h))
+        self.surface.pixbuf.fill(0x00000000)
+
+    def get_tiles(self):
+        """All the rendering's tiles, at its mipmap level"""
+        return set(self.surface.get_tiles())
+
+    def get_dirty_tiles(self, dirty):
+        """The rendering's tiles within some model rects
+
+        :param list dirty: model rects, or None for all tiles
+        :rtype: set
+
+        """
+        tiles = self.get_tiles()
+        if dirty is None:
+            return tiles
+        n = tiledsurface.N
+        level = self.mipmap_level
+        result = set()
+        for (x, y, w, h) in dirty:
+            tx0 = (x >> level) // n
+            ty0 = (y >> level) // n
+            tx1 = ((x + w - 1) >> level) // n
+            ty1 = ((y + h - 1) >> level) // n
+            for tx in xrange(tx0, tx1 + 1):
+                for ty in xrange(ty0, ty1 + 1):
+                    if (tx, ty) in tiles:
+                        result.add((tx, ty))
+        return result
+
+    def adopt_tiles(self, other, dirty):
+        """Copies still-valid tiles from an earlier rendering
+
+        :param _LayerThumbnail other: earlier rendering of the layer
+        :param list dirty: model rects changed since it was updated,
+            or None if anything may have changed.
+        :returns: the tiles which still need rendering
+        :rtype: set
+
+        """
+        tiles = self.get_tiles()
+        if dirty is None or other.mipmap_level != self.mipmap_level:
+            return tiles
+        todo = self.get_dirty_tiles(dirty)
+        reusable = (tiles & other.get_tiles()) - todo
+        for tx, ty in reusable:
+            with other.surface.tile_request(tx, ty, readonly=True) as src:
+                with self.surface.tile_request(tx, ty, readonly=False) as dst:
+                    dst[...] = src
+        return tiles - reusable
+
+    def get_pixbuf(self):
+        """The thumbnail, scaled to size
+
+        :rtype: GdkPixbuf.Pixbuf
+
+        The result is a new pixbuf, independent of the rendering.
+
+        """
+        pixbuf = self.surface.pixbuf
+        size = self.size
+        thumbnail = pixbuf
+        if size not in (pixbuf.get_width(), pixbuf.get_height()):
+            thumbnail = helpers.scale_proportionally(pixbuf, size, size)
+        if thumbnail is pixbuf:
+            thumbnail = pixbuf.copy()
+        return thumbnail
+
+
 ## Layer path tuple functions
 
 
@@ -0,0 +1,299 @@
+# This file is part of MyPaint.
+# Copyright (C) 2026 by the MyPaint Development Team.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Concurrent encoding of OpenRaster zipfile members.
+
+Saving an OpenRaster file is dominated by PNG encoding, which used to
+happen one layer at a time. The writer here lets the layer saving code
+hand each PNG encode off to a worker thread, while still adding the
+members to the zipfile in the same order and with the same content
+that a serial save produces.
+
+"""
+
+## Imports
+
+from __future__ import division, print_function
+
+import os
+import sys
+import time
+import shutil
+import zipfile
+import tempfile
+import logging
+import collections
+
+import lib.workers
+import lib.feedback
+
+
+logger = logging.getLogger(__name__)
+
+
+## Module constants
+
+#: Number of queued members allowed per worker before queueing blocks.
+PENDING_PER_WORKER = 4
+
+#: Buffer size used when streaming encoded members into the zipfile.
+COPY_CHUNK_SIZE = 256 * 1024
+
+# ZipFile.open(..., mode="w") is only available in Python 3.6+.
+_ZIP_STREAMING = (sys.version_info >= (3, 6))
+
+# Kinds of queued entry.
+_DATA = 0
+_FILE = 1
+_JOB = 2
+
+
+## Helper functions
+
+
+def write_png(orazip, tmpdir, storepath, surface, rect,
+              progress=None, **kwargs):
+    """Encodes a rectangle of a surface as a new PNG zipfile member.
+
+    :param orazip: zipfile open for write, or an OrderedZipWriter
+    :param unicode tmpdir: scratch folder, for plain zipfiles
+    :param unicode storepath: name of the member within the zipfile
+    :param surface: object with a lib.surface-style save_as_png()
+    :param tuple rect: rectangle to save, (x, y, w, h)
+    :param progress: Unsized UI feedback object
+    :type progress: lib.feedback.Progress or None
+    :param \*\*kwargs: passed through to surface.save_as_png()
+
+    With an OrderedZipWriter, encoding happens on one of its worker
+    threads, and the writer reports progress when the member is added.
+    With a plain zipfile.ZipFile, the PNG is encoded right away
+    via a temporary file in `tmpdir`.
+
+    """
+    if isinstance(orazip, OrderedZipWriter):
+        orazip.submit(storepath, surface.save_as_png, *rect, **kwargs)
+        if progress:
+            progress.close()
+        return
+    pngpath = os.path.join(tmpdir, os.path.basename(storepath))
+    t0 = time.time()
+    surface.save_as_png(pngpath, *rect, progress=progress, **kwargs)
+    t1 = time.time()
+    logger.debug('%.3fs surface saving %r', t1 - t0, storepath)
+    orazip.write(pngpath, storepath)
+    os.remove(pngpath)
+
+
+## Class defs
+
+
+class OrderedZipWriter (object):
+    """Zipfile wrapper which encodes members in parallel, but adds in order
+
+    It supports the subset of the zipfile.ZipFile interface used when
+    saving, and adds submit() for work which can be done on a worker
+    thread. Members are added to the wrapped zipfile strictly in the
+    order they were queued, as soon as everything before them is ready.
+
+    >>> import io
+    >>> buf = io.BytesIO()
+    >>> zf = zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED)
+    >>> orazip = OrderedZipWriter(zf, num_workers=3)
+    >>> orazip.writestr("mimetype", b"image/openraster")
+    >>> for i in range(5):
+    ...     orazip.submit("data/%d.txt" % (i,),
+    ...                   lambda fp, i: fp.write(b"x" * (5 - i)), i)
+    >>> orazip.writestr("stack.xml", b"<image/>")
+    >>> orazip.close()
+    >>> zf = zipfile.ZipFile(buf)
+    >>> zf.namelist()  # doctest: +NORMALIZE_WHITESPACE
+    ['mimetype', 'data/0.txt', 'data/1.txt', 'data/2.txt',
+     'data/3.txt', 'data/4.txt', 'stack.xml']
+    >>> zf.read("data/1.txt")
+    b'xxxx'
+
+    """
+
+    def __init__(self, zf, num_workers=None):
+        """Initialize, wrapping a zipfile.
+
+        :param zipfile.ZipFile zf: zipfile open for write
+        :param int num_workers: encoder threads (None or 0: automatic)
+
+        """
+        super(OrderedZipWriter, self).__init__()
+        self._zipfile = zf
+        self._pool = lib.workers.WorkerPool(num_workers, name="orasave")
+        self._queue = collections.deque()  # [(kind, arcname, payload)]
+        self._max_pending = self._pool.num_workers * PENDING_PER_WORKER
+
+    def __repr__(self):
+        return "<OrderedZipWriter %r pending=%d>" % (
+            self._zipfile.filename,
+            len(self._queue),
+        )
+
+    @property
+    def compression(self):
+        """The wrapped zipfile's compression type (read-only)."""
+        return self._zipfile.compression
+
+    ## ZipFile-like interface
+
+    def writestr(self, zinfo_or_arcname, data):
+        """Queues a member with known content.
+
+        Same as zipfile.ZipFile.writestr(), but may be deferred.
+
+        """
+        self._queue.append((_DATA, zinfo_or_arcname, data))
+        self._write_ready()
+
+    def write(self, filename, arcname=None):
+        """Queues an existing file as a new member.
+
+        Same as zipfile.ZipFile.write(), but may be deferred:
+        the file must not be removed or changed until close().
+
+        """
+        self._queue.append((_FILE, arcname, filename))
+        self._write_ready()
+
+    def close(self, progress=None):
+        """Adds all remaining members, then closes the zipfile.
+
+        :param progress: Unsized UI feedback object
+        :type progress: lib.feedback.Progress or None
+
+        This blocks until every queued member has been written.
+        Errors raised while encoding are re-raised here, or earlier.
+
+        """
+        if not progress:
+            progress = lib.feedback.Progress()
+        progress.items = len(self._queue)
+        try:
+            while self._queue:
+                self._write_next()
+                progress += 1
+        except Exception:
+            self.abort()
+            raise
+        self._pool.shutdown()
+        self._zipfile.close()
+        progress.close()
+
+    def abort(self):
+        """Drops all queued members, and closes the zipfile."""
+        for kind, arcname, payload in self._queue:
+            if kind == _JOB:
+                payload.cancel()
+        while self._queue:
+            kind, arcname, payload = self._queue.popleft()
+            if kind != _JOB:
+                continue
+            try:
+                payload.result().close()
+            except Exception:
+                pass
+        self._pool.shutdown()
+        self._zipfile.close()
+
+    ## Concurrent members
+
+    def submit(self, arcname, func, *args, **kwargs):
+        """Queues a member whose content is written by a worker thread.
+
+        :param unicode arcname: name of the member within the zipfile
+        :param callable func: called as func(fp, *args, **kwargs)
+
+        The callable is invoked on a worker thread, with a binary
+        temporary file open for writing as its first argument. This
+        file has a real file descriptor, so it can be passed to the
+        PNG writer in mypaintlib. Once written, it is streamed into
+        the zipfile when its turn comes. The callable must not update
+        UI feedback objects.
+
+        If too many members are already pending, this blocks until
+        the earliest of them has been written.
+
+        """
+        job = self._pool.submit(self._encode, arcname, func, args, kwargs)
+        self._queue.append((_JOB, arcname, job))
+        self._write_ready()
+        while len(self._queue) > self._max_pending:
+            self._write_next()
+
+    @staticmethod
+    def _encode(arcname, func, args, kwargs):
+        """Runs a submitted callable (worker thread)"""
+        fp = tempfile.TemporaryFile()
+        t0 = time.time()
+        try:
+            func(fp, *args, **kwargs)
+        except Exception:
+            fp.close()
+            raise
+        t1 = time.time()
+        logger.debug("%.3fs encoding %r", t1 - t0, arcname)
+        return fp
+
+    ## Internals
+
+    def _write_ready(self):
+        """Writes queued members, up to the first unfinished one"""
+        while self._queue:
+            kind, arcname, payload = self._queue[0]
+            if kind == _JOB and not payload.done():
+                return
+            self._write_next()
+
+    def _write_next(self):
+        """Writes the first queued member, waiting for it if needed"""
+        kind, arcname, payload = self._queue.popleft()
+        if kind == _DATA:
+            self._zipfile.writestr(arcname, payload)
+        elif kind == _FILE:
+            self._zipfile.write(payload, arcname)
+        else:
+            fp = payload.result()
+            try:
+                self._write_fp(arcname, fp)
+            finally:
+                fp.close()
+
+    def _write_fp(self, arcname, fp):
+        """Streams a temp file's data into the zipfile"""
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell()
+        fp.seek(0)
+        # Mirror the metadata that ZipFile.write() gives a fresh file.
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+        zinfo.external_attr = (0o100000 | 0o644) << 16
+        zinfo.compress_type = self._zipfile.compression
+        zinfo.file_size = size
+        if _ZIP_STREAMING:
+            with self._zipfile.open(zinfo, "w") as dst:
+                shutil.copyfileobj(fp, dst, COPY_CHUNK_SIZE)
+        else:
+            self._zipfile.writestr(zinfo, fp.read())
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
@@ -45,7 +45,8 @@ def save(pixbuf, filename, type='png', **kwargs):
     """Save pixbuf to a named file (compatibility wrapper)
 
     :param GdkPixbuf.Pixbuf pixbuf: the pixbuf to save
-    :param unicode filename: file path to save as
+    :param filename: file path to save as, or a binary file-like object
+    :type filename: unicode or file
     :param str type: type to save as: 'jpeg'/'png'/...
     :param \*\*kwargs: passed through to GdkPixbuf
     :rtype: bool
@@ -59,34 +60,50 @@ def save(pixbuf, filename, type='png', **kwargs):
     True
     >>> shutil.rmtree(d, ignore_errors=True)
 
+    File-like objects are written to, but not closed.
+
+    >>> from io import BytesIO
+    >>> buf = BytesIO()
+    >>> save(p, buf, type="png")
+    True
+    >>> buf.getvalue()[1:4] == b"PNG"
+    True
+
     """
+    if hasattr(filename, "write"):
+        return _save_to_fp(pixbuf, filename, type, **kwargs)
     with open(filename, 'wb') as fp:
-        try:
-            save_to_callbackv = pixbuf.save_to_callbackv
-        except AttributeError:
-            # save_to_callbackv disappeared in GdkPixbuf 2.31.2
-            # and returned as of GdkPixbuf 2.31.5
-            # https://bugzilla.gnome.org/show_bug.cgi?id=670372#c12
-            save_to_callbackv = pixbuf.save_to_callback
-        # Keyword args are not compatible with 2.26 (Ubuntu 12.04,
-        # a.k.a. precise, a.k.a. "what Travis-CI runs")
-        option_keys = []
-        option_values = []
-        for k, v in kwargs.items():
-            if isinstance(k, bytes):
-                k = k.decode("utf-8")
-            option_keys.append(k)
-            if isinstance(v, bytes):
-                v = v.decode("utf-8")
-            option_values.append(v)
-        result = save_to_callbackv(
-            lambda buf, size, data: fp.write(buf) or True,  # save_func
-            fp,  # user_data
-            type,
-            option_keys,
-            option_values,
-        )
-        return result
+        return _save_to_fp(pixbuf, fp, type, **kwargs)
+
+
+def _save_to_fp(pixbuf, fp, type, **kwargs):
+    """Save pixbuf to an open file object (internal)"""
+    try:
+        save_to_callbackv = pixbuf.save_to_callbackv
+    except AttributeError:
+        # save_to_callbackv disappeared in GdkPixbuf 2.31.2
+        # and returned as of GdkPixbuf 2.31.5
+        # https://bugzilla.gnome.org/show_bug.cgi?id=670372#c12
+        save_to_callbackv = pixbuf.save_to_callback
+    # Keyword args are not compatible with 2.26 (Ubuntu 12.04,
+    # a.k.a. precise, a.k.a. "what Travis-CI runs")
+    option_keys = []
+    option_values = []
+    for k, v in kwargs.items():
+        if isinstance(k, bytes):
+            k = k.decode("utf-8")
+        option_keys.append(k)
+        if isinstance(v, bytes):
+            v = v.decode("utf-8")
+        option_values.append(v)
+    result = save_to_callbackv(
+        lambda buf, size, data: fp.write(buf) or True,  # save_func
+        fp,  # user_data
+        type,
+        option_keys,
+        option_values,
+    )
+    return result
 
 
 def load_from_file(filename, progress=None):
@@ -24,6 +24,8 @@
 #include <numpy/arrayobject.h>
 
 #include <stdlib.h>
+#include <string.h>
+#include <vector>
 #include <math.h>
 
 
@@ -65,9 +67,16 @@ void tile_downscale_rgba16(PyObject *src, PyObject *dst, int dst_x, int dst_y) {
   assert(PyArray_ISCARRAY(dst_arr));
 #endif
 
-  tile_downscale_rgba16_c((uint16_t*)PyArray_DATA(src_arr), PyArray_STRIDES(src_arr)[0],
-                          (uint16_t*)PyArray_DATA(dst_arr), PyArray_STRIDES(dst_arr)[0],
+  const uint16_t *src_p = (uint16_t*)PyArray_DATA(src_arr);
+  const int src_strides = PyArray_STRIDES(src_arr)[0];
+  uint16_t *dst_p = (uint16_t*)PyArray_DATA(dst_arr);
+  const int dst_strides = PyArray_STRIDES(dst_arr)[0];
+
+  // Pure pixel crunching: let other Python threads run meanwhile.
+  Py_BEGIN_ALLOW_THREADS
+  tile_downscale_rgba16_c(src_p, src_strides, dst_p, dst_strides,
                           dst_x, dst_y);
+  Py_END_ALLOW_THREADS
 
 }
 
@@ -351,11 +360,17 @@ tile_convert_rgba16_to_rgba8 (PyObject *src,
   assert(PyArray_STRIDE(src_arr, 2) ==   sizeof(uint16_t));
 #endif
 
-  tile_convert_rgba16_to_rgba8_c((uint16_t*)PyArray_DATA(src_arr),
-                                 PyArray_STRIDES(src_arr)[0],
-                                 (uint8_t*)PyArray_DATA(dst_arr),
-                                 PyArray_STRIDES(dst_arr)[0],
+  const uint16_t *src_p = (uint16_t*)PyArray_DATA(src_arr);
+  const int src_strides = PyArray_STRIDES(src_arr)[0];
+  const uint8_t *dst_p = (uint8_t*)PyArray_DATA(dst_arr);
+  const int dst_strides = PyArray_STRIDES(dst_arr)[0];
+
+  // The shared noise table must be set up while we hold the GIL.
+  precalculate_dithering_noise_if_required();
+  Py_BEGIN_ALLOW_THREADS
+  tile_convert_rgba16_to_rgba8_c(src_p, src_strides, dst_p, dst_strides,
                                  EOTF);
+  Py_END_ALLOW_THREADS
 }
 
 static inline void
@@ -461,9 +476,17 @@ void tile_convert_rgbu16_to_rgbu8(PyObject * src, PyObject * dst, const float EO
   assert(PyArray_STRIDE(src_arr, 2) ==   sizeof(uint16_t));
 #endif
 
-  tile_convert_rgbu16_to_rgbu8_c((uint16_t*)PyArray_DATA(src_arr), PyArray_STRIDES(src_arr)[0],
-                                 (uint8_t*)PyArray_DATA(dst_arr), PyArray_STRIDES(dst_arr)[0],
-                                  EOTF);
+  const uint16_t *src_p = (uint16_t*)PyArray_DATA(src_arr);
+  const int src_strides = PyArray_STRIDES(src_arr)[0];
+  const uint8_t *dst_p = (uint8_t*)PyArray_DATA(dst_arr);
+  const int dst_strides = PyArray_STRIDES(dst_arr)[0];
+
+  // The shared noise table must be set up while we hold the GIL.
+  precalculate_dithering_noise_if_required();
+  Py_BEGIN_ALLOW_THREADS
+  tile_convert_rgbu16_to_rgbu8_c(src_p, src_strides, dst_p, dst_strides,
+                                 EOTF);
+  Py_END_ALLOW_THREADS
 }
 
 void tile_convert_rgba8_to_rgba16_const(PyObject * src, PyObject * dst) {
@@ -673,6 +696,8 @@ void tile_perceptual_change_strokemap(PyObject * a_obj, PyObject * b_obj, PyObje
   uint16_t * b_p  = (uint16_t*)PyArray_DATA(b);
   uint8_t * res_p = (uint8_t*)PyArray_DATA(res);
 
+  // Strokemap diffs are computed by worker threads.
+  Py_BEGIN_ALLOW_THREADS
   for (int y=0; y<MYPAINT_TILE_SIZE; y++) {
     for (int x=0; x<MYPAINT_TILE_SIZE; x++) {
 
@@ -717,6 +742,7 @@ void tile_perceptual_change_strokemap(PyObject * a_obj, PyObject * b_obj, PyObje
       res_p += 1;
     }
   }
+  Py_END_ALLOW_THREADS
 }
 
 
@@ -871,6 +897,162 @@ tile_combine (enum CombineMode mode,
         return;
     }
     const TileDataCombineOp *op = combine_mode_info[mode];
+
+    // Blending never calls back into Python, so allow other threads
+    // (e.g. parallel render workers) to run while it happens.
+    Py_BEGIN_ALLOW_THREADS
     op->combine_data(src_p, dst_p, dst_has_alpha, src_opacity);
+    Py_END_ALLOW_THREADS
 }
 
+
+
+/* tile_run_program(): run a compiled render program over a batch of tiles */
+
+// Opcodes, as in lib.layer.rendering.Opcode
+static const int PROGRAM_OP_COMPOSITE = 1;
+static const int PROGRAM_OP_BLIT = 2;
+static const int PROGRAM_OP_PUSH = 3;
+static const int PROGRAM_OP_POP = 4;
+
+
+void
+tile_run_program (PyObject *program_obj,
+                  PyObject *srcs_obj,
+                  PyObject *dsts_obj,
+                  const bool dst_has_alpha)
+{
+    PyArrayObject* program = ((PyArrayObject*)program_obj);
+#ifdef HEAVY_DEBUG
+    assert(PyArray_Check(program_obj));
+    assert(PyArray_NDIM(program) == 2);
+    assert(PyArray_DIM(program, 1) == 4);
+    assert(PyArray_TYPE(program) == NPY_DOUBLE);
+    assert(PyArray_ISCARRAY(program));
+    assert(PyList_Check(srcs_obj));
+    assert(PyList_Check(dsts_obj));
+    assert(PyList_GET_SIZE(srcs_obj) == PyList_GET_SIZE(dsts_obj));
+#endif
+
+    const int nops = PyArray_DIM(program, 0);
+    const double *insns = (const double *)PyArray_DATA(program);
+    const Py_ssize_t ntiles = PyList_GET_SIZE(dsts_obj);
+    if (nops == 0 || ntiles == 0) {
+        return;
+    }
+
+    // Gather the data pointers while the GIL is held.
+    // The caller's lists keep the arrays alive for the whole call.
+    // Empty source tiles are passed in as None, and become NULL.
+    Py_ssize_t nslots = 0;
+    std::vector<fix15_short_t *> dst_ps(ntiles);
+    std::vector<const fix15_short_t *> src_ps;
+    for (Py_ssize_t t = 0; t < ntiles; ++t) {
+        PyObject *dst_obj = PyList_GET_ITEM(dsts_obj, t);
+        dst_ps[t] = (fix15_short_t *)PyArray_DATA((PyArrayObject *)dst_obj);
+        PyObject *tile_srcs = PyList_GET_ITEM(srcs_obj, t);
+        if (t == 0) {
+            nslots = PyList_GET_SIZE(tile_srcs);
+            src_ps.resize(ntiles * nslots);
+        }
+#ifdef HEAVY_DEBUG
+        assert(PyList_GET_SIZE(tile_srcs) == nslots);
+#endif
+        for (Py_ssize_t s = 0; s < nslots; ++s) {
+            PyObject *src_obj = PyList_GET_ITEM(tile_srcs, s);
+            const fix15_short_t *src_p = NULL;
+            if (src_obj != Py_None) {
+                src_p = (const fix15_short_t *)PyArray_DATA(
+                    (PyArrayObject *)src_obj
+                );
+            }
+            src_ps[t*nslots + s] = src_p;
+        }
+    }
+
+    // Scratch space for the isolation stack, reused for every tile.
+    int max_depth = 0;
+    int depth = 0;
+    for (int i = 0; i < nops; ++i) {
+        const int opcode = (int)insns[i*4];
+        if (opcode == PROGRAM_OP_PUSH) {
+            ++depth;
+            max_depth = MAX(max_depth, depth);
+        }
+        else if (opcode == PROGRAM_OP_POP) {
+            --depth;
+        }
+    }
+    const size_t tile_len = MYPAINT_TILE_SIZE * MYPAINT_TILE_SIZE * 4;
+    const size_t tile_bytes = tile_len * sizeof(fix15_short_t);
+    std::vector<fix15_short_t> scratch((max_depth + 1) * tile_len, 0);
+    std::vector<fix15_short_t *> stack(max_depth + 1);
+    std::vector<bool> stack_has_alpha(max_depth + 1);
+
+    // Empty sources still need compositing for some modes.
+    const std::vector<fix15_short_t> zeros(tile_len, 0);
+
+    // The loop never calls back into Python.
+    Py_BEGIN_ALLOW_THREADS
+    for (Py_ssize_t t = 0; t < ntiles; ++t) {
+        const fix15_short_t * const *srcs = src_ps.data() + t*nslots;
+        depth = 0;
+        stack[0] = dst_ps[t];
+        stack_has_alpha[0] = dst_has_alpha;
+        for (int i = 0; i < nops; ++i) {
+            const double *insn = insns + i*4;
+            const int opcode = (int)insn[0];
+            const int slot = (int)insn[1];
+            const int mode = (int)insn[2];
+            const float opacity = (float)insn[3];
+            fix15_short_t *dst = stack[depth];
+            const bool has_alpha = stack_has_alpha[depth];
+            if (opcode == PROGRAM_OP_COMPOSITE) {
+                if (mode >= NumCombineModes || mode < 0) {
+                    continue;
+                }
+                const TileDataCombineOp *op = combine_mode_info[mode];
+                const fix15_short_t *src = srcs[slot];
+                // Same zero-alpha shortcuts as Surface.composite_tile()
+                if (src == NULL || opacity == 0) {
+                    if (has_alpha && op->zero_alpha_clears_backdrop()) {
+                        memset(dst, 0, tile_bytes);
+                        continue;
+                    }
+                    if (! op->zero_alpha_has_effect()) {
+                        continue;
+                    }
+                    if (src == NULL) {
+                        src = zeros.data();
+                    }
+                }
+                op->combine_data(src, dst, has_alpha, opacity);
+            }
+            else if (opcode == PROGRAM_OP_BLIT) {
+                const fix15_short_t *src = srcs[slot];
+                if (src == NULL) {
+                    memset(dst, 0, tile_bytes);
+                }
+                else {
+                    memcpy(dst, src, tile_bytes);
+                }
+            }
+            else if (opcode == PROGRAM_OP_PUSH) {
+                ++depth;
+                stack[depth] = scratch.data() + depth*tile_len;
+                stack_has_alpha[depth] = true;
+                memset(stack[depth], 0, tile_bytes);
+            }
+            else if (opcode == PROGRAM_OP_POP) {
+                --depth;
+                if (mode >= NumCombineModes || mode < 0) {
+                    continue;
+                }
+                const TileDataCombineOp *op = combine_mode_info[mode];
+                op->combine_data(dst, stack[depth], stack_has_alpha[depth],
+                                 opacity);
+            }
+        }
+    }
+    Py_END_ALLOW_THREADS
+}
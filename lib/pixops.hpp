@@ -133,4 +133,14 @@ tile_combine (enum CombineMode mode,
               const float src_opacity);
 
 
+// Run a compiled render program over a batch of tiles.
+// See lib.layer.rendering.RenderProgram.
+
+void
+tile_run_program (PyObject *program_obj,
+                  PyObject *srcs_obj,
+                  PyObject *dsts_obj,
+                  const bool dst_has_alpha);
+
+
 #endif // PIXOPS_HPP
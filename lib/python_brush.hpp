@@ -56,4 +56,43 @@ public:
     return res;
   }
 
+  // Replay recorded events in one call, as for lib.stroke.Stroke.
+  // The array must be a C-contiguous float64 array with one row per
+  // event: dtime, x, y, pressure, xtilt, ytilt, viewzoom, viewrotation,
+  // barrel_rotation. Returns the number of events replayed, or NULL
+  // with an exception set if the array is unsuitable or the surface
+  // code raised one.
+  PyObject * stroke_to_events (Surface * surface, PyObject * obj)
+  {
+    if (! PyArray_Check(obj)) {
+      PyErr_SetString(PyExc_TypeError, "events must be a numpy array");
+      return NULL;
+    }
+    PyArrayObject* data = (PyArrayObject*)obj;
+    if (PyArray_TYPE(data) != NPY_FLOAT64) {
+      PyErr_SetString(PyExc_TypeError, "events array must be float64");
+      return NULL;
+    }
+    if (PyArray_NDIM(data) != 2 || PyArray_DIM(data, 1) != 9) {
+      PyErr_SetString(PyExc_ValueError,
+                      "events array must have shape (n, 9)");
+      return NULL;
+    }
+    if (! PyArray_ISCARRAY_RO(data)) {
+      PyErr_SetString(PyExc_ValueError,
+                      "events array must be C-contiguous and aligned");
+      return NULL;
+    }
+    const npy_intp n = PyArray_DIM(data, 0);
+    const npy_float64 * p = (const npy_float64*)PyArray_DATA(data);
+    for (npy_intp i=0; i<n; i++, p+=9) {
+      Brush::stroke_to (surface, p[1], p[2], p[3], p[4], p[5], p[0],
+                        p[6], p[7], p[8]);
+      if (PyErr_Occurred()) {
+        return NULL;
+      }
+    }
+    return Py_BuildValue("n", (Py_ssize_t)n);
+  }
+
 };
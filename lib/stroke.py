@@ -9,11 +9,172 @@
 
 from __future__ import division, print_function
 
+import array
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
 import numpy as np
 
 from . import brush
 
 
+## Stroke data encoding
+
+# Stroke data is a version byte followed by the recorded events. Each
+# event has 9 fields: dtime, x, y, pressure, xtilt, ytilt, viewzoom,
+# viewrotation, barrel_rotation.
+#
+# Version b'2' is the raw float64 events, row by row.
+#
+# Version b'3' is compact. It's an event count, then the zlib-compressed
+# columns, one field at a time. Where a field has a fixed range or
+# needs only limited precision, it's quantized to integers: see
+# _COMPACT_FIELDS. Positions are delta-coded, so that the slowly
+# changing values compress well.
+
+_NUM_FIELDS = 9
+_COMPACT_HEADER = struct.Struct("<I")
+
+# (scale, dtype, delta-coded) for each field of the compact encoding.
+# A scale of None means the field is stored as float32.
+_COMPACT_FIELDS = [
+    (1e6, "<u4", False),     # dtime, in microseconds
+    (1024, "<i4", True),     # x, in 1/1024 model pixels
+    (1024, "<i4", True),     # y
+    (65535, "<u2", False),   # pressure, 0.0 to 1.0
+    (32767, "<i2", False),   # xtilt, -1.0 to 1.0
+    (32767, "<i2", False),   # ytilt
+    (None, "<f4", False),    # viewzoom
+    (None, "<f4", False),    # viewrotation
+    (None, "<f4", False),    # barrel_rotation
+]
+
+# Delta-coded fields are limited to this, so that the deltas fit too
+_DELTA_LIMIT = 2**30
+
+#: Number of parsed brush settings strings kept for replaying strokes
+BRUSHINFO_CACHE_SIZE = 16
+
+_brushinfo_cache = OrderedDict()  # {settings: BrushInfo}, LRU first
+_brushinfo_cache_lock = threading.Lock()
+
+
+def encode_events(events):
+    """Encodes recorded stroke events as stroke data
+
+    :param events: the events, one row of 9 fields per event
+    :type events: numpy array of float64
+    :returns: compactly encoded data, or the raw b'2' encoding if the
+        events can't be stored compactly
+    :rtype: bytes
+
+    >>> events = np.zeros((100, 9))
+    >>> events[:, 0] = 0.005
+    >>> events[:, 1] = np.linspace(-80.5, 412.25, 100)
+    >>> events[:, 2] = 77.125
+    >>> events[:, 3] = np.linspace(0, 1, 100)
+    >>> events[:, 6] = 1.5
+    >>> data = encode_events(events)
+    >>> data[0:1] == b'3'
+    True
+    >>> len(data) < events.nbytes // 10
+    True
+    >>> np.allclose(decode_events(data), events, atol=1e-3)
+    True
+
+    Events with values out of range are kept exactly as they are.
+
+    >>> events[5, 3] = 1.5
+    >>> data = encode_events(events)
+    >>> data[0:1] == b'2'
+    True
+    >>> bool((decode_events(data) == events).all())
+    True
+
+    """
+    events = np.asarray(events, dtype="float64").reshape(-1, _NUM_FIELDS)
+    columns = []
+    for i, (scale, dtype, delta) in enumerate(_COMPACT_FIELDS):
+        col = events[:, i]
+        if scale is None:
+            if not np.isfinite(col).all():
+                return _encode_raw(events)
+            columns.append(col.astype(dtype).tobytes())
+            continue
+        q = np.round(col * scale)
+        info = np.iinfo(dtype)
+        lo, hi = info.min, info.max
+        if delta:
+            lo, hi = -_DELTA_LIMIT, _DELTA_LIMIT
+        if not (np.isfinite(q).all() and (q >= lo).all() and (q <= hi).all()):
+            return _encode_raw(events)
+        q = q.astype("int64")
+        if delta:
+            q[1:] -= q[:-1].copy()
+        columns.append(q.astype(dtype).tobytes())
+    body = zlib.compress(b"".join(columns))
+    header = _COMPACT_HEADER.pack(len(events))
+    return b'3' + header + body
+
+
+def _encode_raw(events):
+    return b'2' + events.astype("float64").tobytes()
+
+
+def decode_events(stroke_data):
+    """Decodes stroke data made by encode_events()
+
+    :param bytes stroke_data: encoded stroke events
+    :returns: the events, one row of 9 fields per event
+    :rtype: numpy array of float64
+
+    """
+    version, data = stroke_data[0:1], stroke_data[1:]
+    if version == b'2':
+        events = np.frombuffer(data, dtype="float64")
+        return events.reshape(-1, _NUM_FIELDS)
+    elif version != b'3':
+        raise ValueError("Unknown stroke data version %r" % (version,))
+    (n,) = _COMPACT_HEADER.unpack_from(data)
+    events = np.empty((n, _NUM_FIELDS), dtype="float64")
+    if n == 0:
+        return events
+    body = zlib.decompress(data[_COMPACT_HEADER.size:])
+    pos = 0
+    for i, (scale, dtype, delta) in enumerate(_COMPACT_FIELDS):
+        dtype = np.dtype(dtype)
+        col = np.frombuffer(body, dtype=dtype, count=n, offset=pos)
+        pos += n * dtype.itemsize
+        if delta:
+            col = np.cumsum(col, dtype="int64")
+        if scale is None:
+            events[:, i] = col
+        else:
+            events[:, i] = col / scale
+    return events
+
+
+def _get_brushinfo(settings):
+    """Parses a brush settings string, or reuses its parsed BrushInfo
+
+    The result is shared, so it must not be modified.
+
+    """
+    with _brushinfo_cache_lock:
+        bi = _brushinfo_cache.pop(settings, None)
+        if bi is None:
+            bi = brush.BrushInfo(settings)
+        _brushinfo_cache[settings] = bi
+        while len(_brushinfo_cache) > BRUSHINFO_CACHE_SIZE:
+            _brushinfo_cache.popitem(last=False)
+    return bi
+
+
+## Class defs
+
+
 class Stroke (object):
     """Replayable record of a stroke's data
 
@@ -48,24 +209,20 @@ class Stroke (object):
         self.brush = brush
         self.brush.new_stroke()  # resets the stroke_* members of the brush
 
-        self.tmp_event_list = []
+        # Events are recorded as flat float64 rows of 9 fields
+        self.tmp_event_list = array.array('d')
 
     def record_event(self, dtime, x, y, pressure, xtilt, ytilt,
                      viewzoom, viewrotation, barrel_rotation):
         assert not self.finished
-        self.tmp_event_list.append((dtime, x, y, pressure, xtilt, ytilt,
+        self.tmp_event_list.extend((dtime, x, y, pressure, xtilt, ytilt,
                                     viewzoom, viewrotation, barrel_rotation))
 
     def stop_recording(self):
         if self.finished:
             return
-        # OPTIMIZE
-        # - for space: just gzip? use integer datatypes?
-        # - for time: maybe already use array storage while recording?
         data = np.array(self.tmp_event_list, dtype='float64')
-        data = data.tostring()
-        version = b'2'
-        self.stroke_data = version + data
+        self.stroke_data = encode_events(data)
 
         self.total_painting_time = self.brush.get_total_stroke_painting_time()
         del self.brush, self.tmp_event_list
@@ -79,23 +236,22 @@ class Stroke (object):
     def render(self, surface):
         assert self.finished
 
-        # OPTIMIZE: check if parsing of settings is a performance bottleneck
-        b = brush.Brush(brush.BrushInfo(self.brush_settings))
+        bi = _get_brushinfo(self.brush_settings)
+        b = brush.Brush(bi)
+        # The BrushInfo is shared, so don't leave the brush observing it
+        bi.observers.remove(b._update_from_brushinfo)
 
-        states = np.fromstring(self.brush_state, dtype='float32')
+        states = np.frombuffer(self.brush_state, dtype='float32').copy()
         b.set_states_from_array(states)
 
-        version, data = self.stroke_data[0:1], self.stroke_data[1:]
-        assert version == b'2'
-        data = np.fromstring(data, dtype='float64')
-        data.shape = (len(data) // 9, 9)
+        data = np.ascontiguousarray(decode_events(self.stroke_data))
 
         surface.begin_atomic()
-        for (dtime, x, y, pressure, xtilt, ytilt, viewzoom,
-             viewrotation, barrel_rotation) in data:
-            b.stroke_to(surface.backend, x, y, pressure, xtilt, ytilt, dtime,
-                        viewzoom, viewrotation, barrel_rotation)
-        surface.end_atomic()
+        try:
+            n = b.stroke_to_events(surface.backend, data)
+        finally:
+            surface.end_atomic()
+        assert n == len(data), "replayed %d of %d events" % (n, len(data))
 
     def copy_using_different_brush(self, brushinfo):
         assert self.finished
@@ -109,3 +265,16 @@ class Stroke (object):
         # has different meanings for the states. This should cause
         # fewer glitches than resetting the initial state to zero.
         return clone
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
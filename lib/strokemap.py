@@ -13,19 +13,36 @@ from __future__ import division, print_function
 import struct
 import zlib
 import math
+import threading
+from collections import OrderedDict
 from logging import getLogger
 from warnings import warn
 
 import numpy as np
+from gi.repository import GLib
 
 from . import mypaintlib
 from . import tiledsurface
 from . import idletask
+import lib.workers
 from lib.pycompat import PY3, iteritems
 
 logger = getLogger(__name__)
 TILE_SIZE = N = mypaintlib.TILE_SIZE
 
+#: Decompressed strokemap tile bitmaps kept around for repeated lookups
+BITMAP_CACHE_SIZE = 256
+
+_bitmap_cache = OrderedDict()  # {_Tile: array}, most recently used last
+_bitmap_cache_lock = threading.Lock()
+
+#: Number of tiles diffed by each job submitted to the worker pool
+DIFF_BATCH_TILES = 16
+
+# Worker threads for computing strokemap diffs, see _TileDiffBatches
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
 
 ## Class defs
 
@@ -43,6 +60,11 @@ class StrokeShape (object):
         self.tasks = idletask.Processor()
         self.strokemap = {}
         self.brush_string = None
+        # Tiles where the shape may have data, even while tasks
+        # which will fill in the strokemap are still pending.
+        self._tile_coords = set()
+        # Diffs being computed by worker threads
+        self._diffs = None
 
     @classmethod
     def _mock(cls):
@@ -68,24 +90,41 @@ class StrokeShape (object):
         """
         before_dict = before.tiledict
         after_dict = after.tiledict
-        before_tiles = set(before_dict.items())
-        after_tiles = set(after_dict.items())
         changed_idxs = set(
-            pos for pos, data
-            in before_tiles.symmetric_difference(after_tiles)
+            pos for pos in set(before_dict).union(after_dict)
+            if before_dict.get(pos) is not after_dict.get(pos)
         )
         if not changed_idxs:
             return None
         shape = cls()
         assert not shape.strokemap
-        shape.tasks.add_work(_TileDiffUpdateTask(
-            before.tiledict,
-            after.tiledict,
+        shape._tile_coords = set(changed_idxs)
+        shape._diffs = _TileDiffBatches(
+            before_dict,
+            after_dict,
             changed_idxs,
-            shape.strokemap,
-        ))
+            shape._store_diffs,
+        )
         return shape
 
+    def _store_diffs(self):
+        """Store the worker threads' diffs, waiting for them if needed
+
+        Called when the last batch has finished, or when the
+        strokemap's tiles are needed.
+        """
+        diffs = self._diffs
+        if diffs is None:
+            return False
+        self._diffs = None
+        self.strokemap.update(diffs.results())
+        return False
+
+    def _finish_tasks(self):
+        """Complete all pending work on the strokemap"""
+        self._store_diffs()
+        self.tasks.finish_all()
+
     def init_from_string(self, data, translate_x, translate_y):
         """Initialize from a saved compressed byte string.
 
@@ -106,6 +145,24 @@ class StrokeShape (object):
             tile = _Tile.new_from_compressed_bitmap(compressed_bitmap)
             self.strokemap[tx + translate_x, ty + translate_y] = tile
             data = data[size+3*4:]
+        self._tile_coords = set(self.strokemap)
+
+    @property
+    def tile_coords(self):
+        """The tiles where the shape may have set pixels (read-only)
+
+        >>> shape = StrokeShape._mock()
+        >>> shape.tile_coords == set(shape.strokemap)
+        False
+        >>> shape._finish_tasks()
+        >>> shape.tile_coords == set(shape.strokemap)
+        True
+
+        The set is known before the shape's tiles have been worked out,
+        and it may include tiles without any set pixels.
+
+        """
+        return self._tile_coords
 
     def save_to_string(self, translate_x, translate_y):
         """Return a compressed bytes string representing the stroke shape.
@@ -125,7 +182,7 @@ class StrokeShape (object):
         assert translate_y % N == 0
         translate_x = int(translate_x // N)
         translate_y = int(translate_y // N)
-        self.tasks.finish_all()
+        self._finish_tasks()
         data = b''
         for (tx, ty), tile in iteritems(self.strokemap):
             compressed_bitmap = tile.to_bytes()
@@ -145,6 +202,7 @@ class StrokeShape (object):
         the entire task queue is completed.
 
         """
+        self._store_diffs()
         tileproc_methods = []
         for task in self.tasks.iter_work():
             try:
@@ -172,6 +230,8 @@ class StrokeShape (object):
         x = int(x)
         y = int(y)
         pixel_ti = (x // N, y // N)
+        if pixel_ti not in self._tile_coords:
+            return False
         self._complete_tile_tasks(lambda ti: (ti == pixel_ti))
         tile = self.strokemap.get(pixel_ti)
         if tile:
@@ -210,7 +270,15 @@ class StrokeShape (object):
 
     def translate(self, dx, dy):
         """Translate the shape by (dx, dy)"""
-        self.tasks.finish_all()
+        self._finish_tasks()
+        tdxs = [s[1][0] for s in tiledsurface.calc_translation_slices(dx)]
+        tdys = [s[1][0] for s in tiledsurface.calc_translation_slices(dy)]
+        self._tile_coords = set(
+            (tx + tdx, ty + tdy)
+            for (tx, ty) in self.strokemap
+            for tdx in tdxs
+            for tdy in tdys
+        )
         tmp = {}
         self.tasks.add_work(_TileTranslateTask(self.strokemap, tmp, dx, dy))
         self.tasks.add_work(_TileRecompressTask(tmp, self.strokemap))
@@ -225,67 +293,245 @@ class StrokeShape (object):
 
         Only complete tiles are discarded by this method.
         """
-        self.tasks.finish_all()
+        self._finish_tasks()
         x, y, w, h = rect
         logger.debug("Trimming stroke to %dx%d%+d%+d", w, h, x, y)
         for tx, ty in list(self.strokemap.keys()):
             if tx*N+N < x or ty*N+N < y or tx*N > x+w or ty*N > y+h:
                 self.strokemap.pop((tx, ty))
+        self._tile_coords = set(self.strokemap)
         return bool(self.strokemap)
 
 
-class _TileDiffUpdateTask:
-    """Idle task: update strokemap with tile & pixel diffs of snapshots.
+class StrokeIndex (object):
+    """Which strokes in a strokemap may touch each tile
+
+    Picking a stroke used to mean asking every StrokeShape in a layer's
+    strokemap whether it touched a pixel, newest first. The index maps
+    each tile to the shapes which may have data there, so only those
+    need to be asked.
+
+    The index follows a strokemap list owned by someone else, and is
+    told about the changes made to it. If the list changes in ways it
+    wasn't told about, the index is rebuilt the next time it's used.
+
+    >>> a, b, c = [StrokeShape() for i in range(3)]
+    >>> a._tile_coords = set([(0, 0), (1, 0)])
+    >>> b._tile_coords = set([(1, 0)])
+    >>> c._tile_coords = set([(5, 5)])
+    >>> strokes = [a, b]
+    >>> index = StrokeIndex()
+    >>> index.get_strokes_at(strokes, 1, 0) == [b, a]
+    True
+    >>> strokes.append(c)
+    >>> index.stroke_added(strokes)
+    >>> index.get_strokes_at(strokes, 5, 5) == [c]
+    True
 
-    This task is used during initialization of the StrokeShape.
+    Changed and removed shapes are updated in place.
+
+    >>> b._tile_coords = set([(2, 0)])
+    >>> strokes.remove(a)
+    >>> index.strokes_changed(strokes, changed=[b], removed=[a])
+    >>> index.get_strokes_at(strokes, 1, 0)
+    []
+    >>> index.get_strokes_at(strokes, 2, 0) == [b]
+    True
 
     """
 
-    def __init__(self, before, after, changed_idxs, targ):
-        """Initialize, ready to update a target StrokeShape with diffs
+    def __init__(self):
+        super(StrokeIndex, self).__init__()
+        self._strokes = None  # the strokemap list indexed
+        self._signature = None
+        self._tiles = {}  # {(tx, ty): set([StrokeShape])}
+        self._coords = {}  # {StrokeShape: coords indexed}
+        self._depths = {}  # {StrokeShape: int}, for ordering only
+        self._next_depth = 0
+
+    def __repr__(self):
+        return "<StrokeIndex strokes=%d tiles=%d>" % (
+            len(self._coords),
+            len(self._tiles),
+        )
+
+    @staticmethod
+    def _signature_of(strokes, n):
+        if n <= 0:
+            return (0, None, None)
+        return (n, strokes[0], strokes[n-1])
+
+    def _in_sync(self, strokes):
+        if strokes is not self._strokes:
+            return False
+        return self._signature == self._signature_of(strokes, len(strokes))
+
+    def invalidate(self):
+        """Forget everything, ready for a rebuild on next use"""
+        self._strokes = None
+        self._signature = None
+        self._tiles = {}
+        self._coords = {}
+        self._depths = {}
+        self._next_depth = 0
+
+    def _rebuild(self, strokes):
+        self.invalidate()
+        for depth, shape in enumerate(strokes):
+            self._add(shape, depth)
+        self._next_depth = len(strokes)
+        self._strokes = strokes
+        self._signature = self._signature_of(strokes, len(strokes))
+        logger.debug("Rebuilt %r", self)
+
+    def _add(self, shape, depth):
+        coords = frozenset(shape.tile_coords)
+        tiles = self._tiles
+        for ti in coords:
+            shapes = tiles.get(ti)
+            if shapes is None:
+                tiles[ti] = shapes = set()
+            shapes.add(shape)
+        self._coords[shape] = coords
+        self._depths[shape] = depth
+
+    def _remove(self, shape):
+        coords = self._coords.pop(shape, ())
+        tiles = self._tiles
+        for ti in coords:
+            shapes = tiles.get(ti)
+            if shapes is None:
+                continue
+            shapes.discard(shape)
+            if not shapes:
+                del tiles[ti]
+        return self._depths.pop(shape, None)
+
+    def stroke_added(self, strokes):
+        """Index the newest shape, just after it's been appended
+
+        :param list strokes: the strokemap, ending with the new shape
+        """
+        n = len(strokes)
+        if strokes is not self._strokes:
+            return
+        if self._signature != self._signature_of(strokes, n - 1):
+            self.invalidate()
+            return
+        self._add(strokes[-1], self._next_depth)
+        self._next_depth += 1
+        self._signature = self._signature_of(strokes, n)
+
+    def strokes_changed(self, strokes, changed=(), removed=()):
+        """Update after some shapes moved or shrank, or were removed
+
+        :param list strokes: the strokemap, with removals already made
+        :param iterable changed: shapes whose tile_coords have changed
+        :param iterable removed: shapes which were removed from strokes
+        """
+        removed = list(removed)
+        if strokes is not self._strokes:
+            return
+        if self._signature[0] != len(strokes) + len(removed):
+            self.invalidate()
+            return
+        for shape in removed:
+            self._remove(shape)
+        for shape in changed:
+            depth = self._remove(shape)
+            if depth is not None:
+                self._add(shape, depth)
+        self._signature = self._signature_of(strokes, len(strokes))
+
+    def get_strokes_at(self, strokes, tx, ty):
+        """The shapes which may touch a tile, newest first
+
+        :param list strokes: the strokemap
+        :param int tx: tile X coordinate
+        :param int ty: tile Y coordinate
+        :rtype: list
+        """
+        if not self._in_sync(strokes):
+            self._rebuild(strokes)
+        shapes = self._tiles.get((tx, ty))
+        if not shapes:
+            return []
+        return sorted(shapes, key=self._depths.get, reverse=True)
+
+
+class _TileDiffBatches (object):
+    """Strokemap tile diffs of snapshots, computed by worker threads
+
+    The changed tiles are split into batches, which are diffed and
+    compressed by a pool of worker threads. Snapshot tiles are
+    read-only, so the workers can read them safely. When the last
+    batch is done, the owner's callback is scheduled to run in the
+    main thread, where it can fetch the results.
+
+    """
+
+    def __init__(self, before, after, changed_idxs, done_cb):
+        """Initialize, and start working
 
         :param dict before: Complete pre-stroke tiledict (RO, {xy:Tile})
         :param dict after: Complete post-stroke tiledict (RO, {xy:Tile})
-        :param set changed_idxs: RW set of (x,y) tile indexes to process
-        :param dict targ: Target strokemap (WO, {xy: bytes})
+        :param set changed_idxs: (x,y) tile indexes to process
+        :param callable done_cb: called in the main thread when done
 
         """
+        global _worker_pool
         self._before_dict = before
         self._after_dict = after
-        self._targ_dict = targ
-        self._remaining = changed_idxs
+        self._done_cb = done_cb
+        self._lock = threading.Lock()
+        idxs = list(changed_idxs)
+        batches = [
+            idxs[i:i + DIFF_BATCH_TILES]
+            for i in range(0, len(idxs), DIFF_BATCH_TILES)
+        ]
+        self._remaining = len(batches)
+        with _worker_pool_lock:
+            if _worker_pool is None:
+                _worker_pool = lib.workers.WorkerPool(name="strokemap")
+        self._jobs = [
+            _worker_pool.submit(self._diff_batch, batch)
+            for batch in batches
+        ]
 
     def __repr__(self):
         return "<{name} remaining={remaining}>".format(
             name = self.__class__.__name__,
-            remaining = len(self._remaining),
+            remaining = self._remaining,
         )
 
-    def __call__(self):
-        """Diff and update one queued tile."""
+    def _diff_batch(self, idxs):
+        """Diff and compress a batch of tiles (worker thread)"""
+        transparent = tiledsurface.transparent_tile
+        result = {}
         try:
-            ti = self._remaining.pop()
-        except KeyError:
-            return False
-        self._update_tile(ti)
-        return bool(self._remaining)
+            for ti in idxs:
+                data_before = self._before_dict.get(ti, transparent).rgba
+                data_after = self._after_dict.get(ti, transparent).rgba
+                result[ti] = _Tile.new_from_diff(data_before, data_after)
+        finally:
+            with self._lock:
+                self._remaining -= 1
+                done = (self._remaining == 0)
+            if done:
+                GLib.idle_add(self._done_cb)
+        return result
+
+    def results(self):
+        """Wait for all the batches, then return their diffs
+
+        :returns: the new strokemap tiles, {xy: _Tile}
+        :rtype: dict
 
-    def process_tile_subset(self, pred):
-        """Diff and update a subset of queued tiles now."""
-        processed = set()
-        for ti in self._remaining:
-            if not pred(ti):
-                continue
-            self._update_tile(ti)
-            processed.add(ti)
-        self._remaining -= processed
-
-    def _update_tile(self, ti):
-        """Diff and update the tile at a specified position."""
-        transparent = tiledsurface.transparent_tile
-        data_before = self._before_dict.get(ti, transparent).rgba
-        data_after = self._after_dict.get(ti, transparent).rgba
-        self._targ_dict[ti] = _Tile.new_from_diff(data_before, data_after)
+        """
+        tiles = {}
+        for job in self._jobs:
+            tiles.update(job.result())
+        return tiles
 
 
 class _TileTranslateTask:
@@ -473,16 +719,34 @@ class _Tile:
         return tile
 
     def to_array(self):
-        """Convert to an uncompressed array of ones and zeros."""
+        """Convert to an uncompressed array of ones and zeros.
+
+        Recently used arrays are cached, so the result must be treated
+        as read-only.
+
+        >>> ones, checks, zeros = _Tile._mocks()
+        >>> checks.to_array() is checks.to_array()
+        True
+        >>> checks.to_array().shape == (N, N)
+        True
+
+        """
         if self._all:
-            array = np.ones((N, N), 'uint8')
-        else:
-            array = np.frombuffer(
-                zlib.decompress(self._zdata),
-                dtype='uint8',
-            )
-            array.shape = (N, N)
-        # Can this result always be treated as read-only?
+            return np.ones((N, N), 'uint8')
+        with _bitmap_cache_lock:
+            array = _bitmap_cache.pop(self, None)
+            if array is not None:
+                _bitmap_cache[self] = array
+                return array
+        array = np.frombuffer(
+            zlib.decompress(self._zdata),
+            dtype='uint8',
+        )
+        array.shape = (N, N)
+        with _bitmap_cache_lock:
+            _bitmap_cache[self] = array
+            while len(_bitmap_cache) > BITMAP_CACHE_SIZE:
+                _bitmap_cache.popitem(last=False)
         return array
 
     def to_bytes(self):
@@ -24,6 +24,7 @@ from lib.errors import FileHandlingError
 from lib.gettext import C_
 import lib.feedback
 from lib.pycompat import xrange
+from lib.pycompat import unicode
 
 
 logger = logging.getLogger(__name__)
@@ -224,7 +225,8 @@ def save_as_png(surface, filename, *rect, **kwargs):
     """Saves a tile-blittable surface to a file in PNG format
 
     :param TileBlittable surface: Surface to save
-    :param unicode filename: The file to write
+    :param filename: The file to write, or a binary file open for write
+    :type filename: unicode or file
     :param tuple \*rect: Rectangle (x, y, w, h) to save
     :param bool alpha: If true, write a PNG with alpha
     :param progress: Updates a UI every scanline strip.
@@ -242,6 +244,9 @@ def save_as_png(surface, filename, *rect, **kwargs):
     cHRM and gAMA) will not be saved. MyPaint's default behaviour is
     currently to save these chunks.
 
+    If `filename` is an open file object, it must have a real file
+    descriptor. It is written to but not closed.
+
     Raises `lib.errors.FileHandlingError` with a descriptive string if
     something went wrong.
 
@@ -273,7 +278,15 @@ def save_as_png(surface, filename, *rect, **kwargs):
             alpha,
             save_srgb_chunks,
         )
-        with open(filename, "wb") as writer_fp:
+        close_fp = not hasattr(filename, "write")
+        if close_fp:
+            writer_fp = open(filename, "wb")
+        else:
+            writer_fp = filename
+            filename = getattr(writer_fp, "name", None)
+            if not isinstance(filename, (str, unicode)):
+                filename = u""
+        try:
             pngsave = mypaintlib.ProgressivePNGWriter(
                 writer_fp,
                 w, h,
@@ -299,6 +312,9 @@ def save_as_png(surface, filename, *rect, **kwargs):
                     )
                     progress = None
             pngsave.close()
+        finally:
+            if close_fp:
+                writer_fp.close()
         logger.debug("Finished writing %r", filename)
         if progress:
             progress.close()
@@ -17,6 +17,9 @@ import sys
 import os
 import contextlib
 import logging
+import threading
+import weakref
+import zlib
 
 from gettext import gettext as _
 import numpy as np
@@ -33,8 +36,9 @@ import lib.fileutils
 import lib.modes
 import lib.feedback
 import lib.floodfill
+import lib.workers
 from lib.pycompat import xrange
-from lib.pycompat import PY3, itervalues
+from lib.pycompat import PY3, itervalues, iteritems
 
 logger = logging.getLogger(__name__)
 
@@ -54,6 +58,36 @@ SYMMETRY_STRINGS = {
 for sym_type in SYMMETRY_TYPES:
     assert sym_type in SYMMETRY_STRINGS
 
+# Serializes deferred surface loads, which may be triggered by any
+# thread touching a surface's tiles. Reentrant for the loading thread.
+_PENDING_LOAD_LOCK = threading.RLock()
+
+# Marks surfaces whose deferred load is currently running.
+_LOADING = object()
+
+# Optional storage for cold read-only tiles: see set_tile_store().
+_tile_store = None
+
+# Guards swaps between a tile's pixel array and its compressed copy,
+# which may happen on the tile store's worker thread.
+_TILE_PACK_LOCK = threading.Lock()
+
+# zlib level for packed tiles. Speed matters more than size here.
+TILE_PACK_LEVEL = 1
+
+#: Mipmap tiles regenerated per vectorized pass by regenerate_mipmaps().
+MIPMAP_BATCH_TILES = 64
+
+#: Seconds a move's process() waits for its background worker.
+MOVE_POLL_TIMEOUT = 0.005
+
+#: Tiles moved between checks for a newer move offset.
+MOVE_CHECK_TILES = 64
+
+# Worker threads for moving tiles, see _TiledSurfaceMove
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
 
 ## Tile class and marker tile constants
 
@@ -69,15 +103,141 @@ class _Tile (object):
 
     def __init__(self, copy_from=None):
         super(_Tile, self).__init__()
+        self._packed = None
         if copy_from is None:
-            self.rgba = np.zeros((N, N, 4), 'uint16')
+            self._rgba = np.zeros((N, N, 4), 'uint16')
         else:
-            self.rgba = copy_from.rgba.copy()
+            # Always a plain in-memory array, even if the source tile
+            # was moved into a tile store.
+            self._rgba = np.array(copy_from.rgba)
         self.readonly = False
 
     def copy(self):
         return _Tile(copy_from=self)
 
+    @property
+    def rgba(self):
+        """The tile's pixels, as an NxNx4 uint16 array
+
+        Reading this unpacks the tile if needed.
+
+        """
+        rgba = self._rgba
+        if rgba is None:
+            rgba = self._unpack()
+        return rgba
+
+    @rgba.setter
+    def rgba(self, rgba):
+        self._packed = None
+        self._rgba = rgba
+
+    @rgba.deleter
+    def rgba(self):
+        del self._rgba
+
+    ## Compressed storage
+
+    @property
+    def packed(self):
+        """True if the pixels are only held in compressed form."""
+        return self._rgba is None
+
+    def pack(self):
+        """Drops the pixel array, keeping a compressed copy
+
+        Only read-only tiles can be packed, since their pixels never
+        change. Unpacking drops the compressed copy again, so a tile
+        never holds both for long.
+
+        """
+        if not self.readonly:
+            raise ValueError("Only read-only tiles can be packed")
+        rgba = self._rgba
+        if rgba is None:
+            return
+        packed = pack_tile_data(rgba)
+        with _TILE_PACK_LOCK:
+            if self._rgba is rgba:
+                self._packed = packed
+                self._rgba = None
+
+    def get_packed_data(self):
+        """Returns the pixels in compressed form, for saving
+
+        :rtype: bytes
+
+        See pack_tile_data(). This doesn't pack the tile itself.
+
+        """
+        with _TILE_PACK_LOCK:
+            packed = self._packed
+            rgba = self._rgba
+        if packed is None:
+            packed = pack_tile_data(rgba)
+        return packed
+
+    def _unpack(self):
+        # May race with pack() or another _unpack() on other threads.
+        # The swaps are locked, and the first thread to finish wins.
+        with _TILE_PACK_LOCK:
+            packed = self._packed
+            rgba = self._rgba
+        if rgba is not None:
+            return rgba
+        rgba = unpack_tile_data(packed)
+        with _TILE_PACK_LOCK:
+            if self._rgba is not None:
+                return self._rgba
+            self._rgba = rgba
+            self._packed = None
+        store = _tile_store
+        if store is not None:
+            store.readmit(self)
+        return rgba
+
+    def get_memory_usage(self):
+        """Returns the bytes used by the pixel data (approximate)"""
+        nbytes = 0
+        rgba = self._rgba
+        if rgba is not None:
+            nbytes += rgba.nbytes
+        if self._packed is not None:
+            nbytes += len(self._packed)
+        return nbytes
+
+
+def pack_tile_data(rgba):
+    """Compresses a tile's pixels
+
+    :param numpy.ndarray rgba: NxNx4 uint16 tile array
+    :returns: zlib-compressed pixels, in native byte order
+    :rtype: bytes
+
+    """
+    return zlib.compress(rgba.tobytes(), TILE_PACK_LEVEL)
+
+
+def unpack_tile_data(data, dst=None):
+    """Decompresses a tile's pixels
+
+    :param bytes data: as returned by pack_tile_data()
+    :param numpy.ndarray dst: NxNx4 uint16 array to fill, or None
+    :returns: the filled-in array, or a new one
+    :rtype: numpy.ndarray
+
+    >>> src = np.arange(N * N * 4, dtype='uint16').reshape((N, N, 4))
+    >>> (unpack_tile_data(pack_tile_data(src)) == src).all()
+    True
+
+    """
+    pixels = np.frombuffer(zlib.decompress(data), dtype='uint16')
+    pixels = pixels.reshape((N, N, 4))
+    if dst is None:
+        return pixels.copy()
+    dst[...] = pixels
+    return dst
+
 
 # tile for read-only operations on empty spots
 transparent_tile = _Tile()
@@ -88,6 +248,101 @@ mipmap_dirty_tile = _Tile()
 del mipmap_dirty_tile.rgba
 
 
+def downscale_tiles(src):
+    """Halves the size of a stack of 2x2 tile blocks
+
+    :param numpy.ndarray src: uint16 (n, 2*N, 2*N, 4) array, modified
+    :returns: new uint16 (n, N, N, 4) array
+    :rtype: numpy.ndarray
+
+    This is a vectorized version of mypaintlib.tile_downscale_rgba16(),
+    and gives exactly the same results.
+
+    >>> src = np.arange(2 * 4 * 4 * 4, dtype='uint16').reshape((2, 4, 4, 4))
+    >>> dst = downscale_tiles(src.copy())
+    >>> dst.shape
+    (2, 2, 2, 4)
+    >>> px = src[1, 2:4, 0:2, 3] // 4
+    >>> int(dst[1, 1, 0, 3]) == int(px.sum())
+    True
+
+    """
+    np.right_shift(src, 2, out=src)
+    dst = src[:, 0::2, 0::2] + src[:, 0::2, 1::2]
+    dst += src[:, 1::2, 0::2]
+    dst += src[:, 1::2, 1::2]
+    return dst
+
+
+## Tile store management
+
+
+def set_tile_store(store):
+    """Sets the process-wide store for cold read-only tiles.
+
+    :param store: the store, or None to disable
+    :type store: lib.tilestore.TileStore or lib.tilestore.PackedTileStore
+
+    Tiles become read-only when their surface is snapshotted. If a
+    store is set, they're handed to it then, and it may move their
+    pixel data out to disk, or compress it, when they haven't been
+    used for a while.
+
+    """
+    global _tile_store
+    _tile_store = store
+
+
+def get_tile_store():
+    """Gets the store set with set_tile_store(), or None."""
+    return _tile_store
+
+
+def get_tiles_memory_usage(tiles):
+    """Measures the pixel memory used by some tiles
+
+    :param iterable tiles: the tiles to measure
+    :returns: tiles (count of distinct tiles), packed (how many are
+        compressed), bytes (current pixel memory), and unpacked_bytes
+        (the memory they'd need if all were unpacked).
+    :rtype: dict
+
+    Duplicates and the shared transparent tile are not counted.
+
+    >>> t1 = _Tile()
+    >>> t1.readonly = True
+    >>> t2 = _Tile(copy_from=t1)
+    >>> t2.readonly = True
+    >>> t2.pack()
+    >>> usage = get_tiles_memory_usage([t1, t2, t2, transparent_tile])
+    >>> usage["tiles"], usage["packed"]
+    (2, 1)
+    >>> usage["bytes"] < usage["unpacked_bytes"] == 2 * N * N * 4 * 2
+    True
+    >>> (t2.rgba == t1.rgba).all() and not t2.packed
+    True
+
+    Unpacking drops the compressed copy.
+
+    >>> t2.get_memory_usage() == t1.get_memory_usage()
+    True
+
+    """
+    seen = set()
+    usage = dict(tiles=0, packed=0, bytes=0, unpacked_bytes=0)
+    tile_bytes = transparent_tile.rgba.nbytes
+    for tile in tiles:
+        if tile is transparent_tile or id(tile) in seen:
+            continue
+        seen.add(id(tile))
+        usage["tiles"] += 1
+        if tile.packed:
+            usage["packed"] += 1
+        usage["bytes"] += tile.get_memory_usage()
+        usage["unpacked_bytes"] += tile_bytes
+    return usage
+
+
 ## Class defs: surfaces
 
 class _SurfaceSnapshot (object):
@@ -108,7 +363,10 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
         # TODO: pass just what it needs access to, not all of self
         self._backend = mypaintlib.TiledSurface(self)
-        self.tiledict = {}
+        self._pending_load = None  # see set_pending_load()
+        self._load_error = None  # see load_error
+        self._tiledict = {}
+        self._offset_view = None  # see get_render_source()
         self.observers = []
 
         # Used to implement repeating surfaces, like Background
@@ -118,6 +376,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         self.looped_size = looped_size
 
         self.mipmap_level = mipmap_level
+        self._mipmap_dirty = set()  # tiles marked with mipmap_dirty_tile
         if mipmap_level == 0:
             assert mipmap_surfaces is None
             self._mipmaps = self._create_mipmap_surfaces()
@@ -184,6 +443,133 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
     def backend(self):
         return self._backend
 
+    ## Tile storage and deferred loading
+
+    @property
+    def tiledict(self):
+        """The tile store: {(tx, ty): _Tile}
+
+        Accessing this runs any pending deferred load first.
+
+        """
+        if self._pending_load is not None:
+            self._run_pending_load()
+        return self._tiledict
+
+    @tiledict.setter
+    def tiledict(self, d):
+        self._tiledict = d
+
+    def set_pending_load(self, load, bbox):
+        """Defers loading of this surface's tiles until they're needed
+
+        :param callable load: returns a new surface to adopt tiles from
+        :param tuple bbox: expected data bbox, (x, y, w, h)
+
+        The surface must be empty. Its tiles are loaded on the first
+        access to them, or when finish_pending_load() is called.
+        Until then, get_bbox() reports the expected bbox, tile-aligned.
+        Loads don't notify observers: the surface is treated as if it
+        had had the data all along.
+
+        >>> src = MyPaintSurface._mock()
+        >>> surf = MyPaintSurface()
+        >>> surf.set_pending_load(lambda: src, (0, 0, 5*N, 5*N))
+        >>> surf.has_pending_load
+        True
+        >>> tuple(surf.get_bbox()) == (0, 0, 5*N, 5*N)
+        True
+        >>> len(surf.tiledict) == len(src.tiledict)
+        True
+        >>> surf.has_pending_load
+        False
+
+        """
+        assert self.mipmap_level == 0
+        assert not self._tiledict
+        x, y, w, h = bbox
+        tiles = []
+        if w > 0 and h > 0:
+            tiles = [(x // N, y // N), ((x + w - 1) // N, (y + h - 1) // N)]
+        pending = (load, lib.surface.get_tiles_bbox(tiles))
+        for surf in (self._mipmaps or [self]):
+            surf._pending_load = pending
+
+    @property
+    def has_pending_load(self):
+        """True if the surface still has a deferred load (read-only)"""
+        pending = self._pending_load
+        return (pending is not None) and (pending is not _LOADING)
+
+    @property
+    def load_error(self):
+        """The exception raised by a failed deferred load, or None
+
+        If a deferred load fails, the surface is left empty, but the
+        failure is recorded here.  An empty surface like this does not
+        hold the data it was meant to be loaded from, so it must not be
+        saved in place of that data.
+
+        >>> def broken():
+        ...     raise ValueError("corrupt")
+        >>> surf = MyPaintSurface()
+        >>> surf.set_pending_load(broken, (0, 0, N, N))
+        >>> len(surf.tiledict)
+        0
+        >>> isinstance(surf.load_error, ValueError)
+        True
+        >>> surf.finish_pending_load()
+        Traceback (most recent call last):
+        ...
+        ValueError: corrupt
+
+        """
+        return self._load_error
+
+    def finish_pending_load(self):
+        """Runs any pending deferred load right now
+
+        :raises Exception: the load's failure, if it failed
+
+        Implicit loads, via the tiledict property, never raise: they
+        just record any failure in `load_error`.  This method re-raises
+        it, whichever way the load was run.
+
+        """
+        if self._pending_load is not None:
+            self._run_pending_load()
+        if self._load_error is not None:
+            raise self._load_error
+
+    def _run_pending_load(self):
+        """Runs the deferred load, or waits for it to finish"""
+        with _PENDING_LOAD_LOCK:
+            pending = self._pending_load
+            if pending is None or pending is _LOADING:
+                return
+            mipmaps = self._mipmaps or [self]
+            for surf in mipmaps:
+                surf._pending_load = _LOADING
+            try:
+                load, bbox = pending
+                t0 = time.time()
+                try:
+                    src = load()
+                except Exception as err:
+                    logger.exception("Deferred load failed for %r", self)
+                    for surf in mipmaps:
+                        surf._load_error = err
+                    src = None
+                if src is not None:
+                    base = mipmaps[0]
+                    base._tiledict = dict(src.tiledict)
+                    for (tx, ty) in base._tiledict:
+                        base._mark_mipmap_dirty(tx, ty)
+                logger.debug("%.3fs deferred load", time.time() - t0)
+            finally:
+                for surf in mipmaps:
+                    surf._pending_load = None
+
     def notify_observers(self, *args):
         for f in self.observers:
             f(*args)
@@ -283,8 +669,10 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         self._set_tile_numpy(tx, ty, numpy_tile, readonly)
 
     def _regenerate_mipmap(self, t, tx, ty):
+        # The new tile is only published once it's complete, so that
+        # concurrent readers (e.g. render workers) never see a partly
+        # downscaled tile. At worst they regenerate it twice.
         t = _Tile()
-        self.tiledict[(tx, ty)] = t
         empty = True
 
         for x in xrange(2):
@@ -303,10 +691,92 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
                     empty = False
         if empty:
             # rare case, no need to speed it up
-            del self.tiledict[(tx, ty)]
+            self.tiledict.pop((tx, ty), None)
             t = transparent_tile
+        else:
+            self.tiledict[(tx, ty)] = t
+        self._mipmap_dirty.discard((tx, ty))
         return t
 
+    def regenerate_mipmaps(self, max_tiles=None):
+        """Regenerates dirty mipmap tiles in bulk, one level at a time
+
+        :param int max_tiles: stop after about this many tiles
+        :returns: whether any dirty tiles remain
+        :rtype: bool
+
+        Mipmap tiles are normally regenerated lazily, one at a time,
+        when a zoomed-out render reaches them. After a big change that
+        can take a long time. This does the same work ahead of time,
+        in vectorized passes over many tiles at once. Each level is
+        finished before the next one up, so no recursion is needed.
+
+        With max_tiles, it can be called repeatedly from an idle task.
+
+        >>> surf = MyPaintSurface._mock()
+        >>> lazy = MyPaintSurface._mock()
+        >>> surf.regenerate_mipmaps()
+        False
+        >>> any(m._mipmap_dirty for m in surf._mipmaps)
+        False
+        >>> for level in (1, 2):
+        ...     with lazy._mipmaps[level].tile_request(0, 0, True) as a:
+        ...         with surf._mipmaps[level].tile_request(0, 0, True) as b:
+        ...             assert (a == b).all()
+
+        """
+        if self.mipmap_level != 0:
+            raise ValueError("Only call this on the top-level surface.")
+        if self.has_pending_load or not self._mipmaps:
+            return False
+        remaining = max_tiles
+        for mipmap in self._mipmaps[1:]:
+            dirty = mipmap._mipmap_dirty
+            tiledict = mipmap._tiledict
+            while dirty:
+                if remaining is not None and remaining <= 0:
+                    return True
+                n = MIPMAP_BATCH_TILES
+                if remaining is not None:
+                    n = min(n, remaining)
+                batch = []
+                while dirty and len(batch) < n:
+                    tc = dirty.pop()
+                    if tiledict.get(tc) is mipmap_dirty_tile:
+                        batch.append(tc)
+                mipmap._regenerate_mipmap_batch(batch)
+                if remaining is not None:
+                    remaining -= len(batch)
+        return False
+
+    def _regenerate_mipmap_batch(self, coords):
+        """Regenerates some dirty tiles of this mipmap level together"""
+        if not coords:
+            return
+        parent = self.parent
+        src = np.zeros((len(coords), 2*N, 2*N, 4), 'uint16')
+        nonempty = [False] * len(coords)
+        for i, (tx, ty) in enumerate(coords):
+            for x in xrange(2):
+                for y in xrange(2):
+                    ptx, pty = (tx*2 + x, ty*2 + y)
+                    t = parent._tiledict.get((ptx, pty), transparent_tile)
+                    if t is mipmap_dirty_tile:
+                        t = parent._regenerate_mipmap(t, ptx, pty)
+                    if t is transparent_tile:
+                        continue
+                    src[i, y*N:(y+1)*N, x*N:(x+1)*N] = t.rgba
+                    nonempty[i] = True
+        dst = downscale_tiles(src)
+        for i, tc in enumerate(coords):
+            if nonempty[i]:
+                t = _Tile()
+                t.rgba[...] = dst[i]
+                self._tiledict[tc] = t
+            else:
+                self._tiledict.pop(tc, None)
+            self._mipmap_dirty.discard(tc)
+
     def _get_tile_numpy(self, tx, ty, readonly):
         # OPTIMIZE: do some profiling to check if this function is a bottleneck
         #           yes it is
@@ -326,10 +796,13 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
                 self.tiledict[(tx, ty)] = t
         if t is mipmap_dirty_tile:
             t = self._regenerate_mipmap(t, tx, ty)
-        if t.readonly and not readonly:
-            # shared memory, get a private copy for writing
-            t = t.copy()
-            self.tiledict[(tx, ty)] = t
+        if t.readonly:
+            if not readonly:
+                # shared memory, get a private copy for writing
+                t = t.copy()
+                self.tiledict[(tx, ty)] = t
+            elif _tile_store is not None and t is not transparent_tile:
+                _tile_store.touch(t)
         if not readonly:
             # assert self.mipmap_level == 0
             self._mark_mipmap_dirty(tx, ty)
@@ -350,6 +823,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
                                    None) == mipmap_dirty_tile:
                 break
             mipmap.tiledict[(tx // fac, ty // fac)] = mipmap_dirty_tile
+            mipmap._mipmap_dirty.add((tx // fac, ty // fac))
 
     def blit_tile_into(self, dst, dst_has_alpha, tx, ty, mipmap_level=0,
                        *args, **kwargs):
@@ -438,6 +912,26 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
                     return
             mypaintlib.tile_combine(mode, src, dst, dst_has_alpha, opacity)
 
+    def get_readonly_tile(self, tx, ty, mipmap_level=0):
+        """Get one tile's fix15 data for reading, or None if it's empty
+
+        :param int tx: Tile X coord
+        :param int ty: Tile Y coord
+        :param int mipmap_level: layer mipmap level to use
+        :returns: the tile's data, which must not be modified
+        :rtype: numpy.ndarray
+
+        This is a cheaper alternative to a read-only tile_request(),
+        for compiled rendering. See lib.layer.rendering.RenderProgram.
+
+        """
+        if self.mipmap_level < mipmap_level:
+            return self.mipmap.get_readonly_tile(tx, ty, mipmap_level)
+        rgba = self._get_tile_numpy(tx, ty, True)
+        if rgba is transparent_tile.rgba:
+            return None
+        return rgba
+
     ## Snapshotting
 
     def save_snapshot(self):
@@ -452,13 +946,33 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         for t in itervalues(self.tiledict):
             t.readonly = True
         sshot.tiledict = self.tiledict.copy()
+        sshot.source_ref = weakref.ref(self)
+        store = _tile_store
+        if store is not None and self.mipmap_level == 0:
+            store.add(itervalues(sshot.tiledict))
         return sshot
 
     def load_snapshot(self, sshot):
-        """Loads a saved snapshot, replacing the internal tiledict"""
-        self._load_tiledict(sshot.tiledict)
+        """Loads a saved snapshot, replacing the internal tiledict
+
+        Tiles are shared with the snapshot, copy-on-write. Loading a
+        snapshot of another surface which hasn't changed since, as
+        when duplicating a layer, shares its mipmaps too.
+
+            >>> orig = MyPaintSurface._mock()
+            >>> orig.regenerate_mipmaps()
+            False
+            >>> dup = MyPaintSurface()
+            >>> dup.load_snapshot(orig.save_snapshot())
+            >>> dup.tiledict == orig.tiledict
+            True
+            >>> dup._mipmaps[1].tiledict == orig._mipmaps[1].tiledict
+            True
+
+        """
+        self._load_tiledict(sshot.tiledict, getattr(sshot, "source_ref", None))
 
-    def _load_tiledict(self, d):
+    def _load_tiledict(self, d, source_ref=None):
         """Efficiently loads a tiledict, and notifies the observers"""
         if d == self.tiledict:
             # common case optimization, called via stroke.redo()
@@ -469,12 +983,39 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         self.tiledict = d.copy()
         new = set(self.tiledict.items())
         dirty = old.symmetric_difference(new)
-        for pos, tile in dirty:
-            self._mark_mipmap_dirty(*pos)
+        if not self._share_mipmaps(source_ref):
+            for pos, tile in dirty:
+                self._mark_mipmap_dirty(*pos)
         bbox = lib.surface.get_tiles_bbox(pos for (pos, tile) in dirty)
         if not bbox.empty():
             self.notify_observers(*bbox)
 
+    def _share_mipmaps(self, source_ref):
+        """Adopt another surface's mipmaps, if they're valid here too
+
+        :param weakref.ref source_ref: the other surface, or None
+        :returns: whether the mipmaps were shared
+        :rtype: bool
+
+        They're valid if the other surface has exactly the same tiles
+        as this one. The shared mipmap tiles are marked read-only.
+
+        """
+        source = source_ref and source_ref()
+        if source is None or source is self:
+            return False
+        if not (self._mipmaps and source._mipmaps):
+            return False
+        if source.has_pending_load or source.tiledict != self.tiledict:
+            return False
+        for mipmap, src in zip(self._mipmaps[1:], source._mipmaps[1:]):
+            tiledict = src.tiledict.copy()
+            for t in itervalues(tiledict):
+                t.readonly = True
+            mipmap.tiledict = tiledict
+            mipmap._mipmap_dirty = set(src._mipmap_dirty)
+        return True
+
     ## Loading tile data
 
     def load_from_surface(self, other):
@@ -651,12 +1192,16 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         lib.surface.save_as_png(self, filename, *args, **kwargs)
 
     def get_bbox(self):
+        if self.has_pending_load:
+            return self._pending_load[1].copy()
         return lib.surface.get_tiles_bbox(self.tiledict)
 
     def get_tiles(self):
         return self.tiledict
 
     def is_empty(self):
+        if self.has_pending_load:
+            return self._pending_load[1].empty()
         return not self.tiledict
 
     def remove_empty_tiles(self):
@@ -699,12 +1244,14 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         bbox = lib.surface.get_tiles_bbox(removed)
         self.notify_observers(*bbox)
 
+    ## Moving
+
     def get_move(self, x, y, sort=True):
         """Returns a move object for this surface
 
         :param x: Start position for the move, X coord
         :param y: Start position for the move, X coord
-        :param sort: If true, sort tiles to move by distance from (x,y)
+        :param sort: Ignored, see _TiledSurfaceMove
         :rtype: _TiledSurfaceMove
 
         It's up to the caller to ensure that only one move is active at a
@@ -714,6 +1261,22 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
             raise ValueError("Only call this on the top-level surface.")
         return _TiledSurfaceMove(self, x, y, sort=sort)
 
+    def get_render_source(self):
+        """Returns what to render in place of this surface
+
+        :returns: the surface itself, or a view offsetting it
+        :rtype: lib.surface.TileCompositable
+
+        During an interactive move, the surface's tiles are only moved
+        once the move's background work is done. Until then, it has to
+        be rendered through an offset view. See _TiledSurfaceMove.
+
+        """
+        view = self._offset_view
+        if view is None:
+            return self
+        return view
+
     def flood_fill(self, fill_args, dst):
         """Fills connected areas of this surface into another
 
@@ -837,13 +1400,14 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
 
 class _TiledSurfaceMove (object):
-    """Ongoing move state for a tiled surface, processed in chunks
+    """Ongoing move state for a tiled surface
 
-    Tile move processing involves slicing and copying data from a
-    snapshot of the surface's original tile arrays into an active
-    surface within the model document. It's therefore potentially very
-    slow for huge layers: doing this interactively requires the move to
-    be processed in chunks in idle routines.
+    Moving means slicing and copying data from a snapshot of the
+    surface's original tile arrays into new tiles. That's potentially
+    very slow for huge layers, so interactive moves are shown straight
+    away by rendering the surface through an offset view, while a
+    background worker builds the moved tiles. These are swapped into
+    the surface in one go when they're ready.
 
     Moves are created by a surface's get_move() method starting at a
     particular point in model coordinates.
@@ -853,16 +1417,21 @@ class _TiledSurfaceMove (object):
         ...     a[...] = 1<<15
         >>> len(surf.tiledict)
         1
-        >>> move = surf.get_move(N/2, N/2, sort=True)
+        >>> move = surf.get_move(N/2, N/2)
 
     During an interactive move, the move object is typically updated in
-    response to the user moving the pointer,
+    response to the user moving the pointer. The surface renders as
+    moved immediately, but its tiles don't change yet.
 
         >>> move.update(N/2, N/2)
         >>> move.update(N/2 + 1, N/2 + 3)
+        >>> surf.get_render_source() is surf
+        False
+        >>> list(surf.tiledict.keys())
+        [(10, 10)]
 
-    while being processed in chunks of a few hundred tiles in an idle
-    routine.
+    The move is processed in an idle routine, which picks up the
+    background worker's results when they're ready.
 
         >>> while move.process():
         ...     pass
@@ -873,6 +1442,8 @@ class _TiledSurfaceMove (object):
         >>> move.process(n=-1)
         False
         >>> move.cleanup()
+        >>> surf.get_render_source() is surf
+        True
 
     After the cleanup, the move should not be updated or processed any
     further.
@@ -893,13 +1464,11 @@ class _TiledSurfaceMove (object):
         [(-3, 2)]
         >>> move = surf.get_move(0, 0, sort=False)
         >>> move.update(N*3, -N*2)
-        >>> move.process(n=1)   # single op suffices
+        >>> move.process(n=-1)
         False
         >>> move.cleanup()
         >>> list(surf.tiledict.keys())
         [(0, 0)]
-        >>> # Please excuse the doctest for this special case
-        >>> # just regression-proofing.
 
     Moves can be processed non-interactively by calling all the
     different phases together, as above.
@@ -911,35 +1480,22 @@ class _TiledSurfaceMove (object):
 
         :param x: Where to start, model X coordinate
         :param y: Where to start, model Y coordinate
-        :param sort: If true, sort tiles to move by distance from (x,y)
-
-        Sorting tiles by distance makes the move look nicer when moving
-        interactively, but it's pointless for non-interactive moves.
+        :param sort: Ignored. Tiles used to be moved nearest-first.
 
         """
         object.__init__(self)
         self.surface = surface
         self.snapshot = surface.save_snapshot()
-        self.chunks = []
-        self.chunks[:] = self.snapshot.tiledict.keys()
-        self.sort = sort
-        tx = x // N
-        ty = y // N
         self.start_pos = (x, y)
-        if self.sort:
-            self.chunks.sort(
-                key=lambda p: abs(tx - p[0]) + abs(ty - p[1]),
-            )
-        # High water mark of chunks processed so far.
-        # This is reset on every call to update().
-        self.chunks_i = 0
-        # Tile state tracking for individual update cycles
-        self.written = set()
-        self.blank_queue = []
-        # Tile offsets which we'll be applying,
-        # initially the move is zero.
-        self.slices_x = calc_translation_slices(0)
-        self.slices_y = calc_translation_slices(0)
+        self._bbox = lib.surface.get_tiles_bbox(self.snapshot.tiledict)
+        # Offset wanted by the last update(), and offset of the
+        # surface's tiles right now. The render-time offset covers
+        # the difference.
+        self._offset = (0, 0)
+        self._applied = (0, 0)
+        # Background job building the moved tiles, and its offset
+        self._job = None
+        self._job_offset = None
 
     def update(self, dx, dy):
         """Updates the offset during a move
@@ -947,44 +1503,57 @@ class _TiledSurfaceMove (object):
         :param dx: New move offset: relative to the constructor x.
         :param dy: New move offset: relative to the constructor y.
 
-        This causes all the move's work to be re-queued.
+        The surface is redrawn at the new offset straight away.
+        Any work in progress for the previous offset is abandoned.
+
         """
-        # Nothing has been written in this pass yet
-        self.written = set()
-        # Tile indices to be cleared during processing,
-        # unless they've been written to
-        self.blank_queue[:] = self.surface.tiledict.keys()  # fresh!
-        if self.sort:
-            x, y = self.start_pos
-            tx = (x + dx) // N
-            ty = (y + dy) // N
-            self.blank_queue.sort(
-                key=lambda p: abs(tx - p[0]) + abs(ty - p[1]),
+        offset = (int(dx), int(dy))
+        if offset == self._offset:
+            return
+        redraw_bbox = self._get_moved_bbox()
+        self._offset = offset
+        self._update_view()
+        if self._bbox.empty():
+            return
+        redraw_bbox.expandToIncludeRect(self._get_moved_bbox())
+        self.surface.notify_observers(*redraw_bbox)
+
+    def _get_moved_bbox(self):
+        """Area of the moved data, at the wanted offset (internal)"""
+        bbox = self._bbox.copy()
+        bbox.x += self._offset[0]
+        bbox.y += self._offset[1]
+        return bbox
+
+    def _update_view(self):
+        """Sets up the surface's render-time offset (internal)"""
+        dx = self._offset[0] - self._applied[0]
+        dy = self._offset[1] - self._applied[1]
+        if (dx, dy) == (0, 0):
+            self.surface._offset_view = None
+        else:
+            self.surface._offset_view = _OffsetSurfaceView(
+                self.surface, dx, dy,
             )
-        # Calculate offsets
-        self.slices_x = calc_translation_slices(int(dx))
-        self.slices_y = calc_translation_slices(int(dy))
-        # Need to process every source chunk
-        self.chunks_i = 0
 
     def cleanup(self):
         """Cleans up after processing the move.
 
         This must be called after the move has been processed fully, and
-        should only be called after `process()` indicates that all tiles have
-        been sliced and moved.
+        should only be called after `process()` indicates that the moved
+        tiles have been swapped in.
 
         """
         # Process any remaining work. Caller should have done this already.
-        if self.chunks_i < len(self.chunks) or len(self.blank_queue) > 0:
+        if self._job is not None or self._applied != self._offset:
             logger.warning("Stuff left to do at end of move cleanup(). May "
                            "result in poor interactive appearance. "
-                           "chunks=%d/%d, blanks=%d", self.chunks_i,
-                           len(self.chunks), len(self.blank_queue))
+                           "offset=%r, applied=%r", self._offset,
+                           self._applied)
             logger.warning("Doing cleanup now...")
             self.process(n=-1)
-        assert self.chunks_i >= len(self.chunks)
-        assert len(self.blank_queue) == 0
+        assert self._applied == self._offset
+        assert self.surface._offset_view is None
         # Remove empty tiles created by Layer Move
         removed, total = self.surface.remove_empty_tiles()
         logger.debug(
@@ -993,98 +1562,194 @@ class _TiledSurfaceMove (object):
         )
 
     def process(self, n=200):
-        """Process a number of pending tile moves
+        """Process pending work for the move
 
-        :param int n: The number of source tiles to process in this call
-        :returns: whether there are any more tiles to process
+        :param int n: Zero or negative to finish everything now
+        :returns: whether there is any more work to process
         :rtype: bool
 
-        Specify zero or negative `n` to process all remaining tiles.
+        Normally this just checks on the background worker, waiting
+        for it briefly, and swaps in the moved tiles when they're
+        ready for the current offset. It starts the worker if needed.
+        Specify zero or negative `n` to do any remaining work in this
+        thread, and swap it in before returning. Positive values are
+        otherwise ignored.
 
         """
-        updated = set()
-        moves_remaining = self._process_moves(n, updated)
-        blanks_remaining = self._process_blanks(n, updated)
-        for pos in updated:
-            self.surface._mark_mipmap_dirty(*pos)
-        bbox = lib.surface.get_tiles_bbox(updated)
-        self.surface.notify_observers(*bbox)
-        return blanks_remaining or moves_remaining
-
-    def _process_moves(self, n, updated):
-        """Internal: process pending tile moves
-
-        :param int n: as for process()
-        :param set updated: Set of tile indices to be redrawn (in+out)
-        :returns: Whether moves need to be processed
-        :rtype: bool
+        if n <= 0:
+            self._finish()
+            return False
+        job = self._job
+        if job is not None:
+            if not job.wait(MOVE_POLL_TIMEOUT):
+                return True
+            self._job = None
+            tiles = job.result()
+            if tiles is not None and self._job_offset == self._offset:
+                self._swap(tiles, self._job_offset)
+        if self._applied == self._offset:
+            return False
+        self._start_job()
+        return True
+
+    def _start_job(self):
+        """Start moving tiles to the wanted offset in the background"""
+        global _worker_pool
+        with _worker_pool_lock:
+            if _worker_pool is None:
+                _worker_pool = lib.workers.WorkerPool(name="move")
+        self._job_offset = self._offset
+        self._job = _worker_pool.submit(self._move_tiles, *self._offset)
+
+    def _finish(self):
+        """Move tiles to the wanted offset now, and swap them in"""
+        job = self._job
+        self._job = None
+        if job is not None:
+            job.cancel()
+            tiles = job.result()
+            if tiles is not None and self._job_offset == self._offset:
+                self._swap(tiles, self._job_offset)
+        if self._applied != self._offset:
+            tiles = self._move_tiles(*self._offset)
+            self._swap(tiles, self._offset)
+
+    def _move_tiles(self, dx, dy):
+        """Returns a new tiledict, moved from the snapshot
+
+        :param int dx: X offset to move by, in pixels
+        :param int dy: Y offset to move by, in pixels
+        :returns: moved tiles, or None if the offset became stale
+        :rtype: dict
+
+        This may be called in a worker thread. It only reads the
+        snapshot, which is never modified.
 
         """
-        if self.chunks_i > len(self.chunks):
-            return False
-        if n <= 0:
-            n = len(self.chunks)  # process all remaining
-        is_integral = len(self.slices_x) == 1 and len(self.slices_y) == 1
-        for src_t in self.chunks[self.chunks_i:self.chunks_i + n]:
-            src_tx, src_ty = src_t
-            src_tile = self.snapshot.tiledict[src_t]
-            for slice_x in self.slices_x:
+        src_tiles = self.snapshot.tiledict
+        slices_x = calc_translation_slices(dx)
+        slices_y = calc_translation_slices(dy)
+        if len(slices_x) == 1 and len(slices_y) == 1:
+            # We're lucky. The read-only tiles can just be shared.
+            tdx = slices_x[0][1][0]
+            tdy = slices_y[0][1][0]
+            return dict(
+                ((tx + tdx, ty + tdy), tile)
+                for ((tx, ty), tile) in iteritems(src_tiles)
+            )
+        tiles = {}
+        for i, ((src_tx, src_ty), src_tile) in enumerate(
+                iteritems(src_tiles)):
+            if i % MOVE_CHECK_TILES == 0 and self._offset != (dx, dy):
+                return None
+            src = src_tile.rgba
+            for slice_x in slices_x:
                 (src_x0, src_x1), (targ_tdx, targ_x0, targ_x1) = slice_x
-                for slice_y in self.slices_y:
+                for slice_y in slices_y:
                     (src_y0, src_y1), (targ_tdy, targ_y0, targ_y1) = slice_y
-                    targ_tx = src_tx + targ_tdx
-                    targ_ty = src_ty + targ_tdy
-                    targ_t = targ_tx, targ_ty
-                    if is_integral:
-                        # We're lucky. Perform a straight data copy.
-                        self.surface.tiledict[targ_t] = src_tile.copy()
-                        updated.add(targ_t)
-                        self.written.add(targ_t)
-                        continue
-                    # Get a tile to write
-                    targ_tile = None
-                    if targ_t in self.written:
-                        # Reuse a target tile made earlier in this
-                        # update cycle
-                        targ_tile = self.surface.tiledict.get(targ_t, None)
+                    targ_t = (src_tx + targ_tdx, src_ty + targ_tdy)
+                    targ_tile = tiles.get(targ_t)
                     if targ_tile is None:
-                        # Create and store a new blank target tile
-                        # to avoid corruption
                         targ_tile = _Tile()
-                        self.surface.tiledict[targ_t] = targ_tile
-                        self.written.add(targ_t)
-                    # Copy this source slice to the destination
+                        tiles[targ_t] = targ_tile
                     targ_tile.rgba[targ_y0:targ_y1, targ_x0:targ_x1] \
-                        = src_tile.rgba[src_y0:src_y1, src_x0:src_x1]
-                    updated.add(targ_t)
-            # The source tile has been fully processed at this point,
-            # and can be removed from the output dict if it hasn't
-            # also been written to.
-            if src_t in self.surface.tiledict and src_t not in self.written:
-                self.surface.tiledict.pop(src_t, None)
-                updated.add(src_t)
-        # Move on, and return whether we're complete
-        self.chunks_i += n
-        return self.chunks_i < len(self.chunks)
-
-    def _process_blanks(self, n, updated):
-        """Internal: process blanking-out queue
-
-        :param int n: as for process()
-        :param set updated: Set of tile indices to be redrawn (in+out)
-        :returns: Whether the blanking queue is empty
-        :rtype: bool
+                        = src[src_y0:src_y1, src_x0:src_x1]
+        return tiles
+
+    def _swap(self, tiles, offset):
+        """Swap moved tiles into the surface, atomically (internal)"""
+        self._applied = offset
+        self._update_view()
+        self.surface._load_tiledict(tiles)
+
+
+class _OffsetSurfaceView (TileCompositable):
+    """Render-time view of a surface, offset by some pixels
+
+    Used to show an ongoing move before its tiles have been moved.
+    Tiles are assembled from up to four of the surface's tiles as they
+    are requested. At mipmap levels above zero, the offset is scaled
+    down and rounded, so the view is only approximate there.
+
+    >>> surf = MyPaintSurface()
+    >>> with surf.tile_request(0, 0, readonly=False) as a:
+    ...     a[...] = 1
+    >>> view = _OffsetSurfaceView(surf, N-1, -1)
+    >>> view.get_readonly_tile(-1, 0) is None
+    True
+    >>> t = view.get_readonly_tile(0, -1)
+    >>> int(t.sum()), int(t[N-1, N-1, 0]), int(t[N-2, N-1, 0])
+    (4, 1, 0)
+
+    """
+
+    def __init__(self, surface, dx, dy):
+        super(_OffsetSurfaceView, self).__init__()
+        self._surface = surface
+        self._dx = int(dx)
+        self._dy = int(dy)
+
+    def __repr__(self):
+        return "<_OffsetSurfaceView %r dx=%d dy=%d>" % (
+            self._surface, self._dx, self._dy,
+        )
+
+    def get_bbox(self):
+        """The surface's data bbox, offset"""
+        bbox = self._surface.get_bbox()
+        bbox.x += self._dx
+        bbox.y += self._dy
+        return bbox
+
+    def get_readonly_tile(self, tx, ty, mipmap_level=0):
+        """Assemble a tile of the view, or None if it's empty there
+
+        See MyPaintSurface.get_readonly_tile().
 
         """
-        if n <= 0:
-            n = len(self.blank_queue)
-        while len(self.blank_queue) > 0 and n > 0:
-            t = self.blank_queue.pop(0)
-            if t not in self.written:
-                self.surface.tiledict.pop(t, None)
-                updated.add(t)
-                n -= 1
-        return len(self.blank_queue) > 0
+        get = self._surface.get_readonly_tile
+        scale = 1 << mipmap_level
+        src_tx, x = divmod(tx * N - self._dx // scale, N)
+        src_ty, y = divmod(ty * N - self._dy // scale, N)
+        if x == 0 and y == 0:
+            return get(src_tx, src_ty, mipmap_level)
+        dst = None
+        for (dty, src_y0, src_y1, dst_y0) in ((0, y, N, 0), (1, 0, y, N-y)):
+            if src_y0 == src_y1:
+                continue
+            for (dtx, src_x0, src_x1, dst_x0) in ((0, x, N, 0),
+                                                   (1, 0, x, N-x)):
+                if src_x0 == src_x1:
+                    continue
+                src = get(src_tx + dtx, src_ty + dty, mipmap_level)
+                if src is None:
+                    continue
+                if dst is None:
+                    dst = np.zeros((N, N, 4), 'uint16')
+                dst_y1 = dst_y0 + src_y1 - src_y0
+                dst_x1 = dst_x0 + src_x1 - src_x0
+                dst[dst_y0:dst_y1, dst_x0:dst_x1] \
+                    = src[src_y0:src_y1, src_x0:src_x1]
+        return dst
+
+    def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level=0,
+                       opacity=1.0, mode=mypaintlib.CombineNormal,
+                       *args, **kwargs):
+        """Composite one tile of the view over a NumPy array.
+
+        See MyPaintSurface.composite_tile().
+
+        """
+        src = self.get_readonly_tile(tx, ty, mipmap_level)
+        if src is None:
+            if dst_has_alpha:
+                if mode in lib.modes.MODES_CLEARING_BACKDROP_AT_ZERO_ALPHA:
+                    mypaintlib.tile_clear_rgba16(dst)
+                    return
+            if mode not in lib.modes.MODES_EFFECTIVE_AT_ZERO_ALPHA:
+                return
+            src = transparent_tile.rgba
+        mypaintlib.tile_combine(mode, src, dst, dst_has_alpha, opacity)
 
 
 def calc_translation_slices(dc):
@@ -0,0 +1,321 @@
+# This file is part of MyPaint.
+# Copyright (C) 2026 by the MyPaint Development Team.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Sparse spatial index of which surfaces have data at each tile.
+
+Rendering a tile used to mean asking every layer's surface for its
+tile there, even on sparse canvases where most layers have nothing at
+most tiles. The index here inverts that: for each tile position, it
+knows the set of surfaces with a tile there, so callers only visit
+the ones that matter.
+
+The index is kept up to date by its owner, from the same change
+notifications which invalidate the render cache (see
+RootLayerStack.layer_content_changed). Per-surface tile sets are
+built lazily on first use, and so are the coarser per-mipmap-level
+maps. After that, updates only touch the tiles which changed.
+
+The index may report a surface as having data where it has only an
+empty tile, but it must never miss a tile. Surfaces with a pending
+deferred load aren't indexed until the load has happened.
+
+"""
+
+## Imports
+
+from __future__ import division, print_function
+
+import threading
+import logging
+
+import lib.surface
+from lib.pycompat import iteritems
+from lib.pycompat import xrange
+
+
+logger = logging.getLogger(__name__)
+
+
+## Module constants
+
+#: Shared, read-only result for tiles where no surface has data.
+_NOTHING = {}
+
+
+## Class defs
+
+
+class TileIndex (object):
+    """Which of a set of surfaces have data at each tile.
+
+    Surfaces need a get_tiles() method returning their tile dict,
+    and may have a "has_pending_load" property.
+
+    >>> class Surf (object):
+    ...     def __init__(self, *tiles):
+    ...         self.tiles = dict((t, object()) for t in tiles)
+    ...     def get_tiles(self):
+    ...         return self.tiles
+    >>> a = Surf((0, 0), (1, 0))
+    >>> b = Surf((1, 0), (5, 5))
+    >>> index = TileIndex()
+    >>> index.track([a, b])
+    >>> index.tracks(a) and index.tracks(b)
+    True
+    >>> sorted(len(index.get_surfaces_at(tx, 0)) for tx in range(3))
+    [0, 1, 2]
+
+    Coarser mipmap levels merge blocks of tiles.
+
+    >>> len(index.get_surfaces_at(0, 0, 1))
+    2
+    >>> list(index.get_surfaces_at(2, 2, 1)) == [b]
+    True
+
+    Updates check the surface's tiles in the affected area only.
+
+    >>> del a.tiles[(1, 0)]
+    >>> a.tiles[(9, 9)] = object()
+    >>> index.update(a, [(1, 0), (9, 9)])
+    >>> list(index.get_surfaces_at(1, 0)) == [b]
+    True
+    >>> a in index.get_surfaces_at(4, 4, 1)
+    True
+    >>> sorted(index.get_tile_coords(a))
+    [(0, 0), (9, 9)]
+
+    """
+
+    def __init__(self):
+        super(TileIndex, self).__init__()
+        self._lock = threading.RLock()
+        self._tracked = set()  # surfaces the index may answer for
+        self._coords = {}  # {surface: set((tx, ty))}, level 0
+        self._bboxes = {}  # {surface: Rect}
+        self._levels = {}  # {level: {(tx, ty): {surface: count}}}
+
+    def __repr__(self):
+        return "<TileIndex tracked=%d indexed=%d levels=%r>" % (
+            len(self._tracked),
+            len(self._coords),
+            sorted(self._levels.keys()),
+        )
+
+    ## Membership
+
+    def track(self, surfaces):
+        """Sets which surfaces are indexed, forgetting any others.
+
+        :param iterable surfaces: the surfaces to index
+
+        Their tiles are only read when the index needs them.
+
+        """
+        surfaces = set(surfaces)
+        with self._lock:
+            for surface in self._tracked - surfaces:
+                self.invalidate(surface)
+            self._tracked = surfaces
+
+    def tracks(self, surface):
+        """Whether the index can answer for a surface right now.
+
+        :rtype: bool
+
+        Callers must check this before relying on the index for a
+        surface: it's what indexes the surface's tiles the first time.
+
+        """
+        if surface not in self._tracked:
+            return False
+        if getattr(surface, "has_pending_load", False):
+            return False
+        if surface not in self._coords:
+            with self._lock:
+                if surface not in self._coords:
+                    self._add(surface)
+        return True
+
+    def _add(self, surface):
+        """Index a surface's tiles (internal, lock held)"""
+        coords = set(surface.get_tiles().keys())
+        for level, levelmap in iteritems(self._levels):
+            for (tx, ty) in coords:
+                self._incr(levelmap, (tx >> level, ty >> level), surface)
+        self._coords[surface] = coords
+
+    ## Updates
+
+    def invalidate(self, surface):
+        """Forgets what the index knows about a surface's tiles.
+
+        They'll be indexed again the next time they're needed.
+
+        """
+        with self._lock:
+            coords = self._coords.pop(surface, None)
+            self._bboxes.pop(surface, None)
+            if not coords:
+                return
+            for level, levelmap in iteritems(self._levels):
+                for (tx, ty) in coords:
+                    self._decr(levelmap, (tx >> level, ty >> level), surface)
+
+    def invalidate_all(self):
+        """Forgets everything except which surfaces are tracked."""
+        with self._lock:
+            self._coords.clear()
+            self._bboxes.clear()
+            self._levels.clear()
+
+    def update(self, surface, tiles):
+        """Re-checks whether a surface has data at some tiles.
+
+        :param surface: the surface which changed
+        :param iterable tiles: the level 0 tile coords to check
+
+        """
+        with self._lock:
+            coords = self._coords.get(surface)
+            if coords is None:
+                return
+            if getattr(surface, "has_pending_load", False):
+                self.invalidate(surface)
+                return
+            tiledict = surface.get_tiles()
+            changed = False
+            for tc in tiles:
+                present = (tc in tiledict)
+                if present == (tc in coords):
+                    continue
+                changed = True
+                tx, ty = tc
+                if present:
+                    coords.add(tc)
+                    update_func = self._incr
+                else:
+                    coords.discard(tc)
+                    update_func = self._decr
+                for level, levelmap in iteritems(self._levels):
+                    update_func(levelmap, (tx >> level, ty >> level), surface)
+            if changed:
+                self._bboxes.pop(surface, None)
+
+    def update_area(self, surface, x, y, w, h):
+        """Re-checks the tiles in a rectangle of pixels, as for update().
+
+        A zero-sized rectangle means that anything may have changed.
+
+        """
+        if w <= 0 or h <= 0:
+            self.invalidate(surface)
+            return
+        n = lib.surface.N
+        tx0, ty0 = int(x) // n, int(y) // n
+        tx1, ty1 = int(x + w - 1) // n, int(y + h - 1) // n
+        self.update(surface, (
+            (tx, ty)
+            for ty in xrange(ty0, ty1 + 1)
+            for tx in xrange(tx0, tx1 + 1)
+        ))
+
+    # The per-tile dicts are replaced rather than modified, so that
+    # readers on other threads can iterate over them safely.
+
+    @staticmethod
+    def _incr(levelmap, tc, surface):
+        counts = dict(levelmap.get(tc, _NOTHING))
+        counts[surface] = counts.get(surface, 0) + 1
+        levelmap[tc] = counts
+
+    @staticmethod
+    def _decr(levelmap, tc, surface):
+        counts = levelmap.get(tc)
+        if counts is None or surface not in counts:
+            return
+        counts = dict(counts)
+        if counts[surface] > 1:
+            counts[surface] -= 1
+        else:
+            del counts[surface]
+        if counts:
+            levelmap[tc] = counts
+        else:
+            del levelmap[tc]
+
+    ## Queries
+
+    def get_surfaces_at(self, tx, ty, level=0):
+        """Indexed surfaces with data at a tile.
+
+        :param int tx: tile X coordinate, at the given level
+        :param int ty: tile Y coordinate, at the given level
+        :param int level: mipmap level
+        :returns: read-only container of surfaces
+        :rtype: dict
+
+        Only surfaces for which tracks() has been true since they last
+        changed are included.
+
+        """
+        levelmap = self._levels.get(level)
+        if levelmap is None:
+            levelmap = self._build_level(level)
+        return levelmap.get((tx, ty), _NOTHING)
+
+    def _build_level(self, level):
+        with self._lock:
+            levelmap = self._levels.get(level)
+            if levelmap is not None:
+                return levelmap
+            levelmap = {}
+            for surface, coords in iteritems(self._coords):
+                for (tx, ty) in coords:
+                    self._incr(levelmap, (tx >> level, ty >> level), surface)
+            self._levels[level] = levelmap
+            logger.debug("Built %r level %d", self, level)
+            return levelmap
+
+    def get_tile_coords(self, surface):
+        """The level 0 tiles where a tracked surface has data.
+
+        :returns: read-only set of (tx, ty)
+        :rtype: set
+
+        """
+        if not self.tracks(surface):
+            raise KeyError("Surface %r is not indexed" % (surface,))
+        return self._coords[surface]
+
+    def get_bbox(self, surface):
+        """The data bbox of a tracked surface, tile-aligned.
+
+        :rtype: lib.helpers.Rect
+
+        """
+        coords = self.get_tile_coords(surface)
+        bbox = self._bboxes.get(surface)
+        if bbox is None:
+            bbox = lib.surface.get_tiles_bbox(coords)
+            self._bboxes[surface] = bbox
+        return bbox.copy()
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
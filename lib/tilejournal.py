@@ -0,0 +1,313 @@
+# This file is part of MyPaint.
+# Copyright (C) 2026 by the MyPaint Development Team.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Append-only tile journals, for incremental autosave.
+
+Autosaving a layer used to mean re-encoding all of it as a PNG, even
+if only one dab had changed since the last autosave. A tile journal
+instead records a surface as a sequence of compressed tile records,
+and each autosave appends just the tiles which changed.
+
+Finding those tiles is cheap. Snapshotting a surface marks its tiles
+read-only, and tile_request() never writes to a read-only tile in
+place: it swaps in a copy. So every tile object which differs from the
+one recorded at the previous autosave has changed, and every other
+tile hasn't. No hooks in the painting code are needed.
+
+Journals grow as tiles are rewritten, so once most of a journal's
+records are stale it is compacted, by starting a new generation of it
+holding only the current tiles. A new generation is a new file, so the
+previous one stays intact until the stack.xml which names it has been
+replaced.
+
+File format: an 11-byte header (magic, tile size, byte order of the
+pixel data), then records. Each record is a little-endian (tx, ty,
+nbytes) header followed by nbytes of zlib-compressed RGBA uint16 tile
+data. A record with nbytes=0 marks a removed tile. Later records win.
+Readers stop at a given committed length, or at a truncated record.
+
+"""
+
+## Imports
+
+from __future__ import division, print_function
+
+import os
+import sys
+import struct
+import logging
+
+from lib.pycompat import iteritems
+
+
+logger = logging.getLogger(__name__)
+
+
+## Module constants
+
+#: Records written per call of an update task.
+RECORDS_PER_CALL = 32
+
+#: Compact when the journal has this many times more records than tiles.
+COMPACT_RATIO = 2
+
+#: ... but don't bother compacting journals smaller than this.
+COMPACT_MIN_RECORDS = 256
+
+_MAGIC = b"MYPTJNL1"
+_HEADER = struct.Struct("<8sHc")
+_RECORD = struct.Struct("<iiI")
+_BYTEORDER = (b"<" if sys.byteorder == "little" else b">")
+
+
+## Reading
+
+
+def read_journal(path, tile_size, size=None):
+    """Reads a tile journal's current tiles
+
+    :param unicode path: the journal file
+    :param int tile_size: expected tile size
+    :param int size: committed length, or None to read everything
+    :returns: the surviving tiles' compressed data
+    :rtype: dict, {(tx, ty): bytes}
+    :raises ValueError: if the file isn't a compatible tile journal
+
+    >>> import tempfile, shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> j = TileJournal(tmpdir, u"doctest", tile_size=2)
+    >>> class Tile (object):
+    ...     def __init__(self, data):
+    ...         self.data = data
+    ...     def get_packed_data(self):
+    ...         return self.data
+    >>> t1, t2, t3 = Tile(b"a"), Tile(b"bb"), Tile(b"ccc")
+    >>> sizes = []
+    >>> done = lambda j: sizes.append(j.size)
+    >>> def run(tiles):
+    ...     task = j.get_update_task(tiles, done)
+    ...     while task and task():
+    ...         pass
+    ...     return read_journal(j.path, 2, sizes[-1])
+    >>> sorted(run({(0, 0): t1, (1, 0): t2}).items())
+    [((0, 0), b'a'), ((1, 0), b'bb')]
+
+    Only changed tiles are appended, and removals are recorded.
+
+    >>> tiles = run({(1, 0): t3})
+    >>> sorted(tiles.items())
+    [((1, 0), b'ccc')]
+    >>> j.nrecords
+    4
+
+    Reading stops at the committed length, so partial updates
+    are ignored.
+
+    >>> sorted(read_journal(j.path, 2, sizes[0]).items())
+    [((0, 0), b'a'), ((1, 0), b'bb')]
+    >>> shutil.rmtree(tmpdir)
+
+    """
+    tiles = {}
+    with open(path, "rb") as fp:
+        header = fp.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError("%r: truncated header" % (path,))
+        magic, file_tile_size, byteorder = _HEADER.unpack(header)
+        if magic != _MAGIC:
+            raise ValueError("%r is not a tile journal" % (path,))
+        if file_tile_size != tile_size or byteorder != _BYTEORDER:
+            raise ValueError(
+                "%r: incompatible tile journal (%d%s)"
+                % (path, file_tile_size, byteorder.decode("ascii"))
+            )
+        pos = _HEADER.size
+        while size is None or pos < size:
+            rec = fp.read(_RECORD.size)
+            if len(rec) < _RECORD.size:
+                break
+            tx, ty, nbytes = _RECORD.unpack(rec)
+            data = fp.read(nbytes)
+            if len(data) < nbytes:
+                break
+            pos += _RECORD.size + nbytes
+            if size is not None and pos > size:
+                break
+            if nbytes:
+                tiles[(tx, ty)] = data
+            else:
+                tiles.pop((tx, ty), None)
+    return tiles
+
+
+## Writing
+
+
+class TileJournal (object):
+    """Autosave state for one surface: which tiles its journal holds
+
+    Tiles passed in must be read-only, e.g. from a snapshot, and must
+    support get_packed_data(): see lib.tiledsurface._Tile.
+
+    """
+
+    def __init__(self, dirname, prefix, tile_size):
+        """Initialize, without writing anything yet.
+
+        :param unicode dirname: folder for the journal's files
+        :param unicode prefix: file name prefix, unique to the surface
+        :param int tile_size: tile size, for the header
+
+        """
+        super(TileJournal, self).__init__()
+        self._dirname = dirname
+        self._prefix = prefix
+        self._tile_size = tile_size
+        self._generation = -1
+        self._written = {}  # {(tx, ty): tile}, as recorded in the file
+        self._nrecords = 0
+        self._size = 0  # bytes written to the current generation
+
+    def __repr__(self):
+        return "<TileJournal %r tiles=%d records=%d>" % (
+            self.filename,
+            len(self._written),
+            self._nrecords,
+        )
+
+    @property
+    def filename(self):
+        """Base name of the current generation's file"""
+        return u"%s-%d.tiles" % (self._prefix, max(0, self._generation))
+
+    @property
+    def path(self):
+        """Full path to the current generation's file"""
+        return os.path.join(self._dirname, self.filename)
+
+    @property
+    def size(self):
+        """Committed length of the current generation's file"""
+        return self._size
+
+    @property
+    def nrecords(self):
+        """Records in the current generation, including stale ones"""
+        return self._nrecords
+
+    def get_update_task(self, tiledict, done_cb=None):
+        """Prepare to bring the journal up to date with some tiles
+
+        :param dict tiledict: the surface's tiles, {(tx, ty): tile}
+        :param callable done_cb: called as done_cb(journal) at the end
+        :returns: a piecemeal task for lib.idletask.Processor, or None
+            if nothing changed.
+
+        The journal's filename is decided here, so callers can index it
+        before the task runs. If the task is dropped before finishing,
+        the tiles it didn't write are simply written next time.
+
+        """
+        tiles = dict(tiledict)
+        written = self._written
+        fresh = (self._generation < 0 or self._needs_compaction(tiles))
+        if fresh:
+            self._generation += 1
+            self._written = written = {}
+            self._nrecords = 0
+            self._size = 0
+            changes = sorted(iteritems(tiles))
+            removals = []
+        else:
+            changes = [
+                (pos, tile) for (pos, tile) in iteritems(tiles)
+                if written.get(pos) is not tile
+            ]
+            changes.sort()
+            removals = sorted(pos for pos in written if pos not in tiles)
+        if not (fresh or changes or removals):
+            return None
+        logger.debug(
+            "%r: queueing %d changed and %d removed tiles",
+            self, len(changes), len(removals),
+        )
+        return _JournalUpdateTask(
+            self, fresh, changes, removals, done_cb,
+        )
+
+    def _needs_compaction(self, tiles):
+        if self._nrecords < COMPACT_RATIO * len(tiles):
+            return False
+        return self._nrecords >= COMPACT_MIN_RECORDS
+
+    def _append(self, records, truncate):
+        """Appends [(pos, tile or None)], updating the state (internal)"""
+        mode = truncate and "wb" or "ab"
+        path = self.path
+        with open(path, mode) as fp:
+            fp.seek(0, os.SEEK_END)
+            if fp.tell() == 0:
+                fp.write(_HEADER.pack(_MAGIC, self._tile_size, _BYTEORDER))
+            for (tx, ty), tile in records:
+                data = b""
+                if tile is not None:
+                    data = tile.get_packed_data()
+                fp.write(_RECORD.pack(tx, ty, len(data)))
+                fp.write(data)
+            size = fp.tell()
+        for pos, tile in records:
+            if tile is None:
+                self._written.pop(pos, None)
+            else:
+                self._written[pos] = tile
+        self._nrecords += len(records)
+        self._size = size
+
+
+class _JournalUpdateTask (object):
+    """Piecemeal callable: appends changed tiles to a TileJournal"""
+
+    def __init__(self, journal, fresh, changes, removals, done_cb):
+        super(_JournalUpdateTask, self).__init__()
+        self._journal = journal
+        self._truncate = fresh
+        self._records = list(changes)
+        self._records.extend((pos, None) for pos in removals)
+        self._generation = journal._generation
+        self._done_cb = done_cb
+
+    def __call__(self, *args, **kwargs):
+        journal = self._journal
+        if journal._generation != self._generation:
+            return False  # superseded by a compaction
+        chunk = self._records[:RECORDS_PER_CALL]
+        del self._records[:RECORDS_PER_CALL]
+        if chunk or self._truncate:
+            journal._append(chunk, self._truncate)
+            self._truncate = False
+        if self._records:
+            return True
+        logger.debug("autosave: updated %r", journal)
+        if self._done_cb:
+            self._done_cb(journal)
+        return False
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
@@ -0,0 +1,520 @@
+# This file is part of MyPaint.
+# Copyright (C) 2026 by the MyPaint Development Team.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Storage for cold, read-only surface tiles.
+
+Every tile in a MyPaintSurface is a 64x64 RGBA uint16 array: 32 KiB.
+Big documents with many layers, and long undo histories, can easily
+outgrow physical RAM.
+
+Tiles become read-only when a surface is snapshotted, and from then on
+they are never written in place (see MyPaintSurface.tile_request()).
+That makes them safe to move. The stores here keep the most recently
+used read-only tiles as they are, and move the rest somewhere cheaper.
+The tile objects themselves stay the same, so tiledicts and snapshots
+don't notice.
+
+TileStore moves cold tiles into slots in a memory-mapped file. The OS
+pages spilled tiles in and out as they are read; page cache pressure
+never pushes them into swap.
+
+PackedTileStore compresses cold tiles in RAM instead. Tiles written by
+brushwork tend to be mostly flat or empty, so this typically shrinks
+cold tiles by an order of magnitude. A packed tile is expanded again
+the next time its pixels are read.
+
+Snapshots happen all the time, e.g. at the end of each stroke, so the
+live tiles of every layer are tracked too, not just the undo history.
+Tracking is cheap. Moving tiles isn't, so the stores do that on a
+worker thread, in small batches.
+
+"""
+
+## Imports
+
+from __future__ import division, print_function
+
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+import lib.workers
+
+
+logger = logging.getLogger(__name__)
+
+
+## Module constants
+
+#: Number of tile slots added to the file whenever it needs to grow.
+CHUNK_TILES = 256
+
+#: Tiles evicted per locked batch by the background worker.
+EVICT_BATCH_TILES = 64
+
+
+## Class defs
+
+
+class _StoredTileArray (np.ndarray):
+    """A tile array living in a slot of a TileStore's file.
+
+    The slot handle is propagated to views, so the slot stays allocated
+    for as long as anything can still see its memory.
+
+    """
+
+    def __array_finalize__(self, obj):
+        self._slot = getattr(obj, "_slot", None)
+
+
+class _Slot (object):
+    """Handle for an allocated slot. Frees it when garbage collected."""
+
+    def __init__(self, store, index):
+        super(_Slot, self).__init__()
+        self._store_ref = weakref.ref(store)
+        self.index = index
+
+    def __del__(self):
+        store = self._store_ref()
+        if store is not None:
+            try:
+                store._free_slot(self.index)
+            except Exception:
+                pass
+
+
+class _TileResidency (object):
+    """LRU residency tracking for read-only tiles (abstract)
+
+    Subclasses decide what happens to tiles evicted from the set of
+    recently used ones, by implementing _evict() and is_spilled().
+    Eviction runs on a worker thread of its own, started whenever the
+    set of recently used tiles grows past its limit.
+
+    """
+
+    def __init__(self, resident_limit):
+        """Initialize.
+
+        :param int resident_limit: max read-only tiles to keep as-is
+
+        """
+        super(_TileResidency, self).__init__()
+        self._resident_limit = max(0, int(resident_limit))
+        self._lock = threading.RLock()
+        self._resident = OrderedDict()  # {id(tile): weakref}, LRU first
+        self._closed = False
+        self._pool = lib.workers.WorkerPool(num_workers=1, name="tilestore")
+        self._eviction_job = None  # lib.workers.Job, while running
+
+    @property
+    def resident_limit(self):
+        """Number of read-only tiles which may be kept as they are."""
+        return self._resident_limit
+
+    ## Residency tracking
+
+    def add(self, tiles):
+        """Adds newly read-only tiles, as the most recently used.
+
+        :param iterable tiles: tiles to track; already-tracked or
+            already-spilled tiles are just marked as recently used.
+
+        This only records the tiles. Any excess is evicted later, in
+        the background: see finish_eviction().
+
+        """
+        with self._lock:
+            if self._closed:
+                return
+            resident = self._resident
+            for tile in tiles:
+                if self.is_spilled(tile):
+                    continue
+                key = id(tile)
+                ref = resident.pop(key, None)
+                if ref is None:
+                    ref = weakref.ref(tile, self._make_forget_cb(key))
+                resident[key] = ref
+            self._schedule_eviction()
+
+    def touch(self, tile):
+        """Marks a read-only tile as recently used."""
+        key = id(tile)
+        with self._lock:
+            ref = self._resident.pop(key, None)
+            if ref is not None:
+                self._resident[key] = ref
+
+    def readmit(self, tile):
+        """Marks a tile which was just brought back as recently used.
+
+        Like add(), this is cheap enough to call while rendering.
+
+        """
+        key = id(tile)
+        with self._lock:
+            if self._closed:
+                return
+            ref = self._resident.pop(key, None)
+            if ref is None:
+                ref = weakref.ref(tile, self._make_forget_cb(key))
+            self._resident[key] = ref
+            self._schedule_eviction()
+
+    def is_spilled(self, tile):
+        """True if the tile has been moved out of the resident set."""
+        raise NotImplementedError
+
+    def _make_forget_cb(self, key):
+        store_ref = weakref.ref(self)
+
+        def _forget(ref):
+            store = store_ref()
+            if store is None:
+                return
+            with store._lock:
+                if store._resident.get(key) is ref:
+                    del store._resident[key]
+
+        return _forget
+
+    ## Eviction
+
+    def finish_eviction(self):
+        """Waits for background eviction, then evicts any excess now."""
+        with self._lock:
+            job = self._eviction_job
+        if job is not None:
+            job.wait()
+        with self._lock:
+            tiles = self._pop_excess()
+        self._evict_tiles(tiles)
+
+    def _schedule_eviction(self):
+        """Starts background eviction if needed. Call with the lock held."""
+        if self._closed or self._eviction_job is not None:
+            return
+        if len(self._resident) <= self._resident_limit:
+            return
+        self._eviction_job = self._pool.submit(self._eviction_task)
+
+    def _eviction_task(self):
+        """Worker job: evicts LRU tiles in batches until within limit."""
+        try:
+            while True:
+                with self._lock:
+                    excess = len(self._resident) > self._resident_limit
+                    if self._closed or not excess:
+                        # Cleared under the lock, so that add() can't
+                        # miss out on scheduling the next run.
+                        self._eviction_job = None
+                        return
+                    tiles = self._pop_excess(EVICT_BATCH_TILES)
+                self._evict_tiles(tiles)
+        except Exception:
+            logger.exception("Tile eviction failed in %r", self)
+            with self._lock:
+                self._eviction_job = None
+
+    def _pop_excess(self, max_tiles=None):
+        """Removes excess LRU entries. Call with the lock held.
+
+        :param int max_tiles: stop after this many entries
+        :returns: the live read-only tiles removed
+        :rtype: list
+
+        """
+        resident = self._resident
+        tiles = []
+        n = 0
+        while len(resident) > self._resident_limit:
+            if max_tiles is not None and n >= max_tiles:
+                break
+            key, ref = resident.popitem(last=False)
+            n += 1
+            tile = ref()
+            if tile is None or not tile.readonly:
+                continue
+            tiles.append(tile)
+        return tiles
+
+    def _evict_tiles(self, tiles):
+        """Evicts tiles removed by _pop_excess(), without the lock."""
+        for tile in tiles:
+            self._evict(tile)
+
+    def _evict(self, tile):
+        """Move a read-only tile's data out of the way (abstract)."""
+        raise NotImplementedError
+
+    ## Lifecycle
+
+    def close(self):
+        """Stops evicting tiles. Evicted ones remain readable."""
+        with self._lock:
+            self._closed = True
+            self._resident.clear()
+            job = self._eviction_job
+        if job is not None:
+            job.wait()
+        self._pool.shutdown()
+
+
+class TileStore (_TileResidency):
+    """Memory-mapped tile file with LRU residency for read-only tiles.
+
+    >>> import os, tempfile, shutil
+    >>> class Tile (object):
+    ...     def __init__(self, v):
+    ...         self.rgba = np.full((4, 4, 4), v, dtype="uint16")
+    ...         self.readonly = True
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> store = TileStore(os.path.join(tmpdir, "tiles.dat"),
+    ...                   resident_limit=2, tile_shape=(4, 4, 4))
+    >>> tiles = [Tile(i) for i in range(5)]
+    >>> store.add(tiles)
+    >>> store.finish_eviction()
+
+    The least recently added or used tiles get moved to the file,
+    without changing their content. That happens on a worker thread:
+    finish_eviction() waits for it.
+
+    >>> [store.is_spilled(t) for t in tiles]
+    [True, True, True, False, False]
+    >>> [int(t.rgba[0, 0, 0]) for t in tiles]
+    [0, 1, 2, 3, 4]
+    >>> store.stats()["spilled"]
+    3
+
+    Slots are recycled when their tiles go away.
+
+    >>> del tiles[0:2]
+    >>> store.stats()["spilled"]
+    1
+    >>> store.close()
+    >>> shutil.rmtree(tmpdir)
+
+    """
+
+    def __init__(self, path, resident_limit, tile_shape=None):
+        """Initialize, creating the backing file.
+
+        :param unicode path: where to create the tile file
+        :param int resident_limit: max read-only tiles to keep in RAM
+        :param tuple tile_shape: tile array shape (default: RGBA uint16)
+
+        """
+        super(TileStore, self).__init__(resident_limit)
+        if tile_shape is None:
+            from lib.mypaintlib import TILE_SIZE
+            tile_shape = (TILE_SIZE, TILE_SIZE, 4)
+        self._path = path
+        self._tile_shape = tuple(tile_shape)
+        self._tile_bytes = int(np.prod(tile_shape)) * 2
+        self._chunks = []  # [np.memmap]
+        self._free = []  # [slot index]
+        self._spilled = 0
+        with open(path, "wb"):
+            pass
+
+    def __repr__(self):
+        return "<TileStore %r resident=%d/%d spilled=%d>" % (
+            self._path,
+            len(self._resident),
+            self._resident_limit,
+            self._spilled,
+        )
+
+    @property
+    def path(self):
+        """Location of the backing file (read-only)."""
+        return self._path
+
+    def is_spilled(self, tile):
+        """True if the tile's data lives in the backing file."""
+        return isinstance(tile.rgba, _StoredTileArray)
+
+    def _evict(self, tile):
+        """Copy a tile into the file, and point the tile at the copy."""
+        src = tile.rgba
+        if src.shape != self._tile_shape or src.dtype != np.uint16:
+            return
+        dst = self._alloc()
+        dst[...] = src
+        tile.rgba = dst  # atomic swap: old readers keep a valid copy
+
+    ## Slot management
+
+    def _alloc(self):
+        """Allocate a slot, returning a tile array view of it."""
+        with self._lock:
+            if not self._free:
+                self._grow()
+            index = self._free.pop()
+            chunk = self._chunks[index // CHUNK_TILES]
+            arr = chunk[index % CHUNK_TILES].view(_StoredTileArray)
+            arr._slot = _Slot(self, index)
+            self._spilled += 1
+        return arr
+
+    def _free_slot(self, index):
+        with self._lock:
+            self._free.append(index)
+            self._spilled -= 1
+
+    def _grow(self):
+        """Extend the file by one chunk of slots, and map it."""
+        nchunks = len(self._chunks)
+        chunk_bytes = CHUNK_TILES * self._tile_bytes
+        offset = nchunks * chunk_bytes
+        with open(self._path, "r+b") as fp:
+            fp.truncate(offset + chunk_bytes)
+        chunk = np.memmap(
+            self._path,
+            dtype="uint16",
+            mode="r+",
+            offset=offset,
+            shape=(CHUNK_TILES,) + self._tile_shape,
+        )
+        self._chunks.append(chunk)
+        first = nchunks * CHUNK_TILES
+        self._free.extend(reversed(range(first, first + CHUNK_TILES)))
+        logger.debug(
+            "Tile store %r grown to %d slots",
+            self._path,
+            first + CHUNK_TILES,
+        )
+
+    ## Info and lifecycle
+
+    def stats(self):
+        """Returns counters, for debugging and tests.
+
+        :returns: resident (tracked RAM tiles), resident_limit,
+            spilled (tiles in the file), slots (file capacity in tiles),
+            and file_bytes.
+        :rtype: dict
+
+        """
+        with self._lock:
+            slots = len(self._chunks) * CHUNK_TILES
+            return dict(
+                resident = len(self._resident),
+                resident_limit = self._resident_limit,
+                spilled = self._spilled,
+                slots = slots,
+                file_bytes = slots * self._tile_bytes,
+            )
+
+    def close(self):
+        """Stops spilling tiles. Spilled ones remain readable.
+
+        The file's mappings are released once the last spilled tile
+        has been garbage collected. The file itself is left for its
+        owner to remove.
+
+        """
+        super(TileStore, self).close()
+
+
+class PackedTileStore (_TileResidency):
+    """In-memory compression of read-only tiles, with LRU residency.
+
+    Tiles handed to this store must support pack(), which drops their
+    pixel array in favour of a compressed copy, and a "packed" flag.
+    Unpacking is the tile's business: it happens transparently when
+    the tile's pixels are next read, and the tile is expected to call
+    readmit() on the active store when it does. See lib.tiledsurface.
+
+    >>> class Tile (object):
+    ...     def __init__(self):
+    ...         self.readonly = True
+    ...         self.packed = False
+    ...     def pack(self):
+    ...         self.packed = True
+    >>> store = PackedTileStore(resident_limit=2)
+    >>> tiles = [Tile() for i in range(5)]
+    >>> store.add(tiles)
+    >>> store.finish_eviction()
+    >>> [t.packed for t in tiles]
+    [True, True, True, False, False]
+    >>> store.stats()["packed"]
+    3
+
+    Unpacked tiles come back as the most recently used ones.
+
+    >>> tiles[0].packed = False
+    >>> store.readmit(tiles[0])
+    >>> store.finish_eviction()
+    >>> [t.packed for t in tiles]
+    [False, True, True, True, False]
+    >>> store.close()
+
+    """
+
+    def __init__(self, resident_limit):
+        """Initialize.
+
+        :param int resident_limit: max read-only tiles to keep unpacked
+
+        """
+        super(PackedTileStore, self).__init__(resident_limit)
+        self._packed = weakref.WeakSet()
+
+    def __repr__(self):
+        return "<PackedTileStore resident=%d/%d packed=%d>" % (
+            len(self._resident),
+            self._resident_limit,
+            len(self._packed),
+        )
+
+    def is_spilled(self, tile):
+        """True if the tile is currently held only in compressed form."""
+        return tile.packed
+
+    def _evict(self, tile):
+        tile.pack()
+        with self._lock:
+            self._packed.add(tile)
+
+    def stats(self):
+        """Returns counters, for debugging and tests.
+
+        :returns: resident (tracked unpacked tiles), resident_limit,
+            and packed (tiles packed by this store, and still packed).
+        :rtype: dict
+
+        """
+        with self._lock:
+            packed = sum(1 for t in list(self._packed) if t.packed)
+            return dict(
+                resident = len(self._resident),
+                resident_limit = self._resident_limit,
+                packed = packed,
+            )
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
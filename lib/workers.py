@@ -0,0 +1,291 @@
+# This file is part of MyPaint.
+# Copyright (C) 2026 by the MyPaint Development Team.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Threaded worker pools for CPU-heavy, GIL-releasing work.
+
+Most of the pixel crunching in MyPaint happens inside mypaintlib,
+and the hot tile functions there release the GIL while they run.
+That means plain Python threads can keep several cores busy
+as long as the Python-side glue between those calls stays small.
+
+Nothing here touches GTK. Results are handed back to the caller's
+thread, which is expected to be the main thread when UI updates
+need to be made.
+
+"""
+
+## Imports
+
+from __future__ import division, print_function
+
+import sys
+import threading
+import logging
+import multiprocessing
+
+from lib.pycompat import PY3
+
+if PY3:
+    import queue
+else:
+    import Queue as queue
+
+
+logger = logging.getLogger(__name__)
+
+
+## Module constants
+
+#: Upper bound for automatically sized pools.
+MAX_AUTO_WORKERS = 8
+
+
+## Helper functions
+
+def get_num_cpus():
+    """Returns the number of CPUs available, or 1 if unknown.
+
+    >>> get_num_cpus() >= 1
+    True
+
+    """
+    try:
+        return max(1, multiprocessing.cpu_count())
+    except NotImplementedError:
+        return 1
+
+
+def get_default_num_workers():
+    """Returns a sensible default size for an automatic worker pool.
+
+    >>> 1 <= get_default_num_workers() <= MAX_AUTO_WORKERS
+    True
+
+    """
+    return max(1, min(MAX_AUTO_WORKERS, get_num_cpus()))
+
+
+def normalize_num_workers(n):
+    """Normalizes a user-specified number of workers.
+
+    Zero or None means "pick automatically",
+    and negative values are clamped to 1.
+
+    >>> normalize_num_workers(3)
+    3
+    >>> normalize_num_workers(-2)
+    1
+    >>> normalize_num_workers(0) == get_default_num_workers()
+    True
+
+    """
+    if not n:
+        return get_default_num_workers()
+    return max(1, int(n))
+
+
+## Class defs
+
+
+class Job (object):
+    """A single submitted unit of work, and its eventual result."""
+
+    def __init__(self, func, args, kwargs):
+        super(Job, self).__init__()
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._cancelled = False
+
+    def _run(self):
+        if self._cancelled:
+            self._done.set()
+            return
+        try:
+            self._result = self._func(*self._args, **self._kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._done.set()
+
+    def cancel(self):
+        """Prevents the job from running if it hasn't started yet."""
+        self._cancelled = True
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        """True if the job has finished running (or was skipped)."""
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Waits for the job to finish. Returns done()."""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def result(self):
+        """Waits for the job, then returns its result or re-raises."""
+        self._done.wait()
+        if self._exc_info is not None:
+            exc = self._exc_info[1]
+            self._exc_info = None
+            raise exc
+        return self._result
+
+
+class WorkerPool (object):
+    """Fixed-size pool of daemon threads processing submitted jobs.
+
+    Worker threads are started lazily, on the first submission.
+
+    >>> pool = WorkerPool(num_workers=3)
+    >>> jobs = [pool.submit(pow, i, 2) for i in range(10)]
+    >>> [j.result() for j in jobs]
+    [0, 1, 4, 9, 16, 25, 36, 49, 64, 81]
+
+    The map_unordered() method is a blocking convenience wrapper
+    which yields items as they complete, in the calling thread.
+
+    >>> done = sorted(pool.map_unordered(abs, [-3, -1, -2]))
+    >>> done
+    [-3, -2, -1]
+
+    Exceptions raised by a job are re-raised in the thread
+    that asks for its result.
+
+    >>> list(pool.map_unordered(int, ["x"]))
+    Traceback (most recent call last):
+    ...
+    ValueError: invalid literal for int() with base 10: 'x'
+    >>> pool.shutdown()
+
+    """
+
+    _STOP = object()
+
+    def __init__(self, num_workers=None, name="worker"):
+        """Initialize, with a fixed number of workers.
+
+        :param int num_workers: thread count (None or 0: automatic)
+        :param str name: prefix for thread names, for debugging
+
+        """
+        super(WorkerPool, self).__init__()
+        self._num_workers = normalize_num_workers(num_workers)
+        self._name = name
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<WorkerPool %r n=%d>" % (self._name, self._num_workers)
+
+    @property
+    def num_workers(self):
+        """Number of worker threads in the pool (read-only)."""
+        return self._num_workers
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self._num_workers):
+                thread = threading.Thread(
+                    target=self._worker_main,
+                    name="%s-%d" % (self._name, i),
+                )
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _worker_main(self):
+        while True:
+            job = self._queue.get()
+            if job is self._STOP:
+                return
+            job._run()
+
+    def submit(self, func, *args, **kwargs):
+        """Queues a callable for processing by a worker.
+
+        :returns: a new Job for the callable.
+        :rtype: Job
+
+        """
+        self._ensure_started()
+        job = Job(func, args, kwargs)
+        self._queue.put(job)
+        return job
+
+    def map_unordered(self, func, items):
+        """Calls func(item) for each item, yielding items as they finish.
+
+        :param callable func: called with each item, on a worker thread
+        :param iterable items: the items to process
+        :returns: iterator yielding items in completion order
+
+        The iterator must be run to completion by the caller.
+        If any call raises, no further items are started,
+        and the exception is re-raised in the caller's thread.
+
+        """
+        items = list(items)
+        if not items:
+            return
+        done_q = queue.Queue()
+        failed = []
+
+        def _run(item):
+            if not failed:
+                try:
+                    func(item)
+                except Exception:
+                    failed.append(sys.exc_info())
+            done_q.put(item)
+
+        for item in items:
+            self.submit(_run, item)
+        for i in range(len(items)):
+            item = done_q.get()
+            if failed:
+                continue
+            yield item
+        if failed:
+            exc = failed[0][1]
+            del failed[:]
+            raise exc
+
+    def shutdown(self):
+        """Stops all worker threads once the queue has drained."""
+        with self._lock:
+            threads = self._threads
+            self._threads = []
+        for thread in threads:
+            self._queue.put(self._STOP)
+        for thread in threads:
+            thread.join()
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
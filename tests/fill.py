@@ -158,6 +158,7 @@ class FillTestsBase(unittest.TestCase):
         )
         handle = src.flood_fill(args, dst)
         handle.wait()
+        return handle
 
     @classmethod
     def setUpClass(cls):
@@ -302,6 +303,55 @@ class CorrectnessTests(FillTestsBase):
                     " src='{layer}'".format(layer=src.name)
                 )
 
+    @fill_test
+    def test_parallel_fill_identical(self):
+        """Filling tiles in parallel gives the same result as serially"""
+        options = floodfill.GapClosingOptions(7, True)
+        cases = [(src, None) for src in self.large]
+        cases += [(src, options) for src in self.gap_layers]
+        min_tiles = floodfill.PARALLEL_MIN_TILES
+        try:
+            for src, gc in cases:
+                with self.fill_layers() as (f1, f2):
+                    floodfill.PARALLEL_MIN_TILES = 1
+                    self.fill(src, f1, gc=gc, offset=3)
+                    floodfill.PARALLEL_MIN_TILES = sys.maxsize
+                    self.fill(src, f2, gc=gc, offset=3)
+                    self.assertTrue(
+                        self.layers_identical(f1, f2),
+                        msg="Parallel and serial fills should match!"
+                        " src={layer}".format(layer=src.name)
+                    )
+        finally:
+            floodfill.PARALLEL_MIN_TILES = min_tiles
+
+    @fill_test
+    def test_preview_fill_identical(self):
+        """Reusing the preview's tiles doesn't change the result"""
+        options = floodfill.GapClosingOptions(7, True)
+        cases = [(src, None) for src in self.large]
+        cases += [(src, options) for src in self.gap_layers]
+        delay = floodfill.PREVIEW_DELAY
+        interval = floodfill.PREVIEW_INTERVAL
+        try:
+            for src, gc in cases:
+                with self.fill_layers() as (f1, f2):
+                    floodfill.PREVIEW_DELAY = 0
+                    floodfill.PREVIEW_INTERVAL = 0
+                    handle = self.fill(src, f1, gc=gc)
+                    self.assertTrue(handle.preview.num_tiles > 0)
+                    floodfill.PREVIEW_DELAY = sys.maxsize
+                    handle = self.fill(src, f2, gc=gc)
+                    self.assertEqual(handle.preview.num_tiles, 0)
+                    self.assertTrue(
+                        self.layers_identical(f1, f2),
+                        msg="Fills with and without a preview should match!"
+                        " src={layer}".format(layer=src.name)
+                    )
+        finally:
+            floodfill.PREVIEW_DELAY = delay
+            floodfill.PREVIEW_INTERVAL = interval
+
     @fill_test
     def test_translation_invariant(self):
         offsets = ((0, 63), (-35, -77), (32, 21), (14, 26), (139, 64),)
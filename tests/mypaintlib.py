@@ -11,6 +11,7 @@ import sys
 import os
 import tempfile
 import shutil
+import zipfile
 
 import numpy as np
 
@@ -19,6 +20,10 @@ from lib import mypaintlib
 from lib import tiledsurface
 from lib import brush
 from lib import document
+from lib import command
+from lib import stroke
+from lib.errors import FileHandlingError
+import lib.layer.error
 
 
 N = mypaintlib.TILE_SIZE
@@ -113,6 +118,78 @@ class Painting (unittest.TestCase):
         s.save_as_png('test_brushPaint.png')
 
 
+class StrokeReplay (unittest.TestCase):
+    """Test replaying recorded strokes in one native call"""
+
+    def setUp(self):
+        myb_path = join(paths.TESTS_DIR, 'brushes/v2/charcoal.myb')
+        with open(myb_path, "r") as fp:
+            bi = brush.BrushInfo(fp.read())
+        bi.set_color_rgb((0.0, 0.9, 1.0))
+        b = brush.Brush(bi)
+
+        events = np.loadtxt(join(paths.TESTS_DIR, 'painting30sec.dat'))
+        self.stroke = stroke.Stroke()
+        self.stroke.start_recording(b)
+        t_old = events[0][0]
+        for t, x, y, pressure in events:
+            self.stroke.record_event(
+                t - t_old, x * 4, y * 4, pressure,
+                0.0, 0.0, 1.0, 0.0, 0.0,
+            )
+            t_old = t
+        self.stroke.stop_recording()
+
+    def _new_brush(self):
+        b = brush.Brush(brush.BrushInfo(self.stroke.brush_settings))
+        states = np.frombuffer(self.stroke.brush_state, dtype='float32')
+        b.set_states_from_array(states.copy())
+        return b
+
+    def test_render_matches_stroke_to(self):
+        """Stroke.render() paints what per-event stroke_to() calls do"""
+        expected = tiledsurface.Surface()
+        b = self._new_brush()
+        expected.begin_atomic()
+        for event in stroke.decode_events(self.stroke.stroke_data):
+            (dtime, x, y, pressure, xtilt, ytilt,
+             viewzoom, viewrotation, barrel_rotation) = event
+            b.stroke_to(
+                expected.backend, x, y, pressure, xtilt, ytilt, dtime,
+                viewzoom, viewrotation, barrel_rotation,
+            )
+        expected.end_atomic()
+
+        actual = tiledsurface.Surface()
+        self.stroke.render(actual)
+
+        tiles = set(expected.get_tiles())
+        self.assertTrue(tiles)
+        self.assertEqual(tiles, set(actual.get_tiles()))
+        for tx, ty in tiles:
+            with expected.tile_request(tx, ty, readonly=True) as a:
+                with actual.tile_request(tx, ty, readonly=True) as b:
+                    self.assertTrue((a == b).all())
+
+    def test_stroke_to_events_rejects_bad_arrays(self):
+        """stroke_to_events() raises for arrays it can't read"""
+        s = tiledsurface.Surface()
+        b = self._new_brush()
+        events = np.zeros((10, 18))
+        bad = [
+            (TypeError, [[0.0] * 9]),
+            (TypeError, events[:, :9].astype('float32').copy()),
+            (ValueError, events[:, :8].copy()),
+            (ValueError, events.reshape(-1)),
+            (ValueError, events[:, ::2]),
+        ]
+        for exc_type, data in bad:
+            with self.assertRaises(exc_type):
+                b.stroke_to_events(s.backend, data)
+        n = b.stroke_to_events(s.backend, events[:, :9].copy())
+        self.assertEqual(n, 10)
+
+
 class DocPaint (unittest.TestCase):
     """Test document equality after saving and loading."""
 
@@ -360,6 +437,230 @@ class DocPaint (unittest.TestCase):
         )
 
 
+class UndoMemory (unittest.TestCase):
+    """Tiles only kept for undo get compressed, and restored exactly."""
+
+    def _paint(self, doc, events):
+        cmd = command.Brushwork(doc, doc.layer_stack.current_path)
+        t_old = events[0][0]
+        for t, x, y, pressure in events:
+            cmd.stroke_to(
+                t - t_old,
+                x / 4, y / 4,
+                pressure,
+                0.0, 0.0,
+                1.0,  # view zoom
+                0.0,  # view rotation
+                0.0,  # barrel rotation
+            )
+            t_old = t
+        cmd.stop_recording()
+        doc.do(cmd)
+
+    def _pixels(self, layer):
+        return dict(
+            (pos, np.array(tile.rgba))
+            for (pos, tile) in layer._surface.tiledict.items()
+        )
+
+    def test_packed_undo_history(self):
+        """Undo history memory is measurable, and shrinks when packed"""
+        events = np.loadtxt(join(paths.TESTS_DIR, 'painting30sec.dat'))
+        doc = document.Document(painting_only=True, packed_tile_limit=16)
+        try:
+            nstrokes = 10
+            for chunk in np.array_split(events, nstrokes):
+                self._paint(doc, chunk)
+            layer = doc.layer_stack.current
+            painted = self._pixels(layer)
+
+            # Packing happens in the background
+            tiledsurface.get_tile_store().finish_eviction()
+            usage = doc.command_stack.get_memory_usage()
+            self.assertGreater(usage["tiles"], 16)
+            self.assertGreater(usage["packed"], 0)
+            self.assertLess(usage["bytes"], usage["unpacked_bytes"])
+            print(
+                "%d undo tiles, %d packed, %0.1f%% of unpacked size, "
+                % (usage["tiles"], usage["packed"],
+                   100.0 * usage["bytes"] / usage["unpacked_bytes"]),
+                end="",
+                file=sys.stderr,
+            )
+
+            for i in range(nstrokes):
+                doc.undo()
+            self.assertEqual(self._pixels(layer), {})
+            for i in range(nstrokes):
+                doc.redo()
+            redone = self._pixels(layer)
+            self.assertEqual(sorted(redone.keys()), sorted(painted.keys()))
+            for pos, rgba in painted.items():
+                self.assertTrue((redone[pos] == rgba).all())
+        finally:
+            doc.cleanup()
+        self.assertIsNone(tiledsurface.get_tile_store())
+
+
+class TileSharing (unittest.TestCase):
+    """Copies of surfaces share tiles until either is painted on."""
+
+    def _dab(self, s, r, g, b):
+        s.begin_atomic()
+        s.draw_dab(100, 100, 50, r, g, b, 1.0, 1.0)
+        s.end_atomic()
+
+    def test_copy_on_write(self):
+        """Duplicates share tiles and mipmaps, and stay independent"""
+        orig = tiledsurface.Surface()
+        self._dab(orig, 1, 0, 0)
+        self.assertFalse(orig.regenerate_mipmaps())
+        pixels = dict(
+            (pos, np.array(tile.rgba))
+            for (pos, tile) in orig.tiledict.items()
+        )
+
+        dup = tiledsurface.Surface()
+        dup.load_snapshot(orig.save_snapshot())
+        self.assertTrue(all(
+            dup.tiledict[pos] is tile
+            for (pos, tile) in orig.tiledict.items()
+        ))
+        for level in range(1, tiledsurface.MAX_MIPMAP_LEVEL + 1):
+            self.assertEqual(
+                dup._mipmaps[level].tiledict,
+                orig._mipmaps[level].tiledict,
+            )
+
+        self._dab(dup, 0, 0, 1)
+        for pos, rgba in pixels.items():
+            self.assertTrue((orig.tiledict[pos].rgba == rgba).all())
+            self.assertIsNot(dup.tiledict[pos], orig.tiledict[pos])
+
+    def test_snapshot_tiles_never_reused(self):
+        """Painting never writes into tiles a snapshot may still hold"""
+        surf = tiledsurface.Surface()
+        self._dab(surf, 1, 0, 0)
+        # Keep just the tiles, as the autosave journal and stroke diffs
+        # do, and not the snapshot object itself.
+        tiles = dict(surf.save_snapshot().tiledict)
+        pixels = dict(
+            (pos, np.array(tile.rgba))
+            for (pos, tile) in tiles.items()
+        )
+        self._dab(surf, 0, 1, 0)
+        for pos, tile in tiles.items():
+            self.assertIsNot(surf.tiledict[pos], tile)
+            self.assertTrue((tile.rgba == pixels[pos]).all())
+
+
+class Mipmaps (unittest.TestCase):
+    """Bulk mipmap regeneration matches the lazy, per-tile kind."""
+
+    def _paint(self, s):
+        events = np.loadtxt(join(paths.TESTS_DIR, 'painting30sec.dat'))
+        s.begin_atomic()
+        for t, x, y, pressure in events:
+            r = g = b = 0.5 * (1.0 + np.sin(t))
+            s.draw_dab(x * 3, y * 3, 12, r, g, b, pressure, 0.6)
+        s.end_atomic()
+
+    def test_bulk_regeneration(self):
+        """Mipmaps regenerated in bulk are the same as lazy ones"""
+        bulk = tiledsurface.Surface()
+        lazy = tiledsurface.Surface()
+        self._paint(bulk)
+        self._paint(lazy)
+        while bulk.regenerate_mipmaps(max_tiles=100):
+            pass
+        for level in range(1, tiledsurface.MAX_MIPMAP_LEVEL + 1):
+            bulk_mipmap = bulk._mipmaps[level]
+            lazy_mipmap = lazy._mipmaps[level]
+            self.assertFalse(bulk_mipmap._mipmap_dirty)
+            self.assertNotIn(
+                tiledsurface.mipmap_dirty_tile,
+                list(bulk_mipmap.tiledict.values()),
+            )
+            coords = set(bulk_mipmap.tiledict.keys())
+            coords.update(lazy_mipmap.tiledict.keys())
+            for tx, ty in coords:
+                with bulk_mipmap.tile_request(tx, ty, readonly=True) as a:
+                    with lazy_mipmap.tile_request(tx, ty,
+                                                  readonly=True) as b:
+                        self.assertTrue((a == b).all())
+
+
+class LazyLoading (unittest.TestCase):
+    """Test lazy loading of OpenRaster files"""
+
+    @classmethod
+    def setUpClass(cls):
+        # An ORA file with a mergedimage.png to use as the preview
+        cls._temp_dir = tempfile.mkdtemp()
+        cls._filename = join(cls._temp_dir, 'lazy.ora')
+        doc = document.Document()
+        doc.load(join(paths.TESTS_DIR, 'smallimage.ora'))
+        doc.save(cls._filename)
+        doc.cleanup()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls._temp_dir, ignore_errors=True)
+
+    def setUp(self):
+        self.doc = document.Document()
+        self.assertTrue(self.doc.load_ora(self._filename, lazy=True))
+        self.root = self.doc.layer_stack
+
+    def tearDown(self):
+        self.doc.cleanup()
+
+    def test_preview_shown_until_loaded(self):
+        """The preview stays set until all layers are loaded"""
+        self.assertIsNotNone(self.root.lazy_preview)
+        for layer in self.root.deepiter():
+            list(layer.get_tile_coords())  # decodes it
+        self.assertIsNotNone(self.root.lazy_preview)
+        self.doc.finish_lazy_loading()
+        self.assertIsNone(self.root.lazy_preview)
+
+    def test_edit_discards_preview(self):
+        """Changing a layer drops the preview"""
+        self.assertIsNotNone(self.root.lazy_preview)
+        self.root.deepget([0]).clear()
+        self.assertIsNone(self.root.lazy_preview)
+
+    def test_broken_member_not_saved(self):
+        """A layer whose deferred load fails refuses to be saved"""
+        # Truncate the top layer's PNG after its header, so the load is
+        # still deferred but fails when it runs.
+        broken = join(self._temp_dir, 'broken.ora')
+        with zipfile.ZipFile(self._filename) as src:
+            with zipfile.ZipFile(broken, 'w') as dst:
+                for info in src.infolist():
+                    data = src.read(info.filename)
+                    if info.filename == 'data/layer-00.png':
+                        data = data[:64]
+                    dst.writestr(info, data)
+        doc = document.Document()
+        try:
+            self.assertTrue(doc.load_ora(broken, lazy=True))
+            root = doc.layer_stack
+            doc.finish_lazy_loading()
+            self.assertIsNotNone(root.deepget([0]).load_error)
+            self.assertIsNone(root.deepget([1]).load_error)
+            self.assertRaises(
+                lib.layer.error.LoadingFailed,
+                root.deepget([0]).save_as_png,
+                join(self._temp_dir, 'broken.png'),
+            )
+            saved = join(self._temp_dir, 'broken-resaved.ora')
+            self.assertRaises(FileHandlingError, doc.save, saved)
+            self.assertFalse(os.path.exists(saved))
+        finally:
+            doc.cleanup()
+
+
 class Frame (unittest.TestCase):
     """Test frame saving"""
 
@@ -418,6 +719,31 @@ class Frame (unittest.TestCase):
             file=sys.stderr,
         )
 
+    def test_background_tile_origin(self):
+        """The background pattern is saved in phase with the frame"""
+        doc = document.Document()
+        doc.load(join(paths.TESTS_DIR, 'smallimage.ora'))
+        doc.set_frame_enabled(True)
+        doc.update_frame(x=13, y=-7, width=300, height=200)
+        doc.save('test_bgTileOrigin.ora')
+        x0, y0 = doc.get_effective_bbox()[0:2]
+
+        # What the non-concurrent writer used to save
+        bg = doc.layer_stack.background_layer
+        x, y, w, h = bg.get_bbox()
+        bg._surface.save_as_png('test_bgTileOrigin.png', x + x0, y + y0, w, h)
+        with open('test_bgTileOrigin.png', 'rb') as fp:
+            expected = fp.read()
+
+        with zipfile.ZipFile('test_bgTileOrigin.ora') as orazip:
+            names = [
+                n for n in orazip.namelist()
+                if n.startswith('data/background') and n.endswith('tile.png')
+            ]
+            self.assertEqual(len(names), 1)
+            self.assertEqual(orazip.read(names[0]), expected)
+        doc.cleanup()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -7,18 +7,29 @@ from os.path import join
 import sys
 import time
 import math
+import contextlib
 import cairo
 from collections import namedtuple
+from itertools import product
 import unittest
 
+import numpy as np
+
 from . import paths
 import lib.gichecks
 from lib import mypaintlib
 from lib.document import Document
+import lib.pixbufsurface
+import lib.workers
+import lib.layer
+import lib.layer.rendering
+import lib.modes
+import lib.tiledsurface
 from lib.pycompat import xrange, PY3
 
 
 TEST_BIGIMAGE = "bigimage.ora"
+N = mypaintlib.TILE_SIZE
 
 
 # Helpers:
@@ -49,6 +60,7 @@ def _scroll(tdw, model, width=1920, height=1080,
             assert model.layer_stack.deepget(path, None).mode == mode
     model.layer_stack.background_visible = use_background
     model.layer_stack._render_cache.clear()
+    tdw.renderer._backing_store.clear()
 
     radius = min(width, height) * turn_radius
     fakealloc = namedtuple("FakeAlloc", ["x", "y", "width", "height"])
@@ -96,8 +108,336 @@ def _scroll(tdw, model, width=1920, height=1080,
     return (nframes, dt)
 
 
+def _render_full(model, mipmap_level=0, repeats=3, spec=None,
+                 composite_caches=False):
+    """Test full-canvas render performance, without a GUI
+
+    Renders the document's whole bbox into an 8bpc pixbuf surface,
+    with the render cache cleared before each pass, so every tile
+    goes through the complete compositing pipeline each time.
+    The per-group and backdrop caches are cleared too, unless
+    "composite_caches" is true.
+
+    """
+    root = model.layer_stack
+    x, y, w, h = root.get_bbox()
+    fac = 2 ** mipmap_level
+    surf = lib.pixbufsurface.Surface(x // fac, y // fac, w // fac, h // fac)
+    tiles = list(surf.get_tiles())
+    clock_func = time.perf_counter if PY3 else time.clock
+    start = clock_func()
+    for i in xrange(repeats):
+        root._render_cache.clear()
+        if not composite_caches:
+            root._composite_caches_clear()
+        root.render(surf, tiles, mipmap_level, spec=spec)
+    dt = clock_func() - start
+    return (len(tiles) * repeats, dt, surf.pixbuf.get_pixels())
+
+
 # Test cases:
 
+class CompositeCaches (unittest.TestCase):
+    """Per-group and backdrop caches must not change what's rendered."""
+
+    def setUp(self):
+        self._model = Document(painting_only=True)
+        self._model.load(join(paths.TESTS_DIR, TEST_BIGIMAGE))
+
+    def tearDown(self):
+        self._model.cleanup()
+
+    def _render_cached(self):
+        return _render_full(self._model, repeats=1,
+                            composite_caches=True)[2]
+
+    def _render_uncached(self):
+        # With no current layer, there's no backdrop to split off
+        root = self._model.layer_stack
+        spec = root._get_render_spec()
+        spec.current = None
+        self.assertIsNone(root._split_ops_at_mark(root.get_render_ops(spec)))
+        return _render_full(self._model, repeats=1, spec=spec)[2]
+
+    def test_edit_current_layer(self):
+        root = self._model.layer_stack
+        paths_and_layers = [
+            (p, l) for (p, l) in root.walk()
+            if isinstance(l, lib.layer.PaintingLayer)
+        ]
+        path, layer = paths_and_layers[len(paths_and_layers) // 2]
+        root.current_path = path
+        self._render_cached()
+        stats_before = root._backdrop_cache.stats()
+
+        # Paint into one tile of the current layer, then redraw
+        # through the caches.
+        x, y, w, h = root.get_bbox()
+        tx, ty = (x // N + 1, y // N + 1)
+        with layer._surface.tile_request(tx, ty, readonly=False) as t:
+            t[:, :, 0] = 1 << 15
+            t[:, :, 3] = 1 << 15
+        layer._surface.notify_observers(tx * N, ty * N, N, N)
+        cached = self._render_cached()
+        stats_after = root._backdrop_cache.stats()
+        self.assertGreater(stats_after["hits"], stats_before["hits"])
+
+        self.assertEqual(cached, self._render_uncached())
+
+    def test_edit_other_layer(self):
+        root = self._model.layer_stack
+        walk = list(root.walk())
+        root.current_path = walk[0][0]
+        self._render_cached()
+        layer = [
+            l for (p, l) in walk
+            if isinstance(l, lib.layer.PaintingLayer)
+        ][-1]
+        layer.opacity = 0.5
+        cached = self._render_cached()
+        self.assertEqual(cached, self._render_uncached())
+
+
+class RenderPrograms (unittest.TestCase):
+    """Compiled render programs must match the Python interpreter."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls._model = Document(painting_only=True)
+        cls._model.load(join(paths.TESTS_DIR, TEST_BIGIMAGE))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._model.cleanup()
+
+    @contextlib.contextmanager
+    def _interpreted(self):
+        program_cls = lib.layer.rendering.RenderProgram
+        compile_func = vars(program_cls)["compile"]
+        program_cls.compile = classmethod(lambda cls, ops: None)
+        try:
+            yield
+        finally:
+            program_cls.compile = compile_func
+
+    def _compare(self, mipmap_level):
+        ntiles, dtc, compiled = _render_full(self._model, mipmap_level)
+        with self._interpreted():
+            ntiles, dti, interpreted = _render_full(self._model, mipmap_level)
+        self.assertEqual(compiled, interpreted)
+        print(
+            "%d tiles, interpreted: %0.3fs, compiled: %0.3fs (%0.2fx)"
+            % (ntiles, dti, dtc, dti / max(dtc, 1e-6)),
+            end=", ", file=sys.stderr,
+        )
+
+    def test_level0(self):
+        self._compare(0)
+
+    def test_level2(self):
+        self._compare(2)
+
+    # Synthetic layer trees, exercising every mode, nested and
+    # pass-through groups, zero opacity, and empty tiles:
+
+    _TILES = [(tx, ty) for ty in xrange(-1, 2) for tx in xrange(-1, 3)]
+
+    def _random_tile(self, rng):
+        alpha = rng.randint(0, (1 << 15) + 1, size=(N, N, 1))
+        if rng.rand() < 0.3:
+            alpha[:] = 1 << 15
+        elif rng.rand() < 0.2:
+            alpha[:] = 0
+        rgb = rng.rand(N, N, 3) * alpha
+        return np.concatenate([rgb, alpha], axis=2).astype('uint16')
+
+    def _random_layers(self, rng, stack, depth=0):
+        modes = lib.modes.STANDARD_MODES
+        for i in xrange(rng.randint(1, 5)):
+            if depth < 3 and rng.rand() < 0.3:
+                layer = lib.layer.LayerStack()
+                stack.append(layer)
+                self._random_layers(rng, layer, depth + 1)
+                if rng.rand() < 0.3:
+                    layer.mode = lib.modes.PASS_THROUGH_MODE
+                else:
+                    layer.mode = modes[rng.randint(len(modes))]
+                    layer.opacity = rng.choice([1.0, 0.7, 0.0])
+            else:
+                layer = lib.layer.PaintingLayer()
+                for tx, ty in self._TILES:
+                    if rng.rand() < 0.4:
+                        continue
+                    surf = layer._surface
+                    with surf.tile_request(tx, ty, readonly=False) as t:
+                        t[:] = self._random_tile(rng)
+                stack.append(layer)
+                layer.mode = modes[rng.randint(len(modes))]
+                layer.opacity = rng.choice([1.0, 0.5, 0.0, rng.rand()])
+            layer.visible = rng.rand() > 0.1
+
+    def _render_tiles(self, root, mipmap_level, background):
+        """Render to fix15 and 8bpc targets, without any caching"""
+        root._render_cache.clear()
+        root._composite_caches_clear()
+        surf = lib.tiledsurface.Surface()
+        root.render(surf, self._TILES, mipmap_level, background=background)
+        result = []
+        for tx, ty in self._TILES:
+            with surf.tile_request(tx, ty, readonly=True) as t:
+                result.append(t.copy())
+        root._render_cache.clear()
+        root._composite_caches_clear()
+        surf = lib.pixbufsurface.Surface(-N, -N, 4 * N, 3 * N)
+        root.render(surf, surf.get_tiles(), mipmap_level,
+                    background=background)
+        result.append(np.frombuffer(surf.pixbuf.get_pixels(), 'uint8'))
+        return result
+
+    def test_random_trees(self):
+        rng = np.random.RandomState(42)
+        for i in xrange(20):
+            root = lib.layer.RootLayerStack(doc=None)
+            self._random_layers(rng, root)
+            walk = list(root.walk())
+            if rng.rand() < 0.7:
+                root.current_path = walk[rng.randint(len(walk))][0]
+            # An explicit background makes the spec uncacheable, so
+            # isolated groups are run as PUSH/POP instructions.
+            for mipmap_level, background in product((0, 1), (None, False)):
+                compiled = self._render_tiles(root, mipmap_level, background)
+                with self._interpreted():
+                    interpreted = self._render_tiles(
+                        root, mipmap_level, background,
+                    )
+                for a, b in zip(compiled, interpreted):
+                    self.assertTrue(np.array_equal(a, b))
+
+
+class TileIndex (unittest.TestCase):
+    """The root's tile index must agree with the layers' own tiles."""
+
+    def setUp(self):
+        self._model = Document(painting_only=True)
+        self._model.load(join(paths.TESTS_DIR, TEST_BIGIMAGE))
+
+    def tearDown(self):
+        self._model.cleanup()
+
+    def _check(self):
+        root = self._model.layer_stack
+        layers = [
+            l for l in root.deepiter()
+            if not isinstance(l, lib.layer.LayerStack)
+        ]
+        tiles = set()
+        for layer in layers:
+            tiles.update(layer.get_tile_coords())
+        self.assertEqual(root.get_tile_coords(), tiles)
+        self.assertEqual(
+            root.get_bbox(),
+            lib.layer.LayerStack.get_bbox(root),
+        )
+        index = root._get_tile_index()
+        for tx, ty in tiles:
+            expected = set(
+                l._surface for l in layers
+                if (tx, ty) in l.get_tile_coords()
+            )
+            found = set(index.get_surfaces_at(tx, ty))
+            self.assertTrue(expected.issubset(found))
+
+    def test_edits(self):
+        root = self._model.layer_stack
+        self._check()
+        layer = [
+            l for (p, l) in root.walk()
+            if isinstance(l, lib.layer.PaintingLayer)
+        ][0]
+        x, y, w, h = root.get_bbox()
+        tx, ty = ((x + w) // N + 3, (y + h) // N + 3)
+        with layer._surface.tile_request(tx, ty, readonly=False) as t:
+            t[:, :, 3] = 1 << 15
+        layer._surface.notify_observers(tx * N, ty * N, N, N)
+        self._check()
+        self.assertIn((tx, ty), root.get_tile_coords())
+        layer.clear()
+        self._check()
+        root.deepremove(root.deepget((0,)))
+        self._check()
+
+    def test_nested_groups(self):
+        root = self._model.layer_stack
+        outer = lib.layer.LayerStack()
+        inner = lib.layer.LayerStack()
+        root.append(outer)
+        outer.append(inner)
+        self._check()
+
+        # Layers with data, appended into a nested group
+        x, y, w, h = root.get_bbox()
+        tx, ty = ((x + w) // N + 3, (y + h) // N + 3)
+        layer = lib.layer.PaintingLayer()
+        with layer._surface.tile_request(tx, ty, readonly=False) as t:
+            t[:, :, 3] = 1 << 15
+        inner.append(layer)
+        self._check()
+        self.assertIn((tx, ty), root.get_tile_coords())
+        self.assertEqual(
+            root.get_bbox(),
+            (x, y, (tx + 1) * N - x, (ty + 1) * N - y),
+        )
+
+        # Painting inside it
+        with layer._surface.tile_request(tx, ty + 2, readonly=False) as t:
+            t[:, :, 3] = 1 << 15
+        layer._surface.notify_observers(tx * N, (ty + 2) * N, N, N)
+        self._check()
+        self.assertIn((tx, ty + 2), root.get_tile_coords())
+
+        # Group-level changes
+        inner.opacity = 0.5
+        self._check()
+        root.deepremove(layer)
+        self._check()
+        self.assertNotIn((tx, ty), root.get_tile_coords())
+        self.assertEqual(root.get_bbox(), (x, y, w, h))
+
+
+class RenderWorkers (unittest.TestCase):
+    """Headless full-redraw performance: 1 render worker versus N."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls._model = Document(painting_only=True)
+        cls._model.load(join(paths.TESTS_DIR, TEST_BIGIMAGE))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._model.cleanup()
+
+    def _compare(self, mipmap_level):
+        root = self._model.layer_stack
+        nworkers = lib.workers.get_default_num_workers()
+        root.render_workers = 1
+        ntiles, dt1, pixels1 = _render_full(self._model, mipmap_level)
+        root.render_workers = nworkers
+        ntiles, dtn, pixelsn = _render_full(self._model, mipmap_level)
+        root.render_workers = 1
+        self.assertEqual(pixels1, pixelsn)
+        print(
+            "%d tiles, 1 worker: %0.3fs, %d workers: %0.3fs (%0.2fx)"
+            % (ntiles, dt1, nworkers, dtn, dt1 / max(dtn, 1e-6)),
+            end=", ", file=sys.stderr,
+        )
+
+    def test_level0(self):
+        self._compare(0)
+
+    def test_level1(self):
+        self._compare(1)
+
+
 class Scroll (unittest.TestCase):
     """Not-quite headless raw panning/scrolling performance tests."""
 
@@ -0,0 +1,612 @@
+#!/usr/bin/env python
+"""Headless benchmarks for the core lib/ code paths
+
+Each benchmark runs in a fresh child process, and is repeated a few
+times. The best time of each is reported, and can be written out as
+JSON along with some information about the machine. A stored results
+file can be used as a baseline: benchmarks which got slower than it by
+more than a threshold are flagged as regressions.
+
+    tests/test_performance.py -l
+    tests/test_performance.py -a -o baseline.json
+    tests/test_performance.py -a -b baseline.json
+
+See README.profiling.md for profiling with this script.
+
+"""
+
+# Imports:
+
+from __future__ import division, print_function
+
+import sys
+import os
+from os.path import join
+import json
+import platform
+import subprocess
+import cProfile
+import tempfile
+import shutil
+import datetime
+from time import sleep
+from optparse import OptionParser
+
+import numpy as np
+
+TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
+TOP_DIR = os.path.dirname(TESTS_DIR)
+
+if TOP_DIR not in sys.path:
+    sys.path.insert(0, TOP_DIR)
+
+from lib.pycompat import PY3  # noqa: E402
+
+if PY3:
+    from time import perf_counter as clock_func
+else:
+    from time import clock as clock_func
+
+
+# Constants:
+
+START_MEASUREMENT = -1
+STOP_MEASUREMENT = -2
+
+#: Default regression threshold, as a fraction of the baseline time.
+DEFAULT_THRESHOLD = 0.15
+
+RESULTS_FORMAT_VERSION = 1
+
+BIGIMAGE = join(TESTS_DIR, "bigimage.ora")
+FILL_OUTLINES = join(TESTS_DIR, "fill_outlines.ora")
+PAINTING = join(TESTS_DIR, "painting30sec.dat")
+BRUSHES_DIR = join(TESTS_DIR, "brushes", "v3")
+BRUSHPACK = join(TESTS_DIR, "brushpacks", "saved-with-py2.7.zip")
+
+all_benchmarks = {}
+
+
+# Benchmark registration and running:
+
+def benchmark(f):
+    """Decorator: registers a benchmark
+
+    Benchmarks are generators. They do their setup, then yield
+    START_MEASUREMENT, do the measured work, and yield
+    STOP_MEASUREMENT. This can happen more than once: the measured
+    times are summed.
+
+    """
+    all_benchmarks[f.__name__] = f
+    return f
+
+
+def run_benchmark(func, profile=None):
+    """Runs a single benchmark, returning its measured time"""
+    gen = func()
+    time_total = 0.0
+    for res in gen:
+        assert res == START_MEASUREMENT, res
+
+        def run_measured_part():
+            res = next(gen)
+            assert res == STOP_MEASUREMENT, res
+
+        t0 = clock_func()
+        if profile:
+            profile.runcall(run_measured_part)
+        else:
+            run_measured_part()
+        time_total += clock_func() - t0
+    return time_total
+
+
+# Helpers:
+
+def _new_document(**kwargs):
+    from lib.document import Document
+    return Document(**kwargs)
+
+
+def _load_events():
+    """The recorded painting, as (dtime, x, y, pressure) rows"""
+    events = []
+    t_old = None
+    for t, x, y, pressure in np.loadtxt(PAINTING):
+        if t_old is None:
+            t_old = t
+        events.append((t - t_old, x, y, pressure))
+        t_old = t
+    return events
+
+
+def _load_brushes():
+    """Brushes from the test brush folder and the test brush pack
+
+    :returns: the brushes' settings strings, by name
+    :rtype: list of tuples
+
+    """
+    import zipfile
+    brushes = []
+    for name in sorted(os.listdir(BRUSHES_DIR)):
+        if not name.endswith(".myb"):
+            continue
+        with open(join(BRUSHES_DIR, name)) as fp:
+            brushes.append((name, fp.read()))
+    with zipfile.ZipFile(BRUSHPACK) as zf:
+        for name in sorted(zf.namelist()):
+            if not name.endswith(".myb"):
+                continue
+            brushes.append((name, zf.read(name).decode("utf-8")))
+    return brushes
+
+
+def _paint(doc, layer_path, events, brushinfo):
+    """Paints some events as one undoable Brushwork command"""
+    import lib.command
+    doc.brush.brushinfo.load_from_brushinfo(brushinfo)
+    cmd = lib.command.Brushwork(doc, layer_path)
+    for (dtime, x, y, pressure) in events:
+        cmd.stroke_to(dtime, x, y, pressure, 0.0, 0.0, 1.0, 0.0, 0.0)
+    cmd.stop_recording()
+    doc.do(cmd)
+
+
+def _render(root, mipmap_level):
+    """Renders a layer stack's whole bbox into an 8bpc pixbuf surface"""
+    import lib.pixbufsurface
+    x, y, w, h = root.get_bbox()
+    x >>= mipmap_level
+    y >>= mipmap_level
+    w = max(1, w >> mipmap_level)
+    h = max(1, h >> mipmap_level)
+    surf = lib.pixbufsurface.Surface(x, y, w, h)
+    root.render(surf, list(surf.get_tiles()), mipmap_level)
+
+
+def _fill(src, dst, bbox, gap_closing_options=None):
+    """Flood fills from the centre of a layer, like tests/fill.py"""
+    from lib import floodfill
+    from lib import mypaintlib
+    sx, sy, sw, sh = src.get_bbox()
+    x, y = sx + sw // 2, sy + sh // 2
+    args = floodfill.FloodFillArguments(
+        (x, y), {(x, y)}, (0.0, 0.0, 0.0), 0.2, 0,
+        0, gap_closing_options, mypaintlib.CombineNormal, False,
+        1.0, False, bbox,
+    )
+    handle = src.flood_fill(args, dst)
+    handle.wait()
+
+
+# Benchmarks:
+
+@benchmark
+def load_ora():
+    doc = _new_document()
+    yield START_MEASUREMENT
+    doc.load(BIGIMAGE)
+    yield STOP_MEASUREMENT
+    doc.cleanup()
+
+
+@benchmark
+def save_ora():
+    tmpdir = tempfile.mkdtemp()
+    doc = _new_document()
+    doc.load(BIGIMAGE)
+    yield START_MEASUREMENT
+    doc.save(join(tmpdir, "test_save.ora"))
+    yield STOP_MEASUREMENT
+    doc.cleanup()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+@benchmark
+def save_png():
+    tmpdir = tempfile.mkdtemp()
+    doc = _new_document()
+    doc.load(BIGIMAGE)
+    yield START_MEASUREMENT
+    doc.save(join(tmpdir, "test_save.png"))
+    yield STOP_MEASUREMENT
+    doc.cleanup()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+@benchmark
+def render_full():
+    doc = _new_document()
+    doc.load(BIGIMAGE)
+    yield START_MEASUREMENT
+    _render(doc.layer_stack, 0)
+    yield STOP_MEASUREMENT
+    doc.cleanup()
+
+
+@benchmark
+def render_mipmap():
+    doc = _new_document()
+    doc.load(BIGIMAGE)
+    for level in (1, 2, 3):
+        yield START_MEASUREMENT
+        _render(doc.layer_stack, level)
+        yield STOP_MEASUREMENT
+    doc.cleanup()
+
+
+@benchmark
+def stroke_replay():
+    from lib import brush
+    from lib import stroke
+    from lib import tiledsurface
+    events = _load_events()
+    strokes = []
+    for name, settings in _load_brushes():
+        b = brush.Brush(brush.BrushInfo(settings))
+        s = stroke.Stroke()
+        s.start_recording(b)
+        for (dtime, x, y, pressure) in events:
+            s.record_event(dtime, x, y, pressure, 0.0, 0.0, 1.0, 0.0, 0.0)
+        s.stop_recording()
+        strokes.append(s)
+    surface = tiledsurface.Surface()
+    yield START_MEASUREMENT
+    for s in strokes:
+        s.render(surface)
+    yield STOP_MEASUREMENT
+
+
+@benchmark
+def flood_fill():
+    doc = _new_document()
+    doc.load(FILL_OUTLINES)
+    root = doc.layer_stack
+    src = root.deepget((0, 2))
+    dst = root.deepget((3, 0))
+    yield START_MEASUREMENT
+    _fill(src, dst, root.get_bbox())
+    yield STOP_MEASUREMENT
+    doc.cleanup()
+
+
+@benchmark
+def flood_fill_gap_closing():
+    from lib import floodfill
+    doc = _new_document()
+    doc.load(FILL_OUTLINES)
+    root = doc.layer_stack
+    src = root.deepget((1, 0))
+    dst = root.deepget((3, 0))
+    options = floodfill.GapClosingOptions(7, True)
+    yield START_MEASUREMENT
+    _fill(src, dst, root.get_bbox(), options)
+    yield STOP_MEASUREMENT
+    doc.cleanup()
+
+
+@benchmark
+def merge_down():
+    doc = _new_document()
+    doc.load(BIGIMAGE)
+    doc.select_layer(path=(0,))
+    yield START_MEASUREMENT
+    while doc.merge_current_layer_down():
+        pass
+    yield STOP_MEASUREMENT
+    doc.cleanup()
+
+
+@benchmark
+def merge_visible():
+    doc = _new_document()
+    doc.load(BIGIMAGE)
+    yield START_MEASUREMENT
+    doc.merge_visible_layers()
+    yield STOP_MEASUREMENT
+    doc.cleanup()
+
+
+@benchmark
+def autosave():
+    from lib import brush
+    doc = _new_document()
+    doc.load(BIGIMAGE)
+    # A full autosave, then an incremental one after some painting.
+    yield START_MEASUREMENT
+    doc._autosave_dirty = True
+    doc._queue_autosave_writes()
+    doc._autosave_processor.finish_all()
+    yield STOP_MEASUREMENT
+    bi = brush.BrushInfo(_load_brushes()[0][1])
+    _paint(doc, doc.layer_stack.current_path, _load_events(), bi)
+    yield START_MEASUREMENT
+    doc._autosave_dirty = True
+    doc._queue_autosave_writes()
+    doc._autosave_processor.finish_all()
+    yield STOP_MEASUREMENT
+    doc.cleanup()
+
+
+@benchmark
+def undo_redo():
+    from lib import brush
+    doc = _new_document()
+    doc.load(BIGIMAGE)
+    root = doc.layer_stack
+    events = _load_events()
+    brushes = [brush.BrushInfo(s) for (name, s) in _load_brushes()]
+    nlayers = len(root)
+    chunk = len(events) // 8
+    for i in range(8):
+        path = (i % nlayers,)
+        bi = brushes[i % len(brushes)]
+        _paint(doc, path, events[i*chunk:(i+1)*chunk], bi)
+    ncommands = len(doc.command_stack.undo_stack)
+    for i in range(3):
+        yield START_MEASUREMENT
+        for j in range(ncommands):
+            doc.undo()
+        for j in range(ncommands):
+            doc.redo()
+        yield STOP_MEASUREMENT
+    doc.cleanup()
+
+
+# Results:
+
+def get_machine_info():
+    """Information about the machine and software running benchmarks
+
+    :rtype: dict
+
+    """
+    import lib.workers
+    import lib.meta
+    return dict(
+        node = platform.node(),
+        platform = platform.platform(),
+        machine = platform.machine(),
+        processor = platform.processor(),
+        num_cpus = lib.workers.get_num_cpus(),
+        python = platform.python_version(),
+        numpy = np.__version__,
+        mypaint = lib.meta.MYPAINT_VERSION,
+    )
+
+
+def write_results(filename, names, results, count):
+    """Writes benchmark results as JSON"""
+    benchmarks = {}
+    for name, times in zip(names, results):
+        if not times:
+            continue
+        benchmarks[name] = dict(
+            times = times,
+            best = min(times),
+        )
+    data = dict(
+        version = RESULTS_FORMAT_VERSION,
+        date = datetime.datetime.now().isoformat(),
+        count = count,
+        machine = get_machine_info(),
+        benchmarks = benchmarks,
+    )
+    with open(filename, "w") as fp:
+        json.dump(data, fp, indent=2, sort_keys=True)
+
+
+def compare_results(baseline_file, names, results, threshold):
+    """Compares results against a stored baseline, and prints a report
+
+    :returns: names of benchmarks which regressed
+    :rtype: list
+
+    """
+    with open(baseline_file) as fp:
+        baseline = json.load(fp)
+    machine = get_machine_info()
+    for key, value in sorted(baseline.get("machine", {}).items()):
+        if machine.get(key) != value:
+            print("warning: baseline %s was %r, now %r"
+                  % (key, value, machine.get(key)))
+    regressions = []
+    base_benchmarks = baseline.get("benchmarks", {})
+    for name, times in zip(names, results):
+        base = base_benchmarks.get(name)
+        if not times:
+            continue
+        if not base:
+            print("%-24s %8.3f   (not in baseline)" % (name, min(times)))
+            continue
+        ratio = min(times) / base["best"]
+        status = "ok"
+        if ratio > 1.0 + threshold:
+            status = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1.0 - threshold:
+            status = "improved"
+        print("%-24s %8.3f %8.3f %+7.1f%%  %s" % (
+            name, min(times), base["best"], (ratio - 1.0) * 100, status,
+        ))
+    return regressions
+
+
+# Main program:
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == 'SINGLE_TEST_RUN':
+        func = all_benchmarks[sys.argv[2]]
+        if sys.argv[3] == 'NONE':
+            result = run_benchmark(func)
+        else:
+            profile = cProfile.Profile()
+            result = run_benchmark(func, profile)
+            profile.dump_stats(sys.argv[3])
+        print('result =', result)
+        return 0
+
+    parser = OptionParser('usage: %prog [options] [test1 test2 test3 ...]')
+    parser.add_option(
+        '-a',
+        '--all',
+        action='store_true',
+        default=False,
+        help='run all benchmarks'
+    )
+    parser.add_option(
+        '-l',
+        '--list',
+        action='store_true',
+        default=False,
+        help='list all available benchmarks'
+    )
+    parser.add_option(
+        '-c',
+        '--count',
+        metavar='N',
+        type='int',
+        default=3,
+        help='number of repetitions (default: 3)'
+    )
+    parser.add_option(
+        '-o',
+        '--output',
+        metavar='FILE',
+        help='write results to FILE as JSON, for use as a baseline'
+    )
+    parser.add_option(
+        '-b',
+        '--baseline',
+        metavar='FILE',
+        help='compare results against a baseline written with -o'
+    )
+    parser.add_option(
+        '-t',
+        '--threshold',
+        metavar='PERCENT',
+        type='float',
+        default=DEFAULT_THRESHOLD * 100,
+        help='slowdown flagged as a regression (default: %default%)'
+    )
+    parser.add_option(
+        '-p',
+        '--profile',
+        metavar='PREFIX',
+        help='dump cProfile info to PREFIX_TESTNAME_N.pstats'
+    )
+    parser.add_option(
+        '-s',
+        '--show-profile',
+        action='store_true',
+        default=False,
+        help='run cProfile, gprof2dot.py and show last result'
+    )
+    options, tests = parser.parse_args()
+
+    if options.list:
+        for name in sorted(all_benchmarks.keys()):
+            print(name)
+        return 0
+
+    if not tests:
+        if options.all:
+            tests = sorted(all_benchmarks)
+        else:
+            parser.print_help()
+            return 1
+
+    for t in tests:
+        if t not in all_benchmarks:
+            print('Unknown benchmark:', t)
+            return 1
+
+    results = []
+    for t in tests:
+        result = []
+        for i in range(options.count):
+            print('---')
+            print('running benchmark "%s" (run %d of %d)'
+                  % (t, i + 1, options.count))
+            print('---')
+            # spawn a new process for each run, to ensure proper cleanup
+            args = [sys.executable, os.path.abspath(__file__),
+                    'SINGLE_TEST_RUN', t, 'NONE']
+            if options.profile or options.show_profile:
+                if options.show_profile:
+                    fname = 'tmp.pstats'
+                else:
+                    fname = '%s_%s_%d.pstats' % (options.profile, t, i)
+                args[4] = fname
+            child = subprocess.Popen(args, stdout=subprocess.PIPE)
+            output, junk = child.communicate()
+            output = output.decode("utf-8", "replace")
+            if child.returncode != 0:
+                print('FAILED')
+                result = None
+                break
+            print(output, end=' ')
+            try:
+                value = float(output.split('result = ')[-1].strip())
+            except ValueError:
+                print('FAILED to find result in test output.')
+                result = None
+                break
+            result.append(value)
+        # some time to press ctrl-c
+        sleep(1.0)
+        results.append(result)
+    print()
+    print('=== DETAILS ===')
+    print('tests =', repr(tests))
+    print('results =', repr(results))
+    print()
+    print('=== SUMMARY ===')
+    fail = False
+    for t, result in zip(tests, results):
+        if not result:
+            print(t, 'FAILED')
+            fail = True
+        else:
+            print('%s %.3f' % (t, min(result)))
+
+    if options.output:
+        write_results(options.output, tests, results, options.count)
+        print()
+        print('Results written to %r' % (options.output,))
+
+    if options.baseline:
+        print()
+        print('=== BASELINE COMPARISON ===')
+        threshold = options.threshold / 100.0
+        regressions = compare_results(
+            options.baseline, tests, results, threshold,
+        )
+        if regressions:
+            print()
+            print('Regressions: %s' % (", ".join(regressions),))
+            fail = True
+
+    if options.show_profile:
+        from distutils.spawn import find_executable
+        gprof2dot = "gprof2dot.py" \
+            if find_executable("gprof2dot.py") \
+            else "gprof2dot"
+        viewer = "feh" \
+            if find_executable("feh") \
+            else "eog"
+        # FIXME: use gui.profiling's improved code somehow
+        os.system(
+            '%s -f pstats tmp.pstats | dot -Tpng -o tmp.png && %s tmp.png'
+            % (gprof2dot, viewer)
+        )
+
+    if fail:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())